@@ -30,7 +30,7 @@ setup(
     version=0.3,
     author='Carlos Abalde',
     author_email='carlos.abalde@gmail.com',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
     url='https://github.com/carlosabalde/varnishsentry',
     description=
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import logging
+
+# Delivery failures are logged on purpose by some tests.
+logging.getLogger('varnishsentry').addHandler(logging.NullHandler())
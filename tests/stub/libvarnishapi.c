@@ -0,0 +1,98 @@
+/*
+ * Stub of the libvarnishapi subset used by varnishsentry (Varnish 3.0 API).
+ * Instead of reading the shared memory log, VSL_Dispatch() hands over
+ * synthetic client txs fed by stub_feed(). Just like the real library, it
+ * blocks waiting for records unless non blocking mode has been enabled.
+ * Dispatches & distinct callbacks are counted.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <strings.h>
+#include <unistd.h>
+
+typedef int vsl_handler(
+    void *priv, int tag, unsigned fd, unsigned len, unsigned spec,
+    const char *ptr, unsigned long long bitmap);
+
+const char *VSL_tags[256] = {
+    NULL, "Debug", "Error", "CLI", "StatSess", "ReqEnd", "SessionOpen",
+    "SessionClose", "BackendOpen", "BackendXID", "BackendReuse",
+    "BackendClose", "HttpGarbage", "Backend", "Length", "FetchError",
+    "RxRequest", "RxResponse", "RxStatus", "RxURL", "RxProtocol", "RxHeader",
+    "TxRequest", "TxResponse", "TxStatus", "TxURL", "TxProtocol", "TxHeader",
+    "ObjRequest", "ObjResponse", "ObjStatus", "ObjURL", "ObjProtocol",
+    "ObjHeader", "LostHeader", "TTL", "Fetch_Body", "VCL_acl", "VCL_call",
+    "VCL_trace", "VCL_return", "VCL_error", "ReqStart", "Hit", "HitPass",
+    "ExpBan", "ExpKill", "WorkThread", "ESI_xmlerror", "Hash",
+    "Backend_health", "VCL_Log", "Gzip",
+};
+
+/* Records of a client tx: tag & payload. */
+static const struct {
+    int tag;
+    const char *ptr;
+} records[] = {
+    {42, "127.0.0.1 80 1"},
+    {19, "/"},
+    {24, "503"},
+    {5, "1 1.0 1.0 0.0 0.0 0.0"},
+};
+
+#define RECORDS (sizeof(records) / sizeof(records[0]))
+
+static volatile long available = 0;
+static unsigned long position = 0;
+static int nonblocking = 0;
+static long dispatches = 0;
+static long handlers = 0;
+static vsl_handler *handler = NULL;
+
+void *VSM_New(void) { return calloc(1, 16); }
+
+void VSL_Setup(void *vd) {}
+
+int VSL_Arg(void *vd, int arg, const char *opt) { return 1; }
+
+int VSL_Open(void *vd, int diag) { return 0; }
+
+void VSL_NonBlocking(void *vd, int nb) { nonblocking = nb; }
+
+int VSL_Name2Tag(const char *name, int l)
+{
+    int i;
+    for (i = 0; i < 256; i++)
+        if (VSL_tags[i] != NULL && strcasecmp(VSL_tags[i], name) == 0)
+            return i;
+    return -1;
+}
+
+int VSL_Dispatch(void *vd, vsl_handler *func, void *priv)
+{
+    dispatches++;
+    if (func != handler) {
+        handler = func;
+        handlers++;
+    }
+    for (;;) {
+        if (available <= 0) {
+            if (nonblocking)
+                return 0;
+            usleep(1000);
+            continue;
+        }
+        __sync_fetch_and_sub(&available, 1);
+        unsigned long i = position++ % RECORDS;
+        if (func(priv, records[i].tag, 10, strlen(records[i].ptr), 1,
+                 records[i].ptr, 0))
+            return 1;
+    }
+}
+
+void stub_feed(long txs) { __sync_fetch_and_add(&available, txs * RECORDS); }
+
+long stub_available(void) { return available; }
+
+long stub_dispatches(void) { return dispatches; }
+
+long stub_handlers(void) { return handlers; }
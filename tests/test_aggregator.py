@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import unittest
+from varnishsentry.aggregator import Aggregator
+
+
+def event(message, items=None):
+    return {
+        'message': message,
+        'data': {
+            'timestamp': 0,
+            'level': 'error',
+            'tags': {'worker': 'w', 'filter': 'f', 'type': 'client'},
+        },
+        'extra': {'items': items or [('TxStatus', message)]},
+    }
+
+
+class AggregatorTestCase(unittest.TestCase):
+    def test_first_event_is_delivered_right_away(self):
+        aggregator = Aggregator({'window': 60})
+        first = event('GET /items/1')
+        self.assertEqual(aggregator.add(first, 0), [first])
+        self.assertEqual(aggregator.add(event('GET /items/2'), 1), [])
+        self.assertEqual(aggregator.add(event('GET /items/3'), 2), [])
+        self.assertEqual(aggregator.aggregated, 2)
+
+        # The summary is delivered once the window is over.
+        self.assertEqual(aggregator.flush(59), [])
+        summary, = aggregator.flush(60)
+        self.assertEqual(summary['message'], 'GET /items/1')
+        self.assertEqual(summary['extra']['occurrences'], 3)
+        self.assertEqual(len(summary['extra']['samples']), 2)
+        self.assertNotIn('occurrences', first['extra'])
+
+    def test_single_events_get_no_summary(self):
+        aggregator = Aggregator({'window': 60})
+        aggregator.add(event('GET /'), 0)
+        self.assertEqual(aggregator.flush(60), [])
+
+    def test_oldest_window_is_closed_early(self):
+        aggregator = Aggregator({'window': 60, 'max_keys': 1})
+        aggregator.add(event('GET /a'), 0)
+        aggregator.add(event('GET /a'), 1)
+        other = event('GET /b')
+        result = aggregator.add(other, 2)
+        self.assertEqual(result[0], other)
+        self.assertEqual(result[1]['extra']['occurrences'], 2)
+        self.assertEqual(aggregator.flush(0, force=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import unittest
+from varnishsentry import bench
+
+
+class BenchTestCase(unittest.TestCase):
+    def test_baseline_agrees(self):
+        # Both dispatch modes see the same txs & matches.
+        result = bench.run(transactions=2000, match_rate=0.05)
+        baseline = bench.run(transactions=2000, match_rate=0.05, baseline=True)
+        self.assertEqual(result['records'], baseline['records'])
+        self.assertEqual(result['transactions'], 2000)
+        self.assertEqual(baseline['transactions'], 2000)
+        self.assertGreater(result['events'], 0)
+        self.assertEqual(result['events'], baseline['events'])
+        self.assertLess(result['dispatched'], baseline['dispatched'])
+
+
+    def test_shards_agree(self):
+        # Sharded runs see the same txs & matches, whatever the number of
+        # shards.
+        result = bench.run(transactions=2000, match_rate=0.05)
+        sharded = bench.run_shards([1, 3], transactions=2000, match_rate=0.05)
+        for item in sharded['results']:
+            self.assertEqual(item['records'], result['records'])
+            self.assertEqual(item['forwarded'], result['dispatched'])
+            self.assertEqual(item['transactions'], 2000)
+            self.assertEqual(item['events'], result['events'])
+            self.assertEqual(len(item['shard_cpu_seconds']), item['shards'])
+
+if __name__ == '__main__':
+    unittest.main()
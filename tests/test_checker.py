@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import time
+import unittest
+from varnishsentry import checker
+
+
+class Regexp(object):
+    # Fake regexp whose evaluations take some time.
+
+    def __init__(self, delays):
+        self._delays = list(delays)
+
+    def search(self, message):
+        time.sleep(self._delays.pop(0) if self._delays else 0)
+
+
+class CheckerTestCase(unittest.TestCase):
+    def test_rule_predicates_are_checked(self):
+        reports = checker.check({
+            'w': {
+                'rules': [{
+                    'expression': r'RxURL ~ "^/(a+)+$" and Length.bytes > 100',
+                    'name': 'rule',
+                }],
+            },
+        })
+        reports = dict((report['tag'], report) for report in reports)
+        self.assertEqual(sorted(reports), ['Length', 'RxURL'])
+        self.assertEqual(reports['RxURL']['name'], 'rule')
+        self.assertEqual(reports['RxURL']['regexp'], '^/(a+)+$')
+        self.assertTrue(reports['RxURL']['risks'])
+        self.assertFalse(reports['Length']['risks'])
+
+    def test_hiccups_are_not_slow_evaluations(self):
+        elapsed = checker._confirm(Regexp([]), 'message', 0.05)
+        self.assertLess(elapsed, checker.SLOW_EVALUATION)
+
+    def test_slow_evaluations_are_confirmed(self):
+        regexp = Regexp([0.005] * checker.SLOW_EVALUATION_RUNS)
+        elapsed = checker._confirm(regexp, 'message', 0.005)
+        self.assertGreaterEqual(elapsed, checker.SLOW_EVALUATION)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import os
+import time
+import ctypes
+import shutil
+import tempfile
+import unittest
+import subprocess
+from varnishsentry.consumer import Consumer, DEFAULT_MAX_BYTES, MAX_IDLE_BACKOFF
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub', 'libvarnishapi.c')
+
+
+class StubConsumer(Consumer):
+    # Consumer reading from the stub libvarnishapi. Matched events are
+    # collected.
+
+    def _init_delivery(self):
+        self._senders = {}
+        self.events = []
+
+    def _deliver(self, worker, event):
+        self.events.append(event)
+
+
+class IdleConsumer(StubConsumer):
+    # Consumer whose thread does nothing, so tests dispatch by themselves.
+
+    def _loop(self):
+        pass
+
+
+class ClockConsumer(IdleConsumer):
+    # Idle consumer whose clock is set by tests.
+
+    now = 0
+
+    def _get_clock(self):
+        return lambda: self.now
+
+
+class SharedConsumer(IdleConsumer):
+    # Idle consumer serving two workers with different limits.
+
+    def _get_workers(self):
+        return {
+            'a': dict(self._config, limits={'transactions': 10, 'items': 50}),
+            'b': dict(self._config, limits={'items': 5}),
+        }
+
+
+class ConsumerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Build the stub libvarnishapi.
+        cls.tmp = tempfile.mkdtemp()
+        cls.sopath = os.path.join(cls.tmp, 'libvarnishapi.so')
+        try:
+            subprocess.check_call(
+                [os.environ.get('CC', 'cc'), '-shared', '-fPIC', '-O2', '-o', cls.sopath, STUB])
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.tmp)
+            raise unittest.SkipTest('Unable to build the stub libvarnishapi.')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        # A fresh copy of the library for each test, so its state is not
+        # shared.
+        self.path = os.path.join(self.tmp, 'libvarnishapi-%s.so' % self.id())
+        shutil.copy(self.sopath, self.path)
+        self.lib = ctypes.CDLL(self.path)
+        self.consumers = []
+
+    def tearDown(self):
+        for consumer in self.consumers:
+            consumer._shutdown()
+
+    def consumer(self, cls=StubConsumer, **config):
+        consumer = cls(None, None, None, 'test', dict({
+            'libvarnishapi': self.path,
+            'filters': {
+                'TxStatus': [{
+                    'regexp': r'^5\d\d$',
+                    'name': '5xx',
+                    'level': 'error',
+                }],
+            },
+        }, **config), False)
+        self.consumers.append(consumer)
+        return consumer
+
+    def wait(self, condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def dispatch(self, consumer, spec, tag, fd, message):
+        # Hand a record to the consumer, as libvarnishapi would.
+        ptr = ctypes.create_string_buffer(message)
+        consumer._vap_callBack(
+            None, list(consumer._tags).index(tag), fd, len(message), spec, ptr, 0)
+
+    def test_records_are_dispatched(self):
+        consumer = self.consumer()
+        consumer._init()
+        self.lib.stub_feed(100)
+        self.assertTrue(self.wait(lambda: len(consumer.events) == 100))
+        self.assertEqual(consumer.events[0]['data']['tags']['filter'], '5xx')
+
+    def test_callback_object_is_reused(self):
+        consumer = self.consumer()
+        consumer._init()
+        for i in range(10):
+            self.lib.stub_feed(10)
+            self.assertTrue(self.wait(lambda: self.lib.stub_available() == 0))
+        self.assertTrue(self.wait(lambda: self.lib.stub_dispatches() > 10))
+        self.assertEqual(self.lib.stub_handlers(), 1)
+
+    def test_dispatch_overhead(self):
+        # Mean cost of dispatching when the log is idle, and per record cost.
+        consumer = self.consumer(cls=IdleConsumer)
+        consumer._init()
+        consumer._thread.join()
+        consumer._consuming = True
+        vap = consumer._vap
+        vap.VSL_NonBlocking(1)
+
+        count = 10000
+        started = time.time()
+        for i in range(count):
+            vap.VSL_DispatchHandler(consumer._handler, priv=False)
+        idle = (time.time() - started) / count
+        self.assertLess(idle, 100e-6)
+
+        txs = 10000
+        self.lib.stub_feed(txs)
+        started = time.time()
+        vap.VSL_DispatchHandler(consumer._handler, priv=False)
+        record = (time.time() - started) / (4 * txs)
+        self.assertEqual(len(consumer.events), txs)
+        self.assertLess(record, 200e-6)
+
+    def test_shutdown_is_bounded_when_idle(self):
+        consumer = self.consumer()
+        consumer._init()
+        self.lib.stub_feed(10)
+        self.assertTrue(self.wait(lambda: len(consumer.events) == 10))
+
+        # Let the idle backoff reach its maximum.
+        time.sleep(20 * MAX_IDLE_BACKOFF)
+        started = time.time()
+        consumer._shutdown()
+        self.assertFalse(consumer._thread.is_alive())
+        self.assertLess(time.time() - started, 2 * MAX_IDLE_BACKOFF + 0.05)
+
+    def test_shutdown_without_init(self):
+        self.consumer()._shutdown()
+
+    def test_shutdown_after_failed_init(self):
+        # Correlation requires both tx types, so initialization fails before
+        # delivery is initialized.
+        consumer = self.consumer(
+            options={'-c': True, '-b': False},
+            correlation={'enabled': True})
+        self.assertRaises(AssertionError, consumer._init)
+        consumer._shutdown()
+
+
+    def test_idle_tx_types_are_purged(self):
+        # Backend txs time out even if only client records keep arriving.
+        consumer = self.consumer(cls=ClockConsumer, timeout=1, filters={
+            'TxStatus': [{'regexp': r'^5\d\d$', 'name': '5xx', 'level': 'error'}],
+            'RxStatus': [{'regexp': r'^5\d\d$', 'name': '5xx', 'level': 'error'}],
+        })
+        consumer._init()
+        consumer._thread.join()
+        consumer._consuming = True
+
+        for fd in range(10):
+            self.dispatch(consumer, 2, 'BackendOpen', 100 + fd, '1 default 127.0.0.1 80')
+        self.assertEqual(len(consumer._buffers[2]), 10)
+
+        consumer.now += 10
+        self.dispatch(consumer, 1, 'ReqStart', 10, '127.0.0.1 80 1')
+        self.assertEqual(len(consumer._buffers[2]), 0)
+        self.assertEqual(consumer._timed_out[2], 10)
+        self.assertEqual(len(consumer._buffers[1]), 1)
+
+
+    def test_strictest_limits_apply_to_shared_buffers(self):
+        consumer = self.consumer(cls=SharedConsumer)
+        consumer._init()
+        self.assertEqual(consumer._max_transactions, 10)
+        self.assertEqual(consumer._max_items, 5)
+        self.assertEqual(consumer._max_bytes, DEFAULT_MAX_BYTES)
+
+    def rules_consumer(self, expression):
+        # Clock consumer using a single client rule (and no filters).
+        consumer = self.consumer(
+            cls=ClockConsumer, filters={}, options={'-c': True, '-b': False},
+            rules=[{'expression': expression, 'name': 'rule', 'level': 'error'}])
+        consumer._init()
+        consumer._thread.join()
+        consumer._consuming = True
+        return consumer
+
+    def test_rules_are_decided_as_records_arrive(self):
+        consumer = self.rules_consumer(r'TxStatus ~ "^5" and RxURL ~ "^/api"')
+        self.dispatch(consumer, 1, 'ReqStart', 10, '127.0.0.1 80 1')
+        tx = consumer._buffers[1][10]
+        self.assertEqual(tx.verdicts, [None])
+        self.dispatch(consumer, 1, 'RxURL', 10, '/api/items')
+        self.assertEqual(tx.verdicts, [None])
+        self.dispatch(consumer, 1, 'TxStatus', 10, '503')
+        self.assertEqual(tx.verdicts, [True])
+        self.assertEqual(consumer.events, [])
+        self.dispatch(consumer, 1, 'ReqEnd', 10, '1 1.0 1.0 0.0 0.0 0.0')
+        self.assertEqual(len(consumer.events), 1)
+        self.assertEqual(consumer.events[0]['data']['tags']['filter'], 'rule')
+        self.assertEqual(consumer._discarded[1], 0)
+
+    def test_rules_are_decided_false_and_tx_discarded(self):
+        consumer = self.rules_consumer(r'TxStatus ~ "^5" and RxURL ~ "^/api"')
+        self.dispatch(consumer, 1, 'ReqStart', 10, '127.0.0.1 80 1')
+        self.assertIn(10, consumer._buffers[1])
+
+        # RxURL is logged once per tx, so the rule can't hold anymore.
+        self.dispatch(consumer, 1, 'RxURL', 10, '/static/logo.png')
+        self.assertNotIn(10, consumer._buffers[1])
+        self.assertEqual(consumer._discarded[1], 1)
+
+        # Remaining records of the tx are ignored.
+        self.dispatch(consumer, 1, 'TxStatus', 10, '503')
+        self.dispatch(consumer, 1, 'ReqEnd', 10, '1 1.0 1.0 0.0 0.0 0.0')
+        self.assertEqual(consumer._buffers[1], {})
+        self.assertEqual(consumer._committed[1], 0)
+        self.assertEqual(consumer.events, [])
+
+    def test_rules_on_repeated_tags_are_decided_at_the_end(self):
+        consumer = self.rules_consumer(r'TxStatus ~ "^5" and not VCL_Log ~ "EXPECTED"')
+
+        # Some VCL_Log record could still match, so the rule is undecided
+        # until the tx ends.
+        self.dispatch(consumer, 1, 'ReqStart', 10, '127.0.0.1 80 1')
+        self.dispatch(consumer, 1, 'TxStatus', 10, '503')
+        self.dispatch(consumer, 1, 'VCL_Log', 10, 'unrelated')
+        self.assertEqual(consumer._buffers[1][10].verdicts, [None])
+        self.dispatch(consumer, 1, 'ReqEnd', 10, '1 1.0 1.0 0.0 0.0 0.0')
+        self.assertEqual(len(consumer.events), 1)
+
+        # Unless a matching VCL_Log record is found.
+        self.dispatch(consumer, 1, 'ReqStart', 11, '127.0.0.1 80 2')
+        self.dispatch(consumer, 1, 'TxStatus', 11, '503')
+        self.dispatch(consumer, 1, 'VCL_Log', 11, '[EXPECTED]')
+        self.assertNotIn(11, consumer._buffers[1])
+        self.assertEqual(consumer._discarded[1], 1)
+        self.dispatch(consumer, 1, 'ReqEnd', 11, '1 1.0 1.0 0.0 0.0 0.0')
+        self.assertEqual(len(consumer.events), 1)
+
+    def test_txs_are_kept_when_filters_need_them(self):
+        # Filters on the same tx type may still match, so txs no rule can
+        # match are not discarded.
+        consumer = self.consumer(
+            cls=ClockConsumer, options={'-c': True, '-b': False},
+            rules=[{'expression': 'RxURL ~ "^/api"', 'name': 'rule', 'level': 'error'}])
+        consumer._init()
+        consumer._thread.join()
+        consumer._consuming = True
+        self.dispatch(consumer, 1, 'ReqStart', 10, '127.0.0.1 80 1')
+        self.dispatch(consumer, 1, 'RxURL', 10, '/static/logo.png')
+        self.assertEqual(consumer._buffers[1][10].verdicts, [False])
+        self.dispatch(consumer, 1, 'TxStatus', 10, '503')
+        self.dispatch(consumer, 1, 'ReqEnd', 10, '1 1.0 1.0 0.0 0.0 0.0')
+        self.assertEqual(consumer._discarded[1], 0)
+        self.assertEqual(
+            [event['data']['tags']['filter'] for event in consumer.events], ['5xx'])
+
+if __name__ == '__main__':
+    unittest.main()
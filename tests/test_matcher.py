@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+import random
+import unittest
+from varnishsentry import fields
+from varnishsentry.matcher import MAX_CACHED_FIELDS, Header, Matcher, _extract_literal
+
+
+def filter(name, regexp):
+    return {
+        'name': name,
+        'regexp': re.compile(regexp) if isinstance(regexp, basestring) else regexp,
+        'cost': 0.0,
+        'evaluations': 0,
+    }
+
+
+def field(name, tag, **conditions):
+    # Field filter named '<field>:<whatever>'.
+    return filter(name, fields.build(tag, dict(conditions, field=name.split(':')[0])))
+
+
+class MatcherTestCase(unittest.TestCase):
+    def match(self, matcher, message):
+        # Names of matching filters, checking profiling agrees.
+        result = [item['name'] for item in matcher.match(message)]
+        self.assertEqual([item['name'] for item in matcher.profile(message)], result)
+        return result
+
+
+class FieldsTestCase(MatcherTestCase):
+    def test_reqend_fields(self):
+        matcher = Matcher([
+            field('total:slow', 'ReqEnd', gt=2.0),
+            field('total:fast', 'ReqEnd', lt=0.5),
+            field('start:recent', 'ReqEnd', ge=1000.0),
+            field('xid:one', 'ReqEnd', eq=1),
+        ])
+        self.assertEqual(
+            self.match(matcher, '1 1000.0 1003.5 0.0 0.0 0.0'),
+            ['total:slow', 'start:recent', 'xid:one'])
+        self.assertEqual(
+            self.match(matcher, '2 10.0 10.1 0.0 0.0 0.0'),
+            ['total:fast'])
+        self.assertEqual(self.match(matcher, '2 10.0 11.0 0.0 0.0 0.0'), [])
+
+    def test_reqend_boundaries(self):
+        matcher = Matcher([
+            field('total:ge', 'ReqEnd', ge=2.0),
+            field('total:gt', 'ReqEnd', gt=2.0),
+            field('total:le', 'ReqEnd', le=2.0),
+            field('total:range', 'ReqEnd', ge=1.0, lt=3.0),
+        ])
+        self.assertEqual(
+            self.match(matcher, '1 1.0 3.0 0.0 0.0 0.0'),
+            ['total:ge', 'total:le', 'total:range'])
+        self.assertEqual(self.match(matcher, '1 1.0 4.5 0.0 0.0 0.0'), ['total:ge', 'total:gt'])
+
+    def test_malformed_messages(self):
+        matcher = Matcher([field('total:any', 'ReqEnd', ge=0.0)])
+        self.assertEqual(self.match(matcher, '1 1.0'), [])
+        self.assertEqual(self.match(matcher, '1 x 2.0 0.0 0.0 0.0'), [])
+        self.assertEqual(self.match(matcher, ''), [])
+        matcher = Matcher([field('bytes:any', 'Length', ge=0)])
+        self.assertEqual(self.match(matcher, 'nan?'), [])
+
+    def test_status_fields(self):
+        matcher = Matcher([
+            field('status:errors', 'RxStatus', ge=500),
+            field('status:unavailable', 'RxStatus', **{'in': [502, 503, 504]}),
+            field('status:ok', 'RxStatus', ne=503, lt=400),
+        ])
+        self.assertEqual(self.match(matcher, '503'), ['status:errors', 'status:unavailable'])
+        self.assertEqual(self.match(matcher, '500'), ['status:errors'])
+        self.assertEqual(self.match(matcher, '200'), ['status:ok'])
+        self.assertEqual(self.match(matcher, '404'), [])
+
+    def test_length_field(self):
+        matcher = Matcher([
+            field('bytes:empty', 'Length', eq=0),
+            field('bytes:large', 'Length', gt=1024 * 1024),
+        ])
+        self.assertEqual(self.match(matcher, '0'), ['bytes:empty'])
+        self.assertEqual(self.match(matcher, '2097152'), ['bytes:large'])
+        self.assertEqual(self.match(matcher, '512'), [])
+
+    def test_cached_results(self):
+        # Single field tags cache results per message, up to some size.
+        matcher = Matcher([field('status:errors', 'RxStatus', ge=500)])
+        for i in range(3):
+            self.assertEqual(self.match(matcher, '503'), ['status:errors'])
+            self.assertEqual(self.match(matcher, '200'), [])
+        for status in range(2 * MAX_CACHED_FIELDS):
+            self.assertEqual(
+                self.match(matcher, str(status)),
+                ['status:errors'] if status >= 500 else [])
+        self.assertLessEqual(len(matcher._cache), MAX_CACHED_FIELDS)
+
+    def test_regexp_filters_on_the_same_tag(self):
+        matcher = Matcher([
+            filter('regexp:5xx', r'^5\d\d$'),
+            field('status:unavailable', 'TxStatus', eq=503),
+            filter('regexp:3', r'3'),
+        ])
+        self.assertEqual(
+            self.match(matcher, '503'),
+            ['regexp:5xx', 'status:unavailable', 'regexp:3'])
+        self.assertEqual(self.match(matcher, '500'), ['regexp:5xx'])
+        self.assertEqual(self.match(matcher, '301'), ['regexp:3'])
+        self.assertEqual(self.match(matcher, '200'), [])
+
+    def test_invalid_fields(self):
+        self.assertRaises(AssertionError, fields.build, 'RxURL', {'field': 'path', 'eq': 1})
+        self.assertRaises(AssertionError, fields.build, 'Length', {'field': 'size', 'eq': 1})
+        self.assertRaises(AssertionError, fields.build, 'Length', {'field': 'bytes'})
+
+
+class HeadersTestCase(MatcherTestCase):
+    def test_names_are_case_insensitive(self):
+        matcher = Matcher([filter('host', Header('Host'))])
+        self.assertEqual(self.match(matcher, 'Host: example.com'), ['host'])
+        self.assertEqual(self.match(matcher, 'host: example.com'), ['host'])
+        self.assertEqual(self.match(matcher, 'HOST:example.com'), ['host'])
+        matcher = Matcher([filter('host', Header('hOsT '))])
+        self.assertEqual(self.match(matcher, 'Host: example.com'), ['host'])
+
+    def test_missing_header(self):
+        matcher = Matcher([filter('host', Header('Host'))])
+        self.assertEqual(self.match(matcher, 'X-Host: example.com'), [])
+        self.assertEqual(self.match(matcher, 'Hostname: example.com'), [])
+        self.assertEqual(self.match(matcher, 'Host'), [])
+        self.assertEqual(self.match(matcher, ''), [])
+
+    def test_value_regexps(self):
+        matcher = Matcher([
+            filter('cache:miss', Header('X-Cache', re.compile(r'^MISS'))),
+            filter('cache:any', Header('X-Cache')),
+            filter('agent:bot', Header('User-Agent', re.compile(r'(?i)bot'))),
+        ])
+        # Leading whitespace is not part of the value.
+        self.assertEqual(self.match(matcher, 'X-Cache:   MISS from a'), ['cache:miss', 'cache:any'])
+        self.assertEqual(self.match(matcher, 'x-cache: HIT, MISS'), ['cache:any'])
+        self.assertEqual(self.match(matcher, 'User-Agent: GoogleBot/2.1'), ['agent:bot'])
+        self.assertEqual(self.match(matcher, 'User-Agent: curl/7.0'), [])
+
+        # The value regexp only applies to the value.
+        matcher = Matcher([filter('cache', Header('X-Cache', re.compile(r'Cache')))])
+        self.assertEqual(self.match(matcher, 'X-Cache: MISS'), [])
+
+    def test_regexp_filters_on_the_same_tag(self):
+        matcher = Matcher([
+            filter('regexp:cookie', r'(?i)^cookie:'),
+            filter('header:cookie', Header('Cookie', re.compile(r'session='))),
+            filter('regexp:session', r'session='),
+        ])
+        self.assertEqual(
+            self.match(matcher, 'Cookie: session=1'),
+            ['regexp:cookie', 'header:cookie', 'regexp:session'])
+        self.assertEqual(self.match(matcher, 'cookie: theme=dark'), ['regexp:cookie'])
+        self.assertEqual(self.match(matcher, 'Referer: /?session=1'), ['regexp:session'])
+        self.assertEqual(self.match(matcher, 'Host: example.com'), [])
+
+    def test_invalid_names(self):
+        self.assertRaises(AssertionError, Header, '')
+        self.assertRaises(AssertionError, Header, 'Host:')
+
+    def test_description(self):
+        self.assertEqual(Header(' Host ').description, 'Host: *')
+        self.assertEqual(Header('Host', re.compile('^a')).description, 'Host: ^a')
+
+
+
+class EquivalenceTestCase(MatcherTestCase):
+    # The literal prefilter & the combined regexp must select exactly the
+    # same filters as running every regexp on its own.
+
+    MESSAGES = [
+        '', '503', '5031', 'GET /api/items', 'post /API/items', 'POST /static',
+        '[WTF] x', 'text/xml', 'foobarbar', 'foobarbaz', 'ABC', 'abc', 'xxy',
+        'error: fail', 'ERROR', 'line\nabc', 'Host: www.example.com',
+        '[E3] failure in y', '[E3] fail',
+    ]
+
+    ALPHABET = 'GETPOSgetpos /apixmlfoobarWTF[]E0123456789\nerror:ABC'
+
+    def check(self, patterns, count=5000):
+        filters = [filter(pattern, pattern) for pattern in patterns]
+        matcher = Matcher(filters)
+        rnd = random.Random(1)
+        messages = list(self.MESSAGES)
+        for i in range(count):
+            messages.append(''.join(
+                rnd.choice(self.ALPHABET) for j in range(rnd.randint(0, 16))))
+            messages.append(rnd.choice(self.MESSAGES) + messages[-1])
+        for message in messages:
+            self.assertEqual(
+                self.match(matcher, message),
+                [item['name'] for item in filters if item['regexp'].search(message)],
+                repr(message))
+        return matcher
+
+    def test_literals(self):
+        literal = lambda pattern: _extract_literal(re.compile(pattern))
+        self.assertEqual(literal(r'^5\d\d$'), ('5', True))
+        self.assertEqual(literal(r'^\[WTF\].*'), ('[WTF]', True))
+        self.assertEqual(literal(r'^(GET|POST) /api'), (' /api', False))
+        self.assertEqual(literal(r'x+y'), ('y', False))
+        self.assertEqual(literal(r'(?m)^abc'), ('abc', False))
+        self.assertIsNone(literal(r'foo|bar'))
+        self.assertIsNone(literal(r'\d{3}'))
+        self.assertIsNone(literal(r'(?i)abc'))
+
+    def test_combined(self):
+        matcher = self.check([
+            r'^5\d\d$', r'^\[WTF\].*', r'^(GET|POST) /api', r'foo|bar', r'x+y',
+            r'.*xml.*', r'\d{3}', r'abc$', r'error|fail', r'^\[E3\] fail',
+            r'^\[E\d\] failure in .*',
+        ])
+        self.assertIsNotNone(matcher._regexp)
+        self.assertTrue(matcher._prefixes)
+        self.assertTrue(matcher._substrings)
+        self.assertTrue(matcher._others)
+
+    def test_case_insensitive(self):
+        matcher = self.check([
+            r'(?i)^get /api', r'(?i)abc', r'(?i)error|fail', r'(?i)^(get|post) ',
+        ])
+        self.assertIsNotNone(matcher._regexp)
+        self.assertEqual(len(matcher._others), 4)
+
+    def test_not_combined(self):
+        # Mixed flags & group references prevent combining regexps.
+        self.assertIsNone(self.check([
+            r'^5\d\d$', r'(?i)abc', r'foo|bar', r'(?m)^abc',
+        ])._regexp)
+        self.assertIsNone(self.check([
+            r'^5\d\d$', r'foo(bar)\1', r'(ba[rz])', r'x+y',
+        ])._regexp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+import unittest
+from varnishsentry import rules
+from varnishsentry.rules import AND, NOT, OR, PREDICATE
+
+
+def p(index):
+    return (PREDICATE, index)
+
+
+class ParserTestCase(unittest.TestCase):
+    def parse(self, expression):
+        tree, predicates = rules.parse(expression)
+        return tree, [(tag, regexp.pattern) for tag, regexp in predicates]
+
+    def error(self, expression):
+        with self.assertRaises(AssertionError) as context:
+            rules.parse(expression)
+        return str(context.exception)
+
+    def test_predicate(self):
+        self.assertEqual(
+            self.parse('TxStatus ~ "^5"'),
+            (p(0), [('TxStatus', '^5')]))
+
+    def test_not_binds_tighter_than_and(self):
+        tree, predicates = self.parse('not A ~ "a" and B ~ "b"')
+        self.assertEqual(tree, (AND, ((NOT, p(0)), p(1))))
+
+    def test_and_binds_tighter_than_or(self):
+        tree, predicates = self.parse('A ~ "a" or B ~ "b" and not C ~ "c"')
+        self.assertEqual(tree, (OR, (p(0), (AND, (p(1), (NOT, p(2)))))))
+        tree, predicates = self.parse('A ~ "a" and B ~ "b" or C ~ "c"')
+        self.assertEqual(tree, (OR, ((AND, (p(0), p(1))), p(2))))
+
+    def test_operators_are_flattened(self):
+        tree, predicates = self.parse('A ~ "a" and B ~ "b" and C ~ "c"')
+        self.assertEqual(tree, (AND, (p(0), p(1), p(2))))
+        tree, predicates = self.parse('not not A ~ "a"')
+        self.assertEqual(tree, (NOT, (NOT, p(0))))
+
+    def test_keywords_are_case_insensitive(self):
+        tree, predicates = self.parse('NOT A ~ "a" AND B ~ "b" Or C ~ "c"')
+        self.assertEqual(tree, (OR, ((AND, ((NOT, p(0)), p(1))), p(2))))
+
+    def test_parentheses(self):
+        tree, predicates = self.parse('(A ~ "a" or B ~ "b") and C ~ "c"')
+        self.assertEqual(tree, (AND, ((OR, (p(0), p(1))), p(2))))
+        tree, predicates = self.parse('not (A ~ "a" or (B ~ "b"))')
+        self.assertEqual(tree, (NOT, (OR, (p(0), p(1)))))
+        self.assertEqual(predicates, [('A', 'a'), ('B', 'b')])
+
+    def test_quoted_regexps(self):
+        # Escaped double quotes are unescaped, other backslashes are kept.
+        tree, predicates = self.parse(r'VCL_Log ~ "\[say \"hi\"\]\d+"')
+        self.assertEqual(predicates, [('VCL_Log', r'\[say "hi"\]\d+')])
+        regexp = rules.parse(r'VCL_Log ~ "\[say \"hi\"\]\d+"')[1][0][1]
+        self.assertTrue(regexp.search('[say "hi"]42'))
+        self.assertFalse(regexp.search('[say hi]42'))
+
+        # Keywords & parentheses inside regexps are not tokens.
+        tree, predicates = self.parse(r'RxURL ~ "^/(and|or)" and not RxURL ~ "not \("')
+        self.assertEqual(tree, (AND, (p(0), (NOT, p(1)))))
+        self.assertEqual(predicates, [('RxURL', '^/(and|or)'), ('RxURL', r'not \(')])
+
+    def test_field_predicates(self):
+        tree, predicates = rules.parse(
+            'ReqEnd.total > 2.5 and not TxStatus.status in (301, 302)')
+        self.assertEqual(tree, (AND, (p(0), (NOT, p(1)))))
+        self.assertEqual([tag for tag, predicate in predicates], ['ReqEnd', 'TxStatus'])
+        self.assertTrue(predicates[0][1].search('1 1.0 4.0 0.0 0.0 0.0'))
+        self.assertFalse(predicates[0][1].search('1 1.0 2.0 0.0 0.0 0.0'))
+        self.assertTrue(predicates[1][1].search('302'))
+        self.assertFalse(predicates[1][1].search('303'))
+
+    def test_errors(self):
+        self.assertEqual(self.error(''), 'Unexpected end of rule expression.')
+        self.assertEqual(self.error('A ~ "a" and'), 'Unexpected end of rule expression.')
+        self.assertEqual(self.error('(A ~ "a"'), 'Missing ")" in rule expression.')
+        self.assertEqual(
+            self.error('A ~ "a")'),
+            'Unexpected ")" in rule expression "A ~ "a")".')
+        self.assertEqual(
+            self.error('A ~ "a" B ~ "b"'),
+            'Unexpected "B" in rule expression "A ~ "a" B ~ "b"".')
+        self.assertEqual(
+            self.error('and A ~ "a"'),
+            'Expected a predicate in rule expression, found "and".')
+        self.assertEqual(
+            self.error('A ~ a'),
+            'Expected \'Tag ~ "regexp"\' in rule expression, found "A".')
+        self.assertEqual(
+            self.error('A ~ "a" $ B ~ "b"'),
+            'Invalid rule expression "A ~ "a" $ B ~ "b"" at position 7.')
+        self.assertEqual(
+            self.error('A ~ "unterminated'),
+            'Invalid rule expression "A ~ "unterminated" at position 3.')
+        self.assertEqual(
+            self.error('Length.bytes in (1, 2'),
+            'Expected \'(number, ...)\' after "Length.bytes in" in rule expression.')
+        self.assertEqual(
+            self.error('Length.bytes ~ "1"'),
+            'Expected a comparison after "Length.bytes" in rule expression.')
+        self.assertEqual(
+            self.error('Length.nope > 1'),
+            '"nope" is not a valid field of tag Length (valid fields: bytes).')
+        self.assertRaises(re.error, rules.parse, 'A ~ "("')
+
+
+class EvaluationTestCase(unittest.TestCase):
+    def test_three_valued_logic(self):
+        tree = rules.parse('A ~ "a" and not B ~ "b"')[0]
+        # Unknown predicates leave the rule undecided, unless some other
+        # predicate decides it.
+        self.assertIsNone(rules.evaluate(tree, [None, None]))
+        self.assertIsNone(rules.evaluate(tree, [3, None]))
+        self.assertFalse(rules.evaluate(tree, [False, None]))
+        self.assertFalse(rules.evaluate(tree, [None, 5]))
+        self.assertTrue(rules.evaluate(tree, [3, False]))
+
+        # Unknown predicates are false once the tx is over.
+        self.assertTrue(rules.evaluate(tree, [3, None], final=True))
+        self.assertFalse(rules.evaluate(tree, [None, None], final=True))
+
+    def test_or(self):
+        tree = rules.parse('A ~ "a" or B ~ "b"')[0]
+        self.assertTrue(rules.evaluate(tree, [None, 0]))
+        self.assertIsNone(rules.evaluate(tree, [False, None]))
+        self.assertFalse(rules.evaluate(tree, [False, False]))
+
+    def test_offset(self):
+        tree = rules.parse('A ~ "a"')[0]
+        self.assertTrue(rules.evaluate(tree, [False, False, 4], offset=2))
+        self.assertFalse(rules.evaluate(tree, [4, 4, False], offset=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from varnishsentry.spool import Spool, SEGMENT_SUFFIX
+from varnishsentry.sender import Sender, build_client
+from tests.sentry import FakeSentry
+
+
+def event(i, level='error'):
+    return {
+        'message': 'GET /items/%d' % i,
+        'data': {
+            'timestamp': int(time.time()),
+            'logger': 'varnishsentry',
+            'level': level,
+            'tags': {},
+        },
+        'extra': {},
+    }
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def messages(self, items):
+        return [event['message'] for event, position in items]
+
+    def segments(self):
+        return sorted(
+            name for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX))
+
+    def test_cursor_persists_across_reopen(self):
+        spool = Spool(self.path)
+        for i in range(10):
+            spool.append(event(i))
+        items = spool.read(4)
+        self.assertEqual(self.messages(items), ['GET /items/%d' % i for i in range(4)])
+        spool.commit(items[-1][1])
+        spool.sync()
+        self.assertEqual(spool.backlog, 6)
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(spool.backlog, 6)
+        items = spool.read(100)
+        self.assertEqual(self.messages(items), ['GET /items/%d' % i for i in range(4, 10)])
+        spool.close()
+
+    def test_uncommitted_events_are_read_again_after_reopen(self):
+        spool = Spool(self.path)
+        for i in range(3):
+            spool.append(event(i))
+        self.assertEqual(len(spool.read(100)), 3)
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(spool.backlog, 3)
+        self.assertEqual(len(spool.read(100)), 3)
+        spool.close()
+
+    def test_oldest_segments_are_dropped_once_full(self):
+        spool = Spool(self.path, segment_size=1000, max_size=5000)
+        for i in range(500):
+            spool.append(event(i))
+        spool.sync()
+        self.assertGreater(spool.dropped, 0)
+        self.assertEqual(spool.dropped + spool.backlog, 500)
+        self.assertLessEqual(len(self.segments()), 6)
+
+        # Remaining events are the newest ones.
+        items = spool.read(1000)
+        self.assertEqual(len(items), spool.backlog)
+        self.assertEqual(items[-1][0]['message'], 'GET /items/499')
+        self.assertEqual(items[0][0]['message'], 'GET /items/%d' % spool.dropped)
+        spool.close()
+
+    def test_read_events_are_not_counted_as_dropped(self):
+        spool = Spool(self.path, segment_size=1000, max_size=5000)
+        for i in range(50):
+            spool.append(event(i))
+        read = len(spool.read(1000))
+        for i in range(50, 500):
+            spool.append(event(i))
+        self.assertEqual(spool.dropped + spool.backlog + read, 500)
+        spool.close()
+
+    def test_torn_trailing_records_are_skipped(self):
+        spool = Spool(self.path)
+        for i in range(5):
+            spool.append(event(i))
+        spool.close()
+
+        # Simulate a crash while writing some record.
+        with open(os.path.join(self.path, self.segments()[-1]), 'ab') as f:
+            f.write('\x10\x00\x00')
+
+        spool = Spool(self.path)
+        self.assertEqual(spool.backlog, 5)
+        items = spool.read(100)
+        self.assertEqual(self.messages(items), ['GET /items/%d' % i for i in range(5)])
+
+        # Writing goes on in a new segment.
+        spool.commit(items[-1][1])
+        spool.append(event(5))
+        self.assertEqual(self.messages(spool.read(100)), ['GET /items/5'])
+        spool.close()
+
+
+class SpoolSenderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = FakeSentry()
+        self.senders = []
+
+    def tearDown(self):
+        for sender in self.senders:
+            sender.stop(timeout=1.0)
+        self.server.stop()
+        shutil.rmtree(self.path)
+
+    def sender(self, **spool):
+        spool = dict(spool, enabled=True, path=self.path, fsync_interval=0.1)
+        sender = Sender(build_client({
+            'dsn': self.server.dsn,
+            'delivery': {'transport': {'retries': 0}},
+        }), {}, spool=spool)
+        self.senders.append(sender)
+        return sender
+
+    def wait(self, condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_failed_events_are_retried(self):
+        self.server.responses = [(503, {})]
+        sender = self.sender()
+        sender.start()
+        for i in range(10):
+            sender.put(event(i))
+        self.assertTrue(self.wait(lambda: sender.sent == 10))
+        self.assertEqual(sender.failed, 1)
+        self.assertEqual(sender.size, 0)
+        self.assertEqual(self.server.requests, 11)
+
+    def test_events_survive_outages(self):
+        sender = self.sender()
+        self.server.responses = [None]
+        sender.start()
+        for i in range(5):
+            sender.put(event(i))
+        self.assertTrue(self.wait(lambda: sender.failed >= 1))
+        sender.stop()
+
+        # Pending events are delivered after a restart.
+        sender = self.sender()
+        self.assertEqual(sender.size, 5)
+        sender.start()
+        self.assertTrue(self.wait(lambda: sender.sent == 5))
+        self.assertEqual(sender.size, 0)
+
+    def test_delivery_is_rate_limited(self):
+        # 10 events per second (and a burst of 10 events).
+        sender = self.sender(rate=10)
+        for i in range(25):
+            sender.put(event(i))
+        started = time.time()
+        sender.start()
+        self.assertTrue(self.wait(lambda: sender.sent == 25))
+        self.assertGreaterEqual(time.time() - started, 1.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import socket
+import httplib
+import unittest
+from raven.exceptions import APIError, RateLimited
+from varnishsentry.transport import KeepAliveHTTPTransport
+from tests.sentry import FakeSentry
+
+HEADERS = {'Content-Type': 'application/octet-stream'}
+
+
+class KeepAliveHTTPTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSentry()
+        self.url = 'http://127.0.0.1:%d/api/1/store/' % self.server.server_address[1]
+        self.transport = KeepAliveHTTPTransport(backoff=0.001, max_backoff=0.01)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connections_are_reused(self):
+        for i in range(10):
+            self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(self.server.requests, 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_batches_use_a_single_connection(self):
+        result = self.transport.send_batch(self.url, ['payload'] * 10, HEADERS)
+        self.assertEqual(result, [None] * 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_5xx_responses_are_retried(self):
+        self.server.responses = [(503, {}), (500, {})]
+        self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_5xx_responses_are_retried_up_to_some_limit(self):
+        self.server.responses = [(503, {'X-Sentry-Error': 'Busy'})] * 3
+        with self.assertRaises(APIError) as context:
+            self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(context.exception.code, 503)
+        self.assertEqual(context.exception.message, 'Busy')
+        self.assertEqual(self.server.requests, 3)
+
+    def test_4xx_responses_are_not_retried(self):
+        self.server.responses = [(400, {'X-Sentry-Error': 'Invalid'})]
+        self.assertRaises(APIError, self.transport.send, self.url, 'payload', HEADERS)
+        self.assertEqual(self.server.requests, 1)
+
+        # The connection is still reused.
+        self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_socket_errors_are_retried(self):
+        # The server drops the connection without responding, twice.
+        self.server.responses = [None, None]
+        self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_socket_errors_are_retried_up_to_some_limit(self):
+        self.server.responses = [None] * 3
+        self.assertRaises(
+            (httplib.HTTPException, socket.error),
+            self.transport.send, self.url, 'payload', HEADERS)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_refused_connections_are_retried(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/api/1/store/' % listener.getsockname()[1]
+        listener.close()
+        attempts = []
+        acquire = self.transport._acquire
+        self.transport._acquire = lambda url: attempts.append(url) or acquire(url)
+        self.assertRaises(socket.error, self.transport.send, url, 'payload', HEADERS)
+        self.assertEqual(len(attempts), 3)
+
+    def test_rate_limits_are_not_retried(self):
+        self.server.responses = [(429, {'Retry-After': '7'})]
+        with self.assertRaises(RateLimited) as context:
+            self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(context.exception.retry_after, 7)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_rate_limits_without_retry_after(self):
+        self.server.responses = [(429, {})]
+        with self.assertRaises(RateLimited) as context:
+            self.transport.send(self.url, 'payload', HEADERS)
+        self.assertEqual(context.exception.retry_after, 0)
+
+    def test_rate_limits_stop_batches(self):
+        self.server.responses = [(200, {}), (429, {'Retry-After': '1'})]
+        result = self.transport.send_batch(self.url, ['payload'] * 4, HEADERS)
+        self.assertIsNone(result[0])
+        self.assertIsInstance(result[1], RateLimited)
+        self.assertIs(result[2], result[1])
+        self.assertIs(result[3], result[1])
+        self.assertEqual(self.server.requests, 2)
+
+    def test_failures_stop_batches_if_required(self):
+        self.server.responses = [(400, {})]
+        result = self.transport.send_batch(self.url, ['payload'] * 3, HEADERS)
+        self.assertIsInstance(result[0], APIError)
+        self.assertEqual(result[1:], [None, None])
+
+        self.server.responses = [(400, {})]
+        result = self.transport.send_batch(self.url, ['payload'] * 3, HEADERS, stop=True)
+        self.assertEqual(len(set(map(id, result))), 1)
+        self.assertEqual(self.server.requests, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+import copy
+from collections import OrderedDict
+
+DEFAULT_WINDOW = 60
+
+DEFAULT_SAMPLES = 3
+
+DEFAULT_MAX_KEYS = 10000
+
+DEFAULT_FINGERPRINT = ('filter', 'type', 'message')
+
+FINGERPRINT_FIELDS = ('worker', 'filter', 'type', 'level', 'message')
+
+# Variable parts of messages (UUIDs, hexadecimal IDs & numbers), replaced when
+# building fingerprints.
+NORMALIZATIONS = (
+    (re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'), '<uuid>'),
+    (re.compile(r'\b(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{12,}\b'), '<hex>'),
+    (re.compile(r'\d+'), '<n>'),
+)
+
+
+class Aggregator(object):
+    # Groups events sharing the same fingerprint during a time window. The
+    # first event of a window is emitted right away, so aggregation never
+    # delays alerts. Once the window is over, if more events were grouped, a
+    # summary is emitted: a copy of the first event including the number of
+    # occurrences and the items of a few other sample txs. Windows are kept
+    # in creation order, so expired windows are always found at the head.
+    # When too many windows are open, the oldest one is closed early.
+
+    def __init__(self, config):
+        self._window = config.get('window', DEFAULT_WINDOW)
+        self._samples = config.get('samples', DEFAULT_SAMPLES)
+        self._max_keys = config.get('max_keys', DEFAULT_MAX_KEYS)
+        self._fingerprint = tuple(config.get('fingerprint', DEFAULT_FINGERPRINT))
+        self._windows = OrderedDict()
+        self.aggregated = 0
+
+        # Check fingerprint.
+        for field in self._fingerprint:
+            assert \
+                field in FINGERPRINT_FIELDS, \
+                '"%s" is not a valid fingerprint field.' % field
+
+    def add(self, event, now):
+        # Add an event, returning the list of events to be delivered right
+        # now (i.e. the first event of a new window, and summaries of windows
+        # closed early).
+        key = self._get_fingerprint(event)
+        window = self._windows.get(key)
+        if window is not None:
+            window[1] += 1
+            if len(window[3]) < self._samples:
+                window[3].append(event['extra']['items'])
+            self.aggregated += 1
+            return []
+        result = [event]
+        if len(self._windows) >= self._max_keys:
+            summary = self._close(self._windows.popitem(last=False)[1])
+            if summary is not None:
+                result.append(summary)
+        self._windows[key] = [now, 1, event, []]
+        return result
+
+    def flush(self, now, force=False):
+        # Close expired windows (or all of them), returning the summaries to
+        # be delivered.
+        result = []
+        while self._windows:
+            key, window = next(self._windows.iteritems())
+            if not force and now - window[0] < self._window:
+                break
+            del self._windows[key]
+            summary = self._close(window)
+            if summary is not None:
+                result.append(summary)
+        return result
+
+    def _close(self, window):
+        # Summary of a window (None if nothing was grouped, given that the
+        # first event was already emitted).
+        start, count, event, samples = window
+        if count == 1:
+            return None
+        result = copy.copy(event)
+        result['extra'] = dict(
+            event['extra'],
+            occurrences=count,
+            window=self._window,
+            samples=samples)
+        return result
+
+    def _get_fingerprint(self, event):
+        result = []
+        for field in self._fingerprint:
+            if field == 'message':
+                message = event['message']
+                for regexp, replacement in NORMALIZATIONS:
+                    message = regexp.sub(replacement, message)
+                result.append(message)
+            elif field == 'level':
+                result.append(event['data']['level'])
+            else:
+                result.append(event['data']['tags'][field])
+        return tuple(result)
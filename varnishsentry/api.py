@@ -5,7 +5,10 @@ Connect to libvarnishapi using the Python ctypes wrapper by Shohei Tanaka:
 
 	- https://github.com/xcir/python-varnishapi
 
-Current file is an unmodified copy from commit a6073cf4b0.
+Current file is a copy from commit a6073cf4b0, extended with a raw callback
+type that hands the record payload over as an untouched pointer, with
+dispatching helpers accepting prebuilt (i.e. long-lived) callback objects, and
+with a tags-only wrapper that does not open the shared memory log.
 
 '''
 
@@ -15,6 +18,10 @@ import ctypes,getopt
 
 VSL_handler_f = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_char_p, ctypes.c_ulonglong)
 
+# Same as VSL_handler_f, but the payload is not copied into a Python string.
+# Use ctypes.string_at(ptr, length) to fetch it when needed.
+VSL_raw_handler_f = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p, ctypes.c_ulonglong)
+
 class VSLUtil:
 
 	def tag2VarName(self, spec, tag):
@@ -192,6 +199,23 @@ class VSLUtil:
 		},
 	}
 
+class VarnishTags:
+
+	def __init__(self, sopath = 'libvarnishapi.so.1'):
+		self.lib      = ctypes.cdll[sopath]
+		VSLTAGS       = ctypes.c_char_p * 256
+		self.VSL_tags = VSLTAGS.in_dll(self.lib, "VSL_tags")
+
+	def VSL_Name2Tag(self, name):
+		return self.lib.VSL_Name2Tag(name, ctypes.c_int(-1))
+
+	def VSL_NameNormalize(self,name):
+		r = self.VSL_Name2Tag(name)
+		if r >= 0:
+			return self.VSL_tags[r]
+
+		return ''
+
 class VarnishAPI:
 
 	def __init__(self,opt = '',sopath = 'libvarnishapi.so.1'):
@@ -223,6 +247,17 @@ class VarnishAPI:
 			self.lib.VSL_Dispatch(self.vd, cb_func, self.vd)
 
 
+	def VSL_NonBlocking(self, nb = 1):
+		return self.lib.VSL_NonBlocking(self.vd, nb)
+
+
+	def VSL_DispatchHandler(self, cb_func, priv = False):
+		if priv:
+			return self.lib.VSL_Dispatch(self.vd, cb_func, priv)
+		else:
+			return self.lib.VSL_Dispatch(self.vd, cb_func, self.vd)
+
+
 	def VSL_NonBlockingDispatch(self, func, priv = False):
 		cb_func = VSL_handler_f(func)
 		self.lib.VSL_NonBlocking(self.vd, 1)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+import sys
+import time
+import ctypes
+import resource
+import multiprocessing
+from varnishsentry.bench.fake import FakeVarnishAPI
+from varnishsentry.bench.generator import Generator
+from varnishsentry.consumer import MIN_IDLE_BACKOFF, TRANSACTIONS, Consumer
+from varnishsentry.ring import DEFAULT_SIZE as DEFAULT_RING_SIZE, Ring
+from varnishsentry.shard import Shard, Splitter
+
+# Worker used when benchmarking: filters similar to the sample configuration,
+# plus a header filter (i.e. a frequent tag).
+DEFAULT_WORKERS = {
+    'bench': {
+        'filters': {
+            'VCL_Log': [
+                {
+                    'regexp': r'^\[WTF\].*',
+                    'name': 'wtf',
+                    'level': 'warning',
+                },
+            ],
+            'TxStatus': [
+                {
+                    'regexp': r'^5\d\d$',
+                    'name': '5xx',
+                    'level': 'error',
+                },
+            ],
+            'RxHeader': [
+                {
+                    'header': 'X-Debug',
+                    'name': 'debug',
+                    'level': 'info',
+                },
+            ],
+        },
+    },
+}
+
+
+class BenchConsumer(Consumer):
+    # Consumer fed by a fake VarnishAPI. Matched txs are just counted, and
+    # the whole set of records is dispatched synchronously.
+
+    def _get_workers(self):
+        return self._config['workers']
+
+    def _connect(self):
+        return FakeVarnishAPI(
+            opt=self._get_vap_options(
+                None if self._full_context else self._get_tags()),
+            records=self._config['records'])
+
+    def _init_delivery(self):
+        self._senders = {}
+        self._events = 0
+
+    def _deliver(self, worker, event):
+        self._events += 1
+
+    def _loop(self):
+        self._consuming = True
+        self._vap.VSL_NonBlocking(1)
+        while self._vap.VSL_DispatchHandler(self._handler, priv=False):
+            pass
+
+        # Purge all pending txs.
+        started = time.time()
+        self._purge_buffers(sys.maxint)
+        self._purge_time = time.time() - started
+        self._consuming = False
+
+    def bench(self):
+        started = time.time()
+        self._init()
+        self._thread.join()
+        elapsed = time.time() - started
+        latencies = sorted(self._vap.latencies)
+        records = len(self._config['records'][0])
+        return {
+            'records': records,
+            'dispatched': len(latencies),
+            'seconds': elapsed,
+            'records_per_sec': records / elapsed,
+            'p50_callback_usec': _percentile(latencies, 0.50) * 1e6,
+            'p99_callback_usec': _percentile(latencies, 0.99) * 1e6,
+            'purge_usec': self._purge_time * 1e6,
+            'transactions': sum(self._opened.itervalues()),
+            'events': self._events,
+        }
+
+
+class BaselineConsumer(BenchConsumer):
+    # Per record dispatch used before the dispatch table (see Consumer._init())
+    # was introduced, kept as a baseline: all tags are read, every record is
+    # normalized into a dict (tag name & a copy of its payload), and tag names
+    # are checked against the delimiters & filters of its tx type. Matched
+    # txs are just counted.
+
+    def _connect(self):
+        return FakeVarnishAPI(
+            opt=self._get_vap_options(None),
+            records=self._config['records'])
+
+    def _loop(self):
+        self._delimiters = dict(
+            (type, {'start': item['start'], 'end': item['end']})
+            for type, item in TRANSACTIONS.iteritems())
+        self._tag_filters = {}
+        for config in self._workers.itervalues():
+            for tag, filters in config.get('filters', {}).iteritems():
+                for filter in filters:
+                    if 'header' in filter:
+                        regexp = re.compile('(?i)^%s:' % re.escape(filter['header']))
+                    else:
+                        regexp = re.compile(filter['regexp'])
+                    self._tag_filters.setdefault(tag, []).append((regexp, filter['name']))
+        self._txs = dict((type, {}) for type in TRANSACTIONS)
+        BenchConsumer._loop(self)
+
+    def _vap_callBack(self, priv, tag, fd, length, spec, ptr, bm):
+        now = int(time.time())
+        item = {
+            'fd': fd,
+            'type': spec,
+            'typeName': 'c' if spec == 1 else 'b' if spec == 2 else '-',
+            'tag': self._tags[tag],
+            'msg': ctypes.string_at(ptr, length),
+        }
+        if item['type'] in self._types:
+            if item['tag'] in self._delimiters[item['type']]['start']:
+                self._txs[item['type']][fd] = (now, [], [])
+                self._opened[item['type']] += 1
+            tx = self._txs[item['type']].get(fd)
+            if tx is not None:
+                tx[1].append((item['tag'], item['msg']))
+                for regexp, name in self._tag_filters.get(item['tag'], ()):
+                    if regexp.search(item['msg']):
+                        tx[2].append((item['tag'], item['msg'], name))
+                if item['tag'] in self._delimiters[item['type']]['end']:
+                    del self._txs[item['type']][fd]
+                    if tx[2]:
+                        self._events += 1
+
+    def _purge_buffers(self, now):
+        for txs in self._txs.itervalues():
+            for fd, tx in txs.items():
+                if now - tx[0] >= self._timeout:
+                    del txs[fd]
+                    if tx[2]:
+                        self._events += 1
+
+
+class WaitingRing(Ring):
+    # Ring buffer whose producer waits for room instead of dropping records,
+    # so benchmarks measure the sustained throughput of the whole pipeline.
+
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        Ring.__init__(self, size)
+        self.waits = 0
+
+    def put(self, spec, tag, fd, ptr, length):
+        while not Ring.put(self, spec, tag, fd, ptr, length):
+            self.waits += 1
+            time.sleep(MIN_IDLE_BACKOFF)
+        return True
+
+
+class BenchSplitter(Splitter):
+    # Splitter fed by a fake VarnishAPI. Once all records have been
+    # forwarded, shards are told so.
+
+    def _connect(self):
+        return FakeVarnishAPI(
+            opt=self._get_vap_options(
+                None if self._full_context else self._get_tags()),
+            records=self._config['records'])
+
+    def _loop(self):
+        self._consuming = True
+        self._vap.VSL_NonBlocking(1)
+        while self._vap.VSL_DispatchHandler(self._handler, priv=False):
+            pass
+        self._consuming = False
+        self._config['done'].set()
+
+
+class BenchShard(Shard):
+    # Shard whose matched txs are just counted. It stops once the splitter
+    # is done and its ring buffer is empty, purging all pending txs.
+
+    def _connect(self):
+        return FakeVarnishAPI()
+
+    def _init_delivery(self):
+        self._senders = {}
+        self._events = 0
+
+    def _deliver(self, worker, event):
+        self._events += 1
+
+    def _loop(self):
+        self._consuming = True
+        ring = self._config['ring']
+        while True:
+            done = self._config['done'].is_set()
+            if ring.consume(self._vap_callBack) == 0:
+                if done:
+                    break
+                time.sleep(MIN_IDLE_BACKOFF)
+        self._purge_buffers(sys.maxint)
+        self._consuming = False
+
+
+def run(workers=None, full_context=False, baseline=False, **options):
+    # Build records (not included in measurements).
+    generator = Generator(**options)
+    records, buffer = generator.build()
+    baseline_rss = _rss(peak=False)
+
+    # Run the benchmark.
+    consumer = (BaselineConsumer if baseline else BenchConsumer)(
+        None, None, None, 'bench',
+        {
+            'workers': dict(
+                (name, dict(config, full_context=full_context))
+                for name, config in (workers or DEFAULT_WORKERS).iteritems()),
+            'records': records,
+        },
+        False)
+    result = consumer.bench()
+
+    # Done!
+    result.update({
+        'options': dict(options, full_context=full_context, baseline=baseline),
+        'baseline_rss_kb': baseline_rss,
+        'peak_rss_kb': _rss(),
+        'python': sys.version.split()[0],
+    })
+    return result
+
+
+def run_shards(shards, workers=None, full_context=False, ring_size=DEFAULT_RING_SIZE,
+               **options):
+    # Build records (not included in measurements).
+    generator = Generator(**options)
+    records, buffer = generator.build()
+    workers = dict(
+        (name, dict(config, full_context=full_context))
+        for name, config in (workers or DEFAULT_WORKERS).iteritems())
+
+    # Run the benchmark for each number of shards: a splitter (in this
+    # process) forwarding records to that many shard processes. Besides the
+    # overall throughput, CPU time of the splitter & each shard is reported:
+    # with enough cores, throughput is bounded by the splitter and by the
+    # slowest shard.
+    result = []
+    for count in shards:
+        done = multiprocessing.Event()
+        rings = [WaitingRing(ring_size) for i in range(count)]
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_run_shard,
+                args=({'workers': workers, 'ring': ring, 'done': done}, results))
+            for ring in rings]
+        for process in processes:
+            process.start()
+        for process in processes:
+            assert results.get() == 'ready'
+
+        splitter = BenchSplitter(
+            None, None, None, 'bench',
+            {'workers': workers, 'records': records, 'rings': rings, 'done': done},
+            False)
+        started = time.time()
+        cpu = _cpu()
+        splitter._init()
+        splitter._thread.join()
+        splitter_cpu = _cpu() - cpu
+        reports = [results.get() for process in processes]
+        elapsed = time.time() - started
+        for process in processes:
+            process.join()
+
+        total = len(records[0])
+        result.append({
+            'shards': count,
+            'records': total,
+            'forwarded': sum(report['records'] for report in reports),
+            'seconds': elapsed,
+            'records_per_sec': total / elapsed,
+            'splitter_cpu_seconds': splitter_cpu,
+            'splitter_records_per_cpu_sec': total / max(splitter_cpu, 1e-6),
+            'shard_cpu_seconds': [report['cpu_seconds'] for report in reports],
+            'ring_waits': sum(ring.waits for ring in rings),
+            'transactions': sum(report['transactions'] for report in reports),
+            'events': sum(report['events'] for report in reports),
+        })
+
+    # Done!
+    return {
+        'options': dict(options, full_context=full_context, ring_size=ring_size),
+        'cpus': multiprocessing.cpu_count(),
+        'python': sys.version.split()[0],
+        'results': result,
+    }
+
+
+def _run_shard(config, results):
+    shard = BenchShard(None, None, None, 'bench', config, False)
+    cpu = _cpu()
+    shard._init()
+    results.put('ready')
+    shard._thread.join()
+    results.put({
+        'records': shard._records,
+        'transactions': sum(shard._opened.itervalues()),
+        'events': shard._events,
+        'cpu_seconds': _cpu() - cpu,
+    })
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _percentile(values, percentile):
+    if values:
+        return values[min(int(len(values) * percentile), len(values) - 1)]
+    return 0.0
+
+
+def _rss(peak=True):
+    # Current RSS is only available on Linux.
+    if not peak:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * resource.getpagesize() / 1024
+        except IOError:
+            pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import time
+import array
+import getopt
+from varnishsentry.replay import LogTags
+
+DISPATCH_BATCH = 1024
+
+
+class FakeVarnishAPI(LogTags):
+    # Drop-in replacement of api.VarnishAPI feeding pre-built raw records
+    # (see Generator.build()) instead of reading the shared memory log. The
+    # -c, -b & -i options are honored just as libvarnishapi does. Callback
+    # latencies are recorded.
+
+    def __init__(self, opt='', sopath=None, records=((), (), (), (), ())):
+        LogTags.__init__(self)
+        self._records = records
+        self._position = 0
+        self._client = False
+        self._backend = False
+        self._selected = None
+        self.latencies = array.array('d')
+        if opt:
+            opts, args = getopt.getopt(opt, 'bCcdI:i:k:n:r:s:X:x:m:')
+            for option, value in opts:
+                if option == '-c':
+                    self._client = True
+                elif option == '-b':
+                    self._backend = True
+                elif option == '-i':
+                    self._selected = set(
+                        self.VSL_Name2Tag(tag) for tag in value.split(','))
+
+    def VSL_NonBlocking(self, nb=1):
+        return 0
+
+    def VSL_DispatchHandler(self, cb_func, priv=False):
+        # Feed the next batch of records. Returns 0 when no records are left.
+        tags, fds, lengths, specs, pointers = self._records
+        end = min(self._position + DISPATCH_BATCH, len(tags))
+        latencies = self.latencies
+        clock = time.time
+        for index in xrange(self._position, end):
+            tag = tags[index]
+            spec = specs[index]
+            if (self._selected is None or tag in self._selected) and \
+               ((not self._client and not self._backend) or
+                (self._client and spec & 1) or
+                (self._backend and spec & 2)):
+                started = clock()
+                result = cb_func(
+                    priv, tag, fds[index], lengths[index], spec, pointers[index], 0)
+                latencies.append(clock() - started)
+                if result:
+                    self._position = index + 1
+                    return 1
+        self._position = end
+        return 1 if end < len(tags) else 0
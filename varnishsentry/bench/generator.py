@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import random
+import array
+import ctypes
+from varnishsentry.replay import DEFAULT_TAGS
+
+DEFAULT_SEED = 42
+
+DEFAULT_TRANSACTIONS = 10000
+
+DEFAULT_BACKEND_RATIO = 0.3
+
+DEFAULT_HEADERS = 12
+
+DEFAULT_CONCURRENCY = 32
+
+DEFAULT_MATCH_RATE = 0.01
+
+# Client & backend specs, as reported by libvarnishapi.
+CLIENT = 1
+
+BACKEND = 2
+
+
+class Generator(object):
+    # Deterministic synthetic VSL record generator: the same settings always
+    # produce the same records. Several txs are in flight at the same time
+    # (each one using its own fd), and their records are randomly
+    # interleaved. Matching client txs include a 5xx status & a VCL_Log
+    # '[WTF]' item.
+
+    def __init__(self, seed=DEFAULT_SEED, transactions=DEFAULT_TRANSACTIONS,
+                 backend_ratio=DEFAULT_BACKEND_RATIO, headers=DEFAULT_HEADERS,
+                 concurrency=DEFAULT_CONCURRENCY, match_rate=DEFAULT_MATCH_RATE):
+        self._random = random.Random(seed)
+        self._transactions = transactions
+        self._backend_ratio = backend_ratio
+        self._headers = headers
+        self._concurrency = concurrency
+        self._match_rate = match_rate
+        self._xid = 1000
+
+    def records(self):
+        # Yields (tag name, fd, spec, message) tuples.
+        pending = self._transactions
+        fds = range(self._concurrency + 10, 10, -1)
+        running = []
+        while pending > 0 or running:
+            # Start new txs while below the concurrency level.
+            while pending > 0 and len(running) < self._concurrency:
+                fd = fds.pop()
+                running.append((fd, iter(self._transaction(fd))))
+                pending -= 1
+
+            # Emit the next record of some running tx.
+            index = self._random.randrange(len(running))
+            fd, items = running[index]
+            try:
+                yield next(items)
+            except StopIteration:
+                running[index] = running[-1]
+                running.pop()
+                fds.append(fd)
+
+    def build(self):
+        # Build raw records, as expected by VSL callbacks, using compact
+        # parallel arrays: integer tags, fds, lengths, specs & pointers.
+        # Returns the arrays and the buffer holding all payloads (keep a
+        # reference to it while using the records).
+        ids = dict((tag, id) for id, tag in enumerate(DEFAULT_TAGS))
+        tags = array.array('B')
+        fds = array.array('I')
+        lengths = array.array('I')
+        specs = array.array('B')
+        pointers = array.array('L')
+        chunks = []
+        offset = 0
+        for tag, fd, spec, message in self.records():
+            tags.append(ids[tag])
+            fds.append(fd)
+            lengths.append(len(message))
+            specs.append(spec)
+            pointers.append(offset)
+            chunks.append(message)
+            offset += len(message)
+        buffer = ctypes.create_string_buffer(''.join(chunks), offset)
+        del chunks
+        address = ctypes.addressof(buffer)
+        for index in xrange(len(pointers)):
+            pointers[index] += address
+        return (tags, fds, lengths, specs, pointers), buffer
+
+    def _transaction(self, fd):
+        self._xid += 1
+        if self._random.random() < self._backend_ratio:
+            return self._backend(fd, self._xid)
+        else:
+            return self._client(fd, self._xid, self._random.random() < self._match_rate)
+
+    def _client(self, fd, xid, matched):
+        url = '/api/items/%d' % self._random.randint(1, 100000)
+        yield ('SessionOpen', fd, CLIENT, '10.0.0.%d %d :80' % (fd % 250, 40000 + fd))
+        yield ('ReqStart', fd, CLIENT, '10.0.0.%d %d %d' % (fd % 250, 40000 + fd, xid))
+        yield ('RxRequest', fd, CLIENT, 'GET')
+        yield ('RxURL', fd, CLIENT, url)
+        yield ('RxProtocol', fd, CLIENT, 'HTTP/1.1')
+        for i in range(self._headers):
+            yield ('RxHeader', fd, CLIENT, 'X-Header-%d: value %d' % (i, xid))
+        yield ('VCL_call', fd, CLIENT, 'recv lookup')
+        yield ('Hash', fd, CLIENT, url)
+        yield ('VCL_call', fd, CLIENT, 'hash hash')
+        if matched:
+            yield ('VCL_Log', fd, CLIENT, '[WTF] unexpected backend response')
+            yield ('VCL_call', fd, CLIENT, 'error deliver')
+            yield ('TxProtocol', fd, CLIENT, 'HTTP/1.1')
+            yield ('TxStatus', fd, CLIENT, '503')
+            yield ('TxResponse', fd, CLIENT, 'Service Unavailable')
+        else:
+            yield ('Hit', fd, CLIENT, str(xid - 1))
+            yield ('VCL_call', fd, CLIENT, 'hit deliver')
+            yield ('TxProtocol', fd, CLIENT, 'HTTP/1.1')
+            yield ('TxStatus', fd, CLIENT, '200')
+            yield ('TxResponse', fd, CLIENT, 'OK')
+        for i in range(self._headers):
+            yield ('TxHeader', fd, CLIENT, 'X-Out-%d: value' % i)
+        yield ('Length', fd, CLIENT, '512')
+        yield ('ReqEnd', fd, CLIENT, '%d 1404729600.0 1404729600.1 0.0 0.0 0.1' % xid)
+        yield ('SessionClose', fd, CLIENT, 'EOF')
+        yield ('StatSess', fd, CLIENT, '10.0.0.%d %d 0 1 1 0 0 0 512 0' % (fd % 250, 40000 + fd))
+
+    def _backend(self, fd, xid):
+        yield ('BackendOpen', fd, BACKEND, 'default 10.0.1.1 %d 10.0.1.2 80' % (50000 + fd))
+        yield ('BackendXID', fd, BACKEND, str(xid))
+        yield ('TxRequest', fd, BACKEND, 'GET')
+        yield ('TxURL', fd, BACKEND, '/api/items/%d' % self._random.randint(1, 100000))
+        yield ('TxProtocol', fd, BACKEND, 'HTTP/1.1')
+        for i in range(self._headers):
+            yield ('TxHeader', fd, BACKEND, 'X-Header-%d: value %d' % (i, xid))
+        yield ('RxProtocol', fd, BACKEND, 'HTTP/1.1')
+        yield ('RxStatus', fd, BACKEND, '200')
+        yield ('RxResponse', fd, BACKEND, 'OK')
+        for i in range(self._headers):
+            yield ('RxHeader', fd, BACKEND, 'X-In-%d: value' % i)
+        yield ('Length', fd, BACKEND, '512')
+        yield ('BackendClose', fd, BACKEND, 'default')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+import time
+import ctypes
+from varnishsentry import api
+from varnishsentry import fields
+from varnishsentry import rules
+from varnishsentry.matcher import Header, backtracking_risks
+from varnishsentry.replay import LogFile, LogTags
+
+DEFAULT_LIMIT = 100000
+
+# Evaluations slower than this (in seconds) are reported.
+SLOW_EVALUATION = 0.001
+
+# Evaluations beyond the previous threshold are repeated this number of times,
+# and judged by their median, so GC pauses, scheduling hiccups, etc. are not
+# reported.
+SLOW_EVALUATION_RUNS = 5
+
+
+def check(workers, files=(), limit=DEFAULT_LIMIT):
+    # Check all filters & rule predicates of some workers: static detection
+    # of regexps prone to catastrophic backtracking, and timing against a
+    # corpus of messages extracted from 'varnishlog -w' files (up to some
+    # limit of messages per tag). Returns a list of reports, one per filter
+    # or rule predicate.
+    tags = _get_tags(workers)
+    checks = _get_checks(workers, tags)
+
+    # Load corpus.
+    corpus = dict((tag, []) for tag, items in checks)
+    if files and corpus:
+        def callback(priv, tag, fd, length, spec, ptr, bm):
+            messages = corpus.get(tags.VSL_tags[tag])
+            if messages is not None and len(messages) < limit:
+                messages.append(ctypes.string_at(ptr, length))
+
+        for path in files:
+            LogFile(path, tags.VSL_tags).dispatch(callback)
+
+    # Check filters & rule predicates.
+    result = []
+    for tag, items in checks:
+        messages = corpus[tag]
+        for worker, name, regexp, description, risks in items:
+            report = {
+                'worker': worker,
+                'tag': tag,
+                'name': name,
+                'regexp': description,
+                'risks': risks,
+                'evaluations': len(messages),
+                'matches': 0,
+                'seconds': 0.0,
+                'slowest': 0.0,
+            }
+            for message in messages:
+                started = time.time()
+                matched = regexp.search(message) is not None
+                elapsed = time.time() - started
+                report['matches'] += matched
+                report['seconds'] += elapsed
+                if elapsed >= SLOW_EVALUATION:
+                    elapsed = _confirm(regexp, message, elapsed)
+                report['slowest'] = max(report['slowest'], elapsed)
+            report['slow'] = report['slowest'] >= SLOW_EVALUATION
+            result.append(report)
+
+    # Done!
+    return result
+
+
+def _confirm(regexp, message, elapsed):
+    # Median time of several evaluations of some message (including an
+    # already timed one).
+    timings = [elapsed]
+    for i in range(SLOW_EVALUATION_RUNS - 1):
+        started = time.time()
+        regexp.search(message)
+        timings.append(time.time() - started)
+    return sorted(timings)[len(timings) // 2]
+
+
+def _get_checks(workers, tags):
+    # List of (normalized tag, [(worker, name, regexp, description, risks),
+    # ...]) pairs: filters, and predicates of rules (named after the rule).
+    result = {}
+    for worker, config in sorted(workers.iteritems()):
+        for tag, items in config.get('filters', {}).iteritems():
+            tag = tags.VSL_NameNormalize(tag) or tag
+            for filter in items:
+                result.setdefault(tag, []).append(
+                    (worker, filter.get('name', tag)) + _build_filter(tag, filter))
+        for rule in config.get('rules', []):
+            for tag, regexp in rules.parse(rule['expression'])[1]:
+                tag = tags.VSL_NameNormalize(tag) or tag
+                if isinstance(regexp, fields.Predicate):
+                    description, risks = regexp.description, []
+                else:
+                    description, risks = regexp.pattern, backtracking_risks(regexp)
+                result.setdefault(tag, []).append((
+                    worker, rule.get('name', rule['expression']),
+                    regexp, description, risks))
+    return sorted(result.iteritems())
+
+
+def _build_filter(tag, filter):
+    # Matching object, description & backtracking risks of some filter.
+    if 'header' in filter:
+        regexp = Header(
+            filter['header'],
+            re.compile(filter['regexp']) if 'regexp' in filter else None)
+        return regexp, regexp.description, \
+            backtracking_risks(regexp.regexp) if 'regexp' in filter else []
+    elif 'regexp' in filter:
+        regexp = re.compile(filter['regexp'])
+        return regexp, filter['regexp'], backtracking_risks(regexp)
+    else:
+        regexp = fields.build(tag, filter)
+        return regexp, regexp.description, []
+
+
+def _get_tags(workers):
+    for config in workers.itervalues():
+        if 'libvarnishapi' in config:
+            return api.VarnishTags(sopath=config['libvarnishapi'])
+    try:
+        return api.VarnishTags()
+    except OSError:
+        return LogTags()
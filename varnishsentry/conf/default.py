@@ -16,6 +16,59 @@ from __future__ import absolute_import
 
 PIDFILE = '/var/run/varnishsentry.pid'
 
+# Optional: by default each worker reads and parses the whole shared memory log
+# on its own. When enabled, a single reader process per Varnish instance (i.e.
+# per '-n' option) assembles txs once and matches them against the filters of
+# all workers using that instance. Matched txs are then delivered by a
+# separate process per worker, still honoring its DSN, user & group. The reader
+# processes can run using some specific UID & GID too. Readers queue matched
+# events per level, and shed them (lowest levels first) using the 'delivery'
+# settings of each worker before handing them over to its delivery process.
+#
+# Tx assembly & matching can be spread across several CPU cores setting a
+# number of shards. Then readers just forward records (through shared memory
+# ring buffers of 'ring_size' bytes) to that many matcher processes, selecting
+# them by fd so all records of a tx are handled by the same shard. Note the
+# reader still handles every record, so throughput is bounded by it ('bench
+# --shards' reports how CPU time splits between reader & shards). Defaults
+# to no sharding and 8 MB ring buffers.
+SHARED_READER = {
+    'enabled': False,
+    #'user': 'varnishlog',
+    #'group': 'varnish',
+    #'shards': 4,
+    #'ring_size': 8 * 1024 * 1024,
+}
+
+# Optional: workers periodically publish metrics (records per tag, opened,
+# committed, timed out & evicted txs, filter matches, delivered, failed &
+# dropped events, VSL callback latency histograms, etc.) to the master process,
+# which exposes them using the Prometheus text format. Metrics can be written
+# to a file (e.g. to be picked by the node exporter textfile collector) and /
+# or served through a local UNIX socket (e.g. 'socat - UNIX:/path/to/socket').
+# Samples are labeled with the publishing process ('process') and the worker
+# they refer to ('worker'; shared readers publish samples of several workers).
+# Defaults to disabled and 10 seconds intervals.
+METRICS = {
+    'enabled': False,
+    #'interval': 10,
+    #'path': '/var/lib/varnishsentry/metrics.prom',
+    #'socket': '/var/run/varnishsentry.metrics.sock',
+}
+
+# Optional: sending a SIGUSR1 signal to the master process (or to some worker
+# process) launches a sampling profiler in every worker (or in that worker).
+# Stacks are sampled every 'interval' seconds during 'duration' seconds and
+# written to '<path>.folded' (collapsed stacks, ready for flamegraph.pl). Top
+# allocations (when tracemalloc is available) or top object types are written
+# to '<path>.allocations'. Path must be writable by the worker processes.
+# Defaults to 30 seconds, 10 ms & '/tmp/varnishsentry.<worker>.<pid>.<ts>'.
+PROFILING = {
+    #'duration': 30,
+    #'interval': 0.01,
+    #'path': '/tmp/varnishsentry.%(worker)s.%(pid)d.%(timestamp)d',
+}
+
 ###############################################################################
 ## WORKERS.
 ###############################################################################
@@ -38,6 +91,33 @@ WORKERS = {
         #     and 'debug') value, used as when delivering a matching transaction
         #     to Sentry. Defaults to 'error'.
         #
+        #   - A sample rate (between 0 and 1), used to randomly select which
+        #     matching transactions are submitted. Transactions no filter
+        #     would accept are not even buffered. Defaults to 1.
+        #
+        #   - A rate limit (matching transactions per second) and a burst
+        #     value (defaults to the rate), enforced using a token bucket.
+        #     Defaults to no limit.
+        #
+        #   Instead of a regular expression, filters on tags with typed fields
+        #   may include a field name and some numeric conditions ('gt', 'ge',
+        #   'lt', 'le', 'eq', 'ne' and 'in', all of them must hold). Messages
+        #   of those tags are split into fields once, and only if some field
+        #   filter exists. Supported fields: ReqEnd ('xid', 'start', 'end',
+        #   'accept', 'process', 'deliver' and 'total', in seconds), Length
+        #   ('bytes'), and TxStatus, RxStatus & ObjStatus ('status').
+        #
+        #   Filters on header tags (RxHeader, TxHeader & ObjHeader) may include
+        #   a header name (case insensitive). Then the regular expression, if
+        #   any, is matched against the header value (leading whitespace
+        #   excluded), and only for records of that header. These filters are
+        #   indexed by header name, so records of other headers are rejected
+        #   with a single lookup, no matter how many header filters exist.
+        #
+        #   Submitted transactions include the effective rate of the main
+        #   matching filter (i.e. sample rate x ratio of accepted txs by
+        #   the rate limit).
+        #
         # This option defaults to no filters at all (i.e. nothing will be submitted
         # to Sentry).
         'filters': {
@@ -47,6 +127,14 @@ WORKERS = {
                     'name': 'wtf',
                     'level': 'warning',
                 },
+                {
+                    'regexp': r'^\[DEBUG\].*',
+                    'name': 'debug',
+                    'level': 'debug',
+                    'sample': 0.01,
+                    'rate': 10,
+                    'burst': 100,
+                },
             ],
             'TxStatus': [
                 {
@@ -54,9 +142,67 @@ WORKERS = {
                     'name': '5xx',
                     'level': 'error',
                 },
+                {
+                    'field': 'status',
+                    'in': (401, 403),
+                    'name': 'denied',
+                    'level': 'info',
+                },
+            ],
+            'ReqEnd': [
+                {
+                    'field': 'total',
+                    'gt': 2.0,
+                    'name': 'slow',
+                    'level': 'warning',
+                },
+            ],
+            'RxHeader': [
+                {
+                    'header': 'X-Debug',
+                    'name': 'x-debug',
+                    'level': 'debug',
+                },
+                {
+                    'header': 'User-Agent',
+                    'regexp': r'(?i)sqlmap|nikto',
+                    'name': 'scanner',
+                    'level': 'warning',
+                },
+            ],
+            'Length': [
+                {
+                    'field': 'bytes',
+                    'gt': 10 * 1024 * 1024,
+                    'name': 'large',
+                    'level': 'info',
+                },
             ],
         },
 
+        # Optional: rules combine predicates on several tags ('Tag ~ "regexp"',
+        # holding once some record of that tag matches the regexp, or numeric
+        # predicates on typed fields, such as 'ReqEnd.total > 2' or
+        # 'TxStatus.status in (500, 503)') using 'and', 'or', 'not' &
+        # parentheses. A rule is checked incrementally as
+        # records arrive, and it's decided once the transaction ends (or
+        # earlier, if possible; predicates on tags logged once per
+        # transaction, such as RxURL or TxStatus, are decided as soon as their
+        # record is found). Name, level, sample rate & rate limit options are
+        # the same used by filters. Name defaults to the expression. When
+        # only rules are used for some transaction type (and transactions
+        # are not correlated), transactions no rule can match anymore are
+        # discarded right away. Defaults to no rules.
+        #'rules': [
+        #    {
+        #        'expression':
+        #            r'TxStatus ~ "^5" and RxURL ~ "^/api" and '
+        #            r'not VCL_Log ~ "\[EXPECTED\]"',
+        #        'name': 'api-5xx',
+        #        'level': 'error',
+        #    },
+        #],
+
         # Optional: run the worker process using some specific UID & GID. Note
         # that launching varnishsentry as root is required when using this
         # option. Defaults to same UID & GID that the master varnishsenry process.
@@ -76,6 +222,23 @@ WORKERS = {
             #'-n': 'acme',
         },
 
+        # Optional: in order to reduce processing costs, only a minimal set of
+        # tags is read from the shared memory log: tx delimiters, filtered tags
+        # and some context tags included in submitted transactions. The list
+        # of context tags can be customized here. Defaults to request / response
+        # lines, statuses, backend errors, hits, TTLs & VCL calls & logs (i.e.
+        # no headers).
+        #'context': ['RxURL', 'TxStatus', 'RxHeader', 'TxHeader'],
+
+        # Optional: read all tags from the shared memory log, including all of
+        # them in submitted transactions. Defaults to False.
+        #'full_context': False,
+
+        # Optional: sample the cost of each filter (evaluations & time spent
+        # running its regexp). Costs are published as metrics and logged on
+        # shutdown. Defaults to False.
+        #'profile_filters': False,
+
         # Optional: libvarnishapi path may be manually specified. Defaults to
         # 'libvarnishapi.so.1'
         #'libvarnishapi': '/usr/lib/libvarnishapi.so.1',
@@ -83,6 +246,141 @@ WORKERS = {
         # Optional: broken transactions are discarded after some timeout. Defaults
         # to 5 seconds.
         'timeout': 5,
+
+        # Optional: memory limits. When the number of open transactions of some
+        # type reaches its limit, the oldest one is evicted (it'll be submitted
+        # anyway if already matched). Once a transaction reaches the maximum
+        # number of items or bytes, only matching items are kept and submitted
+        # transactions include the number of discarded items. Evictions and
+        # truncations are periodically logged. When using a shared reader,
+        # transactions are buffered once per reader (or shard) for all workers
+        # using that instance, so limits (and eviction & truncation counters)
+        # apply to the reader, which uses the smallest limits of its workers.
+        # Defaults to 50000 transactions per type, and 500 items & 64 KB per
+        # transaction.
+        'limits': {
+            'transactions': 50000,
+            'items': 500,
+            'bytes': 64 * 1024,
+        },
+
+        # Optional: payload policy of submitted transactions. Matched items are
+        # always included. Other items are only included if 'unmatched' is
+        # enabled, their tag is in the 'tags' allowlist (if any) and the
+        # transaction is below 'max_items' items. Items longer than
+        # 'max_bytes' are truncated. Submitted transactions include the number
+        # of omitted items. Defaults to all items, as they are.
+        #'payload': {
+        #    'tags': ['RxURL', 'TxStatus', 'VCL_Log'],
+        #    'max_items': 100,
+        #    'max_bytes': 1024,
+        #    'unmatched': True,
+        #},
+
+        # Optional: correlate client & backend transactions sharing the same
+        # XID (found in ReqStart & BackendXID records). Events of correlated
+        # transactions include a summary (request / response lines, statuses,
+        # backend & fetch errors) of the other one, and a single event is
+        # submitted if both are matched. Events of transactions waiting for
+        # their counterparts are held back up to 'timeout' seconds. Up to
+        # 'max_entries' transactions are kept waiting; beyond that the oldest
+        # one is submitted uncorrelated. Requires both client & backend
+        # transactions, and it's not available when sharding. Defaults to
+        # disabled, 10000 entries & 5 seconds.
+        #'correlation': {
+        #    'enabled': True,
+        #    'max_entries': 10000,
+        #    'timeout': 5,
+        #},
+
+        # Optional: matched transactions are queued and delivered to Sentry by
+        # a pool of sender threads, so slow Sentry responses never stall the
+        # processing of the shared memory log. Once the outbound queue reaches
+        # the high watermark new events are dropped (and counted) until it
+        # drains below the low watermark. Events are queued in a separate lane
+        # per level, and batches are built taking up to 'weights' events from
+        # each lane in turn (highest levels first). When shedding, queued
+        # events of lower levels are dropped to make room for incoming events
+        # of higher levels. Defaults to 2 threads, batches of 32 events,
+        # 10000 / 8000 watermarks and 16 / 8 / 4 / 2 / 1 weights. Events of
+        # a batch are encoded at once and posted back to back over a single
+        # connection. Whatever the DSN scheme, a synchronous transport is
+        # used (any raven transport prefix, such as 'threaded+', is ignored),
+        # keeping a persistent connection per sender thread, and retrying
+        # failed requests with exponential backoff & jitter (defaults to 2
+        # retries, 0.1 seconds initial backoff, 5 seconds maximum backoff and
+        # the raven default timeout).
+        'delivery': {
+            'threads': 2,
+            'batch': 32,
+            'high_watermark': 10000,
+            'low_watermark': 8000,
+            #'weights': {
+            #    'fatal': 16,
+            #    'error': 8,
+            #    'warning': 4,
+            #    'info': 2,
+            #    'debug': 1,
+            #},
+            #'transport': {
+            #    'retries': 2,
+            #    'backoff': 0.1,
+            #    'max_backoff': 5.0,
+            #    'timeout': 5,
+            #},
+        },
+
+        # Optional: keep matched events in an on-disk spool (a directory
+        # exclusively used by this worker) instead of in the in-memory
+        # outbound queue, so Sentry outages and restarts don't lose them.
+        # Events are appended to segment files, synchronized to disk in
+        # batches ('fsync_batch' events or every 'fsync_interval' seconds),
+        # and delivered by a single sender thread at up to 'rate' events per
+        # second. Failed deliveries are retried with exponential backoff. The
+        # read cursor is persisted, so delivery resumes after restarts. Once
+        # the spool grows beyond 'max_size' bytes the oldest segments are
+        # dropped. Defaults to disabled, 8 MB segments, 256 MB, 1024 events,
+        # 1 second & no rate limit.
+        #'spool': {
+        #    'enabled': True,
+        #    'path': '/var/spool/varnishsentry/www',
+        #    'segment_size': 8 * 1024 * 1024,
+        #    'max_size': 256 * 1024 * 1024,
+        #    'fsync_batch': 1024,
+        #    'fsync_interval': 1.0,
+        #    'rate': 100,
+        #},
+
+        # Optional: adaptive sampling. Sample rates of all filters are lowered
+        # (down to some minimum factor) while the outbound queue holds more
+        # than 'max_backlog' events or the mean VSL callback latency is above
+        # 'max_latency' seconds, and slowly restored afterwards. Defaults to
+        # disabled, 5000 events, 100 us & 0.01.
+        #'sampling': {
+        #    'adaptive': True,
+        #    'max_backlog': 5000,
+        #    'max_latency': 0.0001,
+        #    'min_factor': 0.01,
+        #},
+
+        # Optional: aggregate similar events before delivering them. Events
+        # sharing the same fingerprint during a time window (in seconds) are
+        # grouped: the first one is delivered right away and, once the window
+        # is over, a copy of it including the number of occurrences and the
+        # items of a few other sample txs is delivered (only if some other
+        # event was grouped). Fingerprints are built using any of 'worker',
+        # 'filter', 'type', 'level' and 'message' (the main matched item, with
+        # numbers, hexadecimal IDs & UUIDs templated out). Up to 'max_keys'
+        # windows are kept in memory; beyond that the oldest one is closed
+        # early. Defaults to disabled, 60 seconds windows, 3 samples, 10000
+        # keys & a filter + type + message fingerprint.
+        #'aggregation': {
+        #    'enabled': True,
+        #    'window': 60,
+        #    'samples': 3,
+        #    'max_keys': 10000,
+        #    'fingerprint': ['filter', 'type', 'message'],
+        #},
     },
 }
 
@@ -7,11 +7,18 @@
 from __future__ import absolute_import
 import re
 import time
-import datetime
+import random
 import logging
 import threading
-from raven import Client
+import ctypes
+from collections import deque, OrderedDict
 from varnishsentry import api
+from varnishsentry import fields
+from varnishsentry import metrics
+from varnishsentry import rules
+from varnishsentry.matcher import HEADER_TAGS, Header, Matcher
+from varnishsentry.sampling import TokenBucket, Governor
+from varnishsentry.sender import LEVELS as FILTER_LEVELS, Sender, build_client
 from varnishsentry.worker import Worker
 
 #
@@ -46,66 +53,260 @@ TRANSACTIONS = {
 
 DEFAULT_TIMEOUT = 5
 
-FILTER_LEVELS = ('fatal', 'error', 'warning', 'info', 'debug')
+# Tags used by libvarnishapi to tell client & backend records apart. They must
+# never be excluded from the log.
+SPEC_TAGS = ('SessionOpen', 'ReqStart', 'BackendOpen', 'BackendXID')
+
+# Tags included in submitted events, besides tx delimiters & filtered tags,
+# when not running in full context mode.
+DEFAULT_CONTEXT_TAGS = (
+    'RxRequest', 'RxURL', 'RxProtocol', 'RxStatus',
+    'TxRequest', 'TxURL', 'TxProtocol', 'TxStatus',
+    'Backend', 'FetchError', 'Error', 'Hash', 'Hit', 'HitPass', 'TTL',
+    'VCL_call', 'VCL_return', 'VCL_error', 'VCL_Log',
+)
+
+# Pseudo tag used to store rules along with filters.
+RULES_TAG = 'rules'
+
+MAX_SPEC = 3
+
+MAX_TAG = 255
+
+MAX_POOLED_TRANSACTIONS = 1024
+
+DEFAULT_MAX_TRANSACTIONS = 50000
+
+DEFAULT_MAX_ITEMS = 500
+
+DEFAULT_MAX_BYTES = 64 * 1024
+
+PURGE_BATCH = 64
+
+# Formatted items are interned (i.e. shared by all events including them) up
+# to this number of distinct items. Beyond that the table is reset. Only short
+# items (the ones usually repeated, such as common headers) are interned, so
+# the table never takes more than a few MB.
+MAX_INTERNED_ITEMS = 10000
+
+MAX_INTERNED_LENGTH = 256
+
+# Marker appended to items truncated by some payload policy.
+TRUNCATION_MARKER = '...'
+
+DEFAULT_CORRELATION_ENTRIES = 10000
+
+DEFAULT_CORRELATION_TIMEOUT = 5
+
+# Tags holding XIDs, and tags kept in the summaries of txs waiting for their
+# counterparts in the correlation index. The 'Backend' record tells client txs
+# fetching from some backend apart.
+XID_TAGS = ('ReqStart', 'BackendXID')
+
+CORRELATION_TAGS = (
+    'ReqStart', 'BackendXID', 'BackendOpen', 'BackendReuse', 'Backend',
+    'RxRequest', 'RxURL', 'RxStatus', 'TxRequest', 'TxURL', 'TxStatus',
+    'FetchError',
+)
+
+MIN_IDLE_BACKOFF = 0.001
+
+MAX_IDLE_BACKOFF = 0.1
+
+# Only one out of LATENCY_SAMPLING records is timed (must be a power of 2).
+LATENCY_SAMPLING = 64
+
+# Only one out of PROFILING_SAMPLING records is used to profile filters.
+PROFILING_SAMPLING = 2 * LATENCY_SAMPLING
 
 
 class Consumer(Worker):
     def _init(self):
-        # Base initializations.
+        # Base initializations. A consumer usually serves a single worker, but
+        # subclasses may serve several workers sharing the same instance.
         self._consuming = False
-        self._timeout = self._config.get('timeout', DEFAULT_TIMEOUT)
-        self._next_purge = 0
+        self._workers = self._get_workers()
+        self._timeout = max(
+            config.get('timeout', DEFAULT_TIMEOUT)
+            for config in self._workers.itervalues())
+        self._full_context = any(
+            config.get('full_context', False)
+            for config in self._workers.itervalues())
+        self._serial = 0
+
+        # Clock used to timestamp & expire txs (see _get_clock()).
+        self._clock = self._get_clock()
+
+        # Memory limits: open txs per tx type, and items & bytes per tx. Txs
+        # are buffered once for all served workers, so the strictest limits
+        # apply.
+        limits = [config.get('limits', {}) for config in self._workers.itervalues()]
+        self._max_transactions = min(
+            item.get('transactions', DEFAULT_MAX_TRANSACTIONS) for item in limits)
+        self._max_items = min(item.get('items', DEFAULT_MAX_ITEMS) for item in limits)
+        self._max_bytes = min(item.get('bytes', DEFAULT_MAX_BYTES) for item in limits)
+        self._evictions = 0
+        self._truncations = 0
+        self._logged_evictions = 0
+        self._logged_truncations = 0
+
+        # Metrics counters. They're updated by the consumer thread only.
+        self._tag_records = [0] * (MAX_TAG + 1)
+        self._opened = dict((type, 0) for type in TRANSACTIONS)
+        self._committed = dict((type, 0) for type in TRANSACTIONS)
+        self._timed_out = dict((type, 0) for type in TRANSACTIONS)
+        self._skipped = dict((type, 0) for type in TRANSACTIONS)
+        self._discarded = dict((type, 0) for type in TRANSACTIONS)
+        self._latency = metrics.Histogram()
+        self._sampled = 0
 
-        # Initialize Sentry client.
-        self._client = None
-        if 'dsn' in self._config:
-            self._client = Client(dsn=self._config['dsn'])
+        # Sampled per filter cost accounting.
+        self._profile_filters = any(
+            config.get('profile_filters', False)
+            for config in self._workers.itervalues())
 
-        # Connect to libvarnishapi.
-        self._vap = api.VarnishAPI(
-            opt=self._get_vap_options(self._config.get('options', {})),
-            sopath=self._config.get('libvarnishapi', 'libvarnishapi.so.1'))
+        # Correlation of client & backend txs sharing the same XID.
+        self._correlation = self._get_correlation()
+
+        # Initialize delivery of matched txs.
+        self._init_delivery()
+        self._delivering = True
+
+        # Connect to libvarnishapi. Unless running in full context mode, only
+        # required tags will cross the ctypes boundary.
+        self._vap = self._connect()
 
         # Build list of known tx types.
         self._types = TRANSACTIONS.keys()
 
-        # Normalize tx delimiting tags.
-        self._delimiters = {}
-        for type, item in TRANSACTIONS.iteritems():
-            self._delimiters[type] = {
-                'start': [self._vap.VSL_NameNormalize(tag) for tag in item['start']],
-                'end': [self._vap.VSL_NameNormalize(tag) for tag in item['end']],
-            }
-
-        # Initialize tx filters.
-        self._filters = {}
-        for tag, filters in self._config.get('filters', {}).iteritems():
-            tag = self._vap.VSL_NameNormalize(tag)
-            items = []
-            for filter in filters:
-                # Check regular expression.
-                assert \
-                    'regexp' in filter, \
-                    'All filters must contain a matching regexp.'
-
-                # Build filter.
-                item = {
-                    'regexp': re.compile(filter['regexp']),
-                    'name': filter.get('name', tag),
-                    'level': filter.get('level', 'error'),
-                }
+        # Initialize tx filters. Filters of all workers for each tx type & tag
+        # are compiled into a single matcher.
+        filters = {}
+        for worker, config in sorted(self._workers.iteritems()):
+            types = self._get_types(config)
+            for tag, items in config.get('filters', {}).iteritems():
+                tag = self._vap.VSL_NameNormalize(tag)
+                for filter in items:
+                    item = self._build_filter(worker, tag, filter)
+                    for type in types:
+                        filters.setdefault((type, tag), []).append(item)
+        self._filters = filters
+        self._matchers = dict(
+            (key, Matcher(items)) for key, items in filters.iteritems())
+
+        # Initialize rules. Rules of each tx type are stored along with its
+        # filters (using a pseudo tag), and their predicates are flattened
+        # into a single list per tx type: (regexp, single, rule index) tuples.
+        # The offset of the first predicate of each rule is kept too. Each tx
+        # keeps the state of every predicate & rule, and predicates are
+        # evaluated as records arrive. Txs are discarded once no rule can
+        # match them, unless something else needs them.
+        self._rules = dict((type, []) for type in self._types)
+        self._predicates = dict((type, []) for type in self._types)
+        self._offsets = dict((type, []) for type in self._types)
+        self._single_tags = set(
+            self._vap.VSL_NameNormalize(tag) for tag in rules.SINGLE_TAGS)
+        predicates = {}
+        for worker, config in sorted(self._workers.iteritems()):
+            types = self._get_types(config)
+            for rule in config.get('rules', []):
+                item = self._build_rule(worker, rule)
+                for type in types:
+                    self._offsets[type].append(len(self._predicates[type]))
+                    for tag, regexp in item['predicates']:
+                        predicates.setdefault((type, tag), []).append(
+                            len(self._predicates[type]))
+                        self._predicates[type].append((
+                            regexp,
+                            tag in self._single_tags,
+                            len(self._rules[type])))
+                    self._rules[type].append(item)
+                    filters.setdefault((type, RULES_TAG), []).append(item)
+        self._rule_predicates = dict(
+            (key, tuple(items)) for key, items in predicates.iteritems())
+        self._discardable = dict(
+            (type,
+             len(self._rules[type]) > 0 and
+             self._correlation is None and
+             not any(key[0] == type for key in self._matchers))
+            for type in self._types)
+
+        # Initialize sampling. Each tx gets a random draw when it starts, and
+        # a filter only accepts txs whose draw is below its threshold (i.e.
+        # its effective sample rate). Txs no filter would accept are not even
+        # buffered. Thresholds of workers using adaptive sampling are
+        # periodically adjusted.
+        self._random = random.random
+        self._governors = dict(
+            (worker, Governor(config['sampling']))
+            for worker, config in self._workers.iteritems()
+            if config.get('sampling', {}).get('adaptive', False))
+        self._last_latency = (0.0, 0)
+        self._update_thresholds()
+
+        # Build list of tag names, indexed by integer tag.
+        self._tags = [self._vap.VSL_tags[id] for id in range(MAX_TAG + 1)]
+
+        # Initialize payload policies (None means all items are included, as
+        # they are) & the table of interned items.
+        self._payloads = dict(
+            (worker, self._build_payload(config['payload']))
+            for worker, config in self._workers.iteritems()
+            if 'payload' in config)
+        self._interned = {}
 
-                # Check level value.
-                assert \
-                    item['level'] in FILTER_LEVELS, \
-                    '"%s" is not a valid filter level.' % item['level']
+        # Initialize the correlation index: XID -> (timestamp, tx type, tx
+        # summary, pending events) entries in creation order, so expired (and
+        # oldest) entries are always found at the head. Only txs expecting a
+        # counterpart are indexed, keeping just the (tag, message) pairs
+        # needed to describe them.
+        if self._correlation is not None:
+            self._correlations = OrderedDict()
+            self._correlated = 0
+            self._uncorrelated = 0
+            self._xid_tags = set(
+                self._vap.VSL_NameNormalize(tag) for tag in XID_TAGS)
+            self._correlation_tags = set(
+                id for id, tag in enumerate(self._tags)
+                if tag in set(self._vap.VSL_NameNormalize(tag) for tag in CORRELATION_TAGS))
+            self._backend_tag = self._tags.index(self._vap.VSL_NameNormalize('Backend'))
 
-                # Append filter.
-                items.append(item)
-            self._filters[tag] = items
+        # Build set of selected tags (None means all of them).
+        selected = None
+        if not self._full_context:
+            selected = set(self._vap.VSL_NameNormalize(tag) for tag in self._get_tags())
 
-        # Initialize tx buffers.
+        # Build the dispatching table, indexed by spec & integer tag. Each
+        # entry holds everything the VSL callback needs to know about records
+        # of that kind, or None if they can be discarded right away.
+        self._dispatch = [[None] * (MAX_TAG + 1) for spec in range(MAX_SPEC + 1)]
+        for type, item in TRANSACTIONS.iteritems():
+            start = [self._vap.VSL_NameNormalize(tag) for tag in item['start']]
+            end = [self._vap.VSL_NameNormalize(tag) for tag in item['end']]
+            for id, tag in enumerate(self._tags):
+                if tag and (selected is None or tag in selected):
+                    self._dispatch[type][id] = (
+                        type,
+                        tag in start,
+                        tag in end,
+                        self._matchers.get((type, tag)),
+                        self._rule_predicates.get((type, tag)),
+                    )
+
+        # Initialize tx buffers & the pool of reusable tx instances.
         self._buffers = dict((type, {}) for type in self._types)
+        self._pool = []
+
+        # Initialize the tx expiry indexes: (timestamp, fd, serial) tuples in
+        # creation order, one index per tx type. Given that timestamps never
+        # decrease, expired (and oldest) txs are always found at the head.
+        self._expiry = dict((type, deque()) for type in self._types)
+        self._expiries = self._expiry.items()
+
+        # Build the VSL callback object once. It will be reused for every
+        # dispatch.
+        self._handler = api.VSL_raw_handler_f(self._vap_callBack)
+        self._records = 0
 
         # Launch consumer thread.
         self._thread = threading.Thread(target=self._loop)
@@ -117,180 +318,923 @@ class Consumer(Worker):
         if not self._thread.is_alive():
             raise Exception('Consumer thread has been unexpectedly stopped.')
 
+        # Have memory limits been reached?
+        if self._evictions > self._logged_evictions or \
+           self._truncations > self._logged_truncations:
+            logging.getLogger('varnishsentry').warning(
+                'Memory limits reached. %d txs evicted and %d txs truncated '
+                'so far.', self._evictions, self._truncations)
+            self._logged_evictions = self._evictions
+            self._logged_truncations = self._truncations
+
+        # Check delivery status.
+        self._poll_delivery()
+
+        # Adjust sampling.
+        self._update_sampling()
+
     def _shutdown(self):
-        # If running, stop the consuming thread.
-        if self._consuming:
+        # If running, stop the consuming thread and wait for it. Dispatching
+        # is non blocking, so this should take no longer than the maximum
+        # idle backoff. Initialization may have failed at any point.
+        if getattr(self, '_consuming', False):
             self._consuming = False
+            self._thread.join(MAX_IDLE_BACKOFF * 10)
+
+            # Dump filter costs.
+            if self._profile_filters:
+                self._dump_filter_stats()
+
+            # Deliver events still waiting for their counterparts (unless
+            # the consuming thread is still running, and using the index).
+            if self._correlation is not None:
+                if self._thread.is_alive():
+                    logging.getLogger('varnishsentry').warning(
+                        'Consumer thread still running. Discarding events '
+                        'waiting for their counterparts.')
+                else:
+                    self._expire_correlations(None)
+
+        # Flush pending events.
+        if getattr(self, '_delivering', False):
+            self._delivering = False
+            self._shutdown_delivery()
+
+    def _metrics(self):
+        result = [
+            metrics.counter('evicted_transactions_total', self._evictions),
+            metrics.counter('truncated_transactions_total', self._truncations),
+            metrics.histogram('callback_seconds', self._latency),
+        ]
+        for id, count in enumerate(self._tag_records):
+            if count:
+                result.append(metrics.counter(
+                    'records_total', count, tag=self._tags[id]))
+        for type, item in TRANSACTIONS.iteritems():
+            for name, counters in (
+                    ('opened_transactions_total', self._opened),
+                    ('committed_transactions_total', self._committed),
+                    ('timed_out_transactions_total', self._timed_out),
+                    ('skipped_transactions_total', self._skipped),
+                    ('discarded_transactions_total', self._discarded)):
+                result.append(metrics.counter(
+                    name, counters[type], type=item['name']))
+            result.append(metrics.gauge(
+                'open_transactions', len(self._buffers[type]), type=item['name']))
+        for (tag, worker, name), stats in self._get_filter_stats().iteritems():
+            result.append(metrics.counter(
+                'filter_matches_total', stats[0], tag=tag, worker=worker, filter=name))
+            if self._profile_filters:
+                result.append(metrics.counter(
+                    'filter_sampled_evaluations_total', stats[1],
+                    tag=tag, worker=worker, filter=name))
+                result.append(metrics.counter(
+                    'filter_sampled_seconds_total', stats[2],
+                    tag=tag, worker=worker, filter=name))
+        if self._correlation is not None:
+            result.extend([
+                metrics.counter('correlated_transactions_total', self._correlated),
+                metrics.counter('uncorrelated_transactions_total', self._uncorrelated),
+                metrics.gauge('correlation_entries', len(self._correlations)),
+            ])
+        for worker, governor in self._governors.iteritems():
+            result.append(metrics.gauge('sampling_factor', governor.factor, worker=worker))
+        return result + self._metrics_delivery()
+
+    def _get_unique_filters(self):
+        # Filters are shared by all tx types they apply to. Returns a list of
+        # (tag, filter) pairs.
+        result = {}
+        for (type, tag), items in self._filters.iteritems():
+            for filter in items:
+                result[id(filter)] = (tag, filter)
+        return result.values()
+
+    def _get_filter_stats(self):
+        # Matches, sampled evaluations & sampled time of each filter.
+        result = {}
+        for tag, filter in self._get_unique_filters():
+            stats = result.setdefault((tag, filter['worker'], filter['name']), [0, 0, 0.0])
+            stats[0] += filter['matches']
+            stats[1] += filter['evaluations']
+            stats[2] += filter['cost']
+        return result
+
+    def _dump_filter_stats(self):
+        # Log estimated costs, most expensive filters first.
+        stats = sorted(
+            self._get_filter_stats().iteritems(),
+            key=lambda item: item[1][2], reverse=True)
+        for (tag, worker, name), (matches, evaluations, cost) in stats:
+            logging.getLogger('varnishsentry').info(
+                'Filter %s of worker %s (%s): %d matches, ~%d evaluations, '
+                '~%.3f seconds.', name, worker, tag, matches,
+                evaluations * PROFILING_SAMPLING, cost * PROFILING_SAMPLING)
+
+    def _update_sampling(self):
+        # Update acceptance ratios of token buckets.
+        for tag, filter in self._get_unique_filters():
+            if filter['bucket'] is not None:
+                filter['bucket'].update_ratio()
+
+        # Adjust adaptive sampling factors using the outbound backlog and the
+        # mean VSL callback latency since the last adjustment.
+        if self._governors:
+            total, count = self._latency.sum, self._latency.count
+            latency = None
+            if count > self._last_latency[1]:
+                latency = (total - self._last_latency[0]) / (count - self._last_latency[1])
+            self._last_latency = (total, count)
+            for worker, governor in self._governors.iteritems():
+                governor.update(self._get_backlog(worker), latency)
+            self._update_thresholds()
+
+    def _update_thresholds(self):
+        # Effective sample rate of each filter, and maximum one for each tx
+        # type (i.e. txs with higher draws can be ignored right away).
+        thresholds = dict((type, 0.0) for type in self._types)
+        for (type, tag), items in self._filters.iteritems():
+            for filter in items:
+                governor = self._governors.get(filter['worker'])
+                filter['threshold'] = \
+                    filter['sample'] * (governor.factor if governor is not None else 1.0)
+                thresholds[type] = max(thresholds[type], filter['threshold'])
+
+        # When correlating, all txs are needed (a tx may be the counterpart
+        # of some matched tx).
+        if self._correlation is not None:
+            thresholds = dict((type, 1.0) for type in self._types)
+
+        self._thresholds = thresholds
+
+    def _get_backlog(self, worker):
+        sender = self._senders.get(worker)
+        return sender.size if sender is not None else 0
+
+    def _get_profiled_threads(self):
+        return [self._thread]
+
+    def _get_workers(self):
+        return {self.name: self._config}
+
+    def _connect(self):
+        return api.VarnishAPI(
+            opt=self._get_vap_options(
+                None if self._full_context else self._get_tags()),
+            sopath=self._get_config('libvarnishapi', 'libvarnishapi.so.1'))
+
+    def _get_config(self, name, default=None):
+        # Instance wide settings are shared by all served workers, so it's
+        # enough to check any of them.
+        for config in self._workers.itervalues():
+            if name in config:
+                return config[name]
+        return default
+
+    def _get_clock(self):
+        # Function returning the current UNIX timestamp. Subclasses may
+        # replace the wall clock (e.g. when replaying logs).
+        return time.time
+
+    def _get_correlation(self):
+        # Correlation settings (None if disabled). Both tx types are required.
+        correlation = self._get_config('correlation', {})
+        if not correlation.get('enabled', False):
+            return None
+        for config in self._workers.itervalues():
+            assert \
+                len(self._get_types(config)) == len(TRANSACTIONS), \
+                'Correlation requires both client & backend txs.'
+        return {
+            'max_entries': correlation.get('max_entries', DEFAULT_CORRELATION_ENTRIES),
+            'timeout': correlation.get('timeout', DEFAULT_CORRELATION_TIMEOUT),
+        }
+
+    def _get_types(self, config):
+        # Tx types enabled for a worker: -c & -b varnishlog options. No option
+        # at all means all tx types.
+        options = config.get('options', {})
+        result = []
+        if options.get('-c', True):
+            result.append(1)
+        if options.get('-b', True):
+            result.append(2)
+        return result or TRANSACTIONS.keys()
+
+    def _build_rule(self, worker, rule):
+        # Check expression.
+        assert \
+            'expression' in rule, \
+            'All rules must contain an expression.'
+
+        # Build rule: a filter without a regexp, plus the expression tree &
+        # predicates (using normalized tags).
+        tree, predicates = rules.parse(rule['expression'])
+        result = self._build_filter(
+            worker, RULES_TAG, dict(rule, name=rule.get('name', rule['expression'])))
+        result['tree'] = tree
+        result['predicates'] = []
+        for tag, regexp in predicates:
+            normalized = self._vap.VSL_NameNormalize(tag)
+            assert \
+                normalized, \
+                '"%s" is not a valid tag.' % tag
+            result['predicates'].append((normalized, regexp))
+
+        # Done!
+        return result
+
+    def _build_filter(self, worker, tag, filter):
+        # Check regular expression, field or header (rules have none).
+        assert \
+            'regexp' in filter or 'field' in filter or 'header' in filter or \
+            tag == RULES_TAG, \
+            'All filters must contain a matching regexp, field or header.'
+        assert \
+            'header' not in filter or tag in HEADER_TAGS, \
+            'Header filters are only supported by %s.' % ', '.join(HEADER_TAGS)
+
+        # Build filter. Field & header filters are matched using a predicate
+        # instead of a regexp (header filters use the regexp, if any, to
+        # match header values).
+        if 'header' in filter:
+            regexp = Header(
+                filter['header'],
+                re.compile(filter['regexp']) if 'regexp' in filter else None)
+        elif 'regexp' in filter:
+            regexp = re.compile(filter['regexp'])
+        elif 'field' in filter:
+            regexp = fields.build(tag, filter)
+        else:
+            regexp = None
+        result = {
+            'regexp': regexp,
+            'name': filter.get('name', tag),
+            'level': filter.get('level', 'error'),
+            'worker': worker,
+            'matches': 0,
+            'evaluations': 0,
+            'cost': 0.0,
+            'sample': filter.get('sample', 1.0),
+            'threshold': filter.get('sample', 1.0),
+            'bucket':
+                TokenBucket(filter['rate'], filter.get('burst'))
+                if 'rate' in filter else None,
+        }
+
+        # Check sample rate.
+        assert \
+            0.0 <= result['sample'] <= 1.0, \
+            'Filter sample rates must be between 0 and 1.'
+
+        # Check level value.
+        assert \
+            result['level'] in FILTER_LEVELS, \
+            '"%s" is not a valid filter level.' % result['level']
+
+        # Done!
+        return result
+
+    def _build_payload(self, payload):
+        # Build policy.
+        result = {
+            'tags': None,
+            'max_items': payload.get('max_items'),
+            'max_bytes': payload.get('max_bytes'),
+            'unmatched': payload.get('unmatched', True),
+        }
+        if 'tags' in payload:
+            tags = set(self._vap.VSL_NameNormalize(tag) for tag in payload['tags'])
+            result['tags'] = set(
+                id for id, tag in enumerate(self._tags) if tag in tags)
+
+        # Check limits.
+        assert \
+            result['max_items'] is None or result['max_items'] >= 0, \
+            'Payload max items must be non-negative.'
+        assert \
+            result['max_bytes'] is None or result['max_bytes'] > 0, \
+            'Payload max bytes must be positive.'
+
+        # Done!
+        return result
+
+    def _init_delivery(self):
+        # Initialize Sentry client & outbound queue. Events are delivered by
+        # a pool of sender threads, so the VSL callback only has to enqueue
+        # them.
+        self._senders = {}
+        self._dropped = {}
+        for worker, config in self._workers.iteritems():
+            if 'dsn' in config:
+                self._senders[worker] = Sender(
+                    build_client(config),
+                    config.get('delivery', {}),
+                    config.get('aggregation'),
+                    config.get('spool'))
+                self._senders[worker].start()
+                self._dropped[worker] = 0
+
+    def _poll_delivery(self):
+        # Have new events been dropped by the outbound queues?
+        for worker, sender in self._senders.iteritems():
+            if sender.dropped > self._dropped[worker]:
+                logging.getLogger('varnishsentry').warning(
+                    'Outbound queue of worker %s is full. %d events dropped '
+                    'so far.', worker, sender.dropped)
+                self._dropped[worker] = sender.dropped
+
+    def _shutdown_delivery(self):
+        for sender in self._senders.itervalues():
+            sender.stop()
+
+    def _metrics_delivery(self):
+        result = []
+        for worker, sender in self._senders.iteritems():
+            result.extend(metrics.sender(sender, worker=worker))
+        return result
+
+    def _deliver(self, worker, event):
+        sender = self._senders.get(worker)
+        if sender is not None:
+            sender.put(event)
 
     def _loop(self):
         self._consuming = True
+        self._vap.VSL_NonBlocking(1)
+        backoff = MIN_IDLE_BACKOFF
         while self._consuming:
             try:
-                self._vap.VSL_Dispatch(self._vap_callBack, priv=False)
+                # Dispatch all available VSL items.
+                self._records = 0
+                self._vap.VSL_DispatchHandler(self._handler, priv=False)
+
+                # Nothing to do? Purge buffered txs and wait a bit, increasing
+                # the delay while the log remains idle.
+                if self._records == 0:
+                    self._purge_buffers(int(self._clock()))
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_IDLE_BACKOFF)
+                else:
+                    backoff = MIN_IDLE_BACKOFF
             except Exception:
                 logging.getLogger('varnishsentry').error(
                     'Got unexpected exception while dispatching VSL item.',
                     exc_info=True)
 
-    def _get_vap_options(self, options):
+    def _get_tags(self):
+        # Minimal set of tags required by served workers: tx delimiters, tags
+        # used to classify records, filtered tags and context tags.
+        result = set(SPEC_TAGS)
+        for item in TRANSACTIONS.itervalues():
+            result.update(item['start'])
+            result.update(item['end'])
+        for config in self._workers.itervalues():
+            result.update(config.get('filters', {}).keys())
+            result.update(config.get('context', DEFAULT_CONTEXT_TAGS))
+            for rule in config.get('rules', []):
+                result.update(tag for tag, regexp in rules.parse(rule['expression'])[1])
+            if config.get('correlation', {}).get('enabled', False):
+                result.update(CORRELATION_TAGS)
+        return result
+
+    def _get_vap_options(self, tags=None):
+        types = set()
+        for config in self._workers.itervalues():
+            types.update(self._get_types(config))
+        options = self._get_config('options', {})
         result = []
-        if options.get('-c', True):
+        if 1 in types:
             result.append('-c')
-        if options.get('-b', True):
+        if 2 in types:
             result.append('-b')
-        if options.get('-d', False):
+        if any(config.get('options', {}).get('-d', False)
+               for config in self._workers.itervalues()):
             result.append('-d')
         if options.get('-n'):
             result.append('-n')
             result.append(options['-n'])
+        if tags is not None:
+            result.append('-i')
+            result.append(','.join(sorted(tags)))
         return result
 
     def _vap_callBack(self, priv, tag, fd, length, spec, ptr, bm):
-        # Log incoming tx item.
-        logging.getLogger('varnishsentry').debug(
-            'Handling new transaction item: '
-            'priv=%s, tag=%s, fd=%s, length=%s, spec=%s, ptr=%s, bm=%s.',
-            priv, tag, fd, length, spec, ptr, bm)
+        # Stop dispatching ASAP when shutting down.
+        if not self._consuming:
+            return 1
+        self._records += 1
 
-        # Fetch current UNIX timestamp.
-        now = int(time.time())
+        # Does the item belong to any relevant tx type? Irrelevant items are
+        # discarded without further processing.
+        entry = self._dispatch[spec][tag]
+        if entry is None:
+            return
+        self._tag_records[tag] += 1
 
-        # Normalize item fields.
-        item = self._vap.normalizeDic(priv, tag, fd, length, spec, ptr, bm)
+        # Handle the item, timing a sample of them. When enabled, sampled
+        # items alternate between timing & filter profiling.
+        self._sampled += 1
+        if self._sampled & (LATENCY_SAMPLING - 1):
+            self._handle(entry, tag, fd, length, ptr, False)
+        elif self._sampled & LATENCY_SAMPLING and self._profile_filters:
+            self._handle(entry, tag, fd, length, ptr, True)
+        else:
+            started = time.time()
+            self._handle(entry, tag, fd, length, ptr, False)
+            self._latency.observe(time.time() - started)
 
-        # Does the item belong to any relevant tx type?
-        if item['type'] in self._types:
-            # Is this a brand new transaction?
-            if item['tag'] in self._delimiters[item['type']]['start']:
-                self._buffers[item['type']][fd] = Transaction(now, item['type'])
+    def _handle(self, entry, tag, fd, length, ptr, profile):
+        type, start, end, matcher, predicates = entry
 
-            # Has we previously seen the tx?
-            tx = self._buffers[item['type']].get(fd)
+        # Fetch current UNIX timestamp.
+        now = int(self._clock())
+
+        # Is this a brand new transaction? Otherwise, has we previously seen
+        # the tx?
+        if start:
+            tx = self._buffers[type].pop(fd, None)
             if tx is not None:
-                # Append the new item to the tx.
-                tx.add(item['tag'], item['msg'])
-
-                # Try to match the item.
-                if item['tag'] in self._filters:
-                    for filter in self._filters[item['tag']]:
-                        if filter['regexp'].search(item['msg']):
-                            tx.match(
-                                item['tag'],
-                                item['msg'],
-                                filter['name'],
-                                filter['level'])
-
-                # Is the tx ending?
-                if item['tag'] in self._delimiters[item['type']]['end']:
-                    # Remove tx instance from the buffer.
-                    del self._buffers[item['type']][fd]
-
-                    # Commit tx
-                    self._commit_tx(tx, timeout=False)
-
-        # Time to purge buffered txs?
-        if now > self._next_purge:
-            self._purge_buffers(now)
+                self._release_tx(tx)
+                tx = None
+
+            # Unless no filter would accept the tx, start buffering it.
+            draw = self._random()
+            if draw < self._thresholds[type]:
+                if len(self._buffers[type]) >= self._max_transactions:
+                    self._evict(type)
+                tx = self._pool.pop() if self._pool else Transaction()
+                self._serial += 1
+                tx.reset(
+                    now, type, self._serial, draw,
+                    len(self._predicates[type]), len(self._rules[type]))
+                self._buffers[type][fd] = tx
+                self._opened[type] += 1
+                self._expiry[type].append((now, fd, self._serial))
+            else:
+                self._skipped[type] += 1
+        else:
+            tx = self._buffers[type].get(fd)
+
+        if tx is not None:
+            # Fetch the item payload. It's only copied at this point, once we
+            # know some tx needs it.
+            message = ctypes.string_at(ptr, length)
+
+            # Try to match the item.
+            if matcher is None:
+                filters = ()
+            elif profile:
+                filters = matcher.profile(message)
+            else:
+                filters = matcher.match(message)
+
+            # Evaluate pending rule predicates on the item.
+            hits = None
+            if predicates is not None:
+                hits = [
+                    index for index in predicates
+                    if tx.states[index] is None and
+                    self._predicates[type][index][0].search(message)]
+
+            # Append the new (raw) item to the tx. Once the tx is too large,
+            # only matched items are kept.
+            if not tx.truncated and \
+               len(tx.arena) < 2 * self._max_items and \
+               tx.size + length <= self._max_bytes:
+                tx.add(tag, message)
+            elif filters or hits:
+                tx.add(tag, message)
+            else:
+                if not tx.truncated:
+                    self._truncations += 1
+                tx.truncated += 1
+
+            # Register matches.
+            for filter in filters:
+                if tx.draw < filter['threshold']:
+                    tx.match(filter)
+                filter['matches'] += 1
+
+            # Update rules. Once no rule can match the tx (and nothing else
+            # needs it), stop buffering it.
+            if hits is not None and \
+               not self._update_rules(tx, predicates, hits) and \
+               self._discardable[type]:
+                del self._buffers[type][fd]
+                self._discarded[type] += 1
+                self._release_tx(tx)
+
+            # Is the tx ending?
+            elif end:
+                # Remove tx instance from the buffer.
+                del self._buffers[type][fd]
+
+                # Commit tx
+                self._committed[type] += 1
+                self._commit_tx(tx, timeout=False)
+                self._release_tx(tx)
+
+        # Any buffered tx timed out? Purging is amortized across callbacks,
+        # and all tx types are checked (some type may stop receiving
+        # records).
+        for item, expiry in self._expiries:
+            if expiry and now - expiry[0][0] >= self._timeout:
+                self._purge_buffer(item, now, limit=PURGE_BATCH)
 
     def _purge_buffers(self, now):
-        for txs in self._buffers.values():
-            for id in txs.keys():
-                tx = txs[id]
-                # Has the tx timed out?
-                if now - tx.timestamp >= self._timeout:
-                    # Remove tx instance from the buffer.
-                    del txs[id]
-
-                    # Commit tx.
-                    self._commit_tx(tx, timeout=True)
-
-        # Set next purgation timestamp.
-        self._next_purge = int(time.time()) + 1
-
-    def _commit_tx(self, tx, timeout=False):
-        if tx.is_matched and self._client is not None:
-            self._client.capture(
-                'raven.events.Message',
-                message=tx.matched_item,
-                data={
-                    'timestamp': datetime.datetime.fromtimestamp(tx.timestamp),
-                    'logger': 'varnishsentry',
-                    'level': tx.matched_level,
-                    'tags': {
-                        'filter': tx.matched_name,
-                        'type': TRANSACTIONS[tx.type]['name'],
-                        'worker': self.name,
+        for type in self._types:
+            self._purge_buffer(type, now)
+        if self._correlation is not None:
+            self._expire_correlations(now)
+
+    def _purge_buffer(self, type, now, limit=None):
+        expiry = self._expiry[type]
+        while expiry and limit != 0:
+            # Has the oldest tx timed out?
+            timestamp, fd, serial = expiry[0]
+            if now - timestamp < self._timeout:
+                break
+            expiry.popleft()
+            if limit is not None:
+                limit -= 1
+
+            # Is the tx still buffered? (it may be already committed).
+            tx = self._buffers[type].get(fd)
+            if tx is not None and tx.serial == serial:
+                # Remove tx instance from the buffer.
+                del self._buffers[type][fd]
+
+                # Commit tx.
+                self._timed_out[type] += 1
+                self._commit_tx(tx, timeout=True)
+                self._release_tx(tx)
+
+    def _evict(self, type):
+        expiry = self._expiry[type]
+        while expiry:
+            # Is the oldest tx still buffered? (it may be already committed).
+            timestamp, fd, serial = expiry.popleft()
+            tx = self._buffers[type].get(fd)
+            if tx is not None and tx.serial == serial:
+                # Remove tx instance from the buffer.
+                del self._buffers[type][fd]
+
+                # Commit whatever has been matched so far.
+                self._evictions += 1
+                self._commit_tx(tx, evicted=True)
+                self._release_tx(tx)
+                break
+
+    def _release_tx(self, tx):
+        # Return the tx instance to the pool, so it can be reused.
+        if len(self._pool) < MAX_POOLED_TRANSACTIONS:
+            tx.clear()
+            self._pool.append(tx)
+
+    def _update_rules(self, tx, predicates, hits):
+        # Update the state of some predicates given the last item: matched
+        # predicates hold, and predicates on single tags can't hold anymore.
+        # Then update the rules using them. Returns False once no rule can
+        # match the tx.
+        states = tx.states
+        for index in predicates:
+            if states[index] is None:
+                regexp, single, rule = self._predicates[tx.type][index]
+                if index in hits:
+                    states[index] = len(tx.arena) - 2
+                elif single:
+                    states[index] = False
+                else:
+                    continue
+                if tx.verdicts[rule] is None:
+                    self._decide_rule(tx, rule, False)
+        return tx.alive > 0 or len(tx.matches) > 0
+
+    def _decide_rule(self, tx, rule, final):
+        # Evaluate a rule. Once decided, matching rules are registered as
+        # matches of the last item matched by their predicates (or of the
+        # first item of the tx, when none).
+        offset = self._offsets[tx.type][rule]
+        verdict = rules.evaluate(
+            self._rules[tx.type][rule]['tree'], tx.states, offset, final)
+        if verdict is not None:
+            tx.verdicts[rule] = verdict
+            tx.alive -= 1
+            if verdict:
+                item = self._rules[tx.type][rule]
+                count = len(item['predicates'])
+                index = max([
+                    state for state in tx.states[offset:offset + count]
+                    if state is not None and state is not False] or [0])
+                if tx.draw < item['threshold']:
+                    tx.matches.append((index, item))
+                item['matches'] += 1
+
+    def _finalize_rules(self, tx):
+        # Decide pending rules of a completed tx.
+        for rule, verdict in enumerate(tx.verdicts):
+            if verdict is None:
+                self._decide_rule(tx, rule, True)
+
+    def _commit_tx(self, tx, timeout=False, evicted=False):
+        # Decide pending rules (unless the tx is incomplete). Then build
+        # events of matched txs and, if enabled, try to correlate them with
+        # the counterpart tx.
+        if tx.alive and not timeout and not evicted:
+            self._finalize_rules(tx)
+        events = self._build_events(tx, timeout, evicted) if tx.matches else {}
+        if self._correlation is not None:
+            events = self._correlate(tx, events)
+        for worker, event in events.iteritems():
+            self._deliver(worker, event)
+
+    def _build_events(self, tx, timeout, evicted):
+        # One event per worker (see below).
+        result = {}
+        if tx.matches:
+            # Group matched items by worker, leaving out filters running out
+            # of tokens (each filter takes at most one token per tx).
+            now = self._clock()
+            accepted = {}
+            matches = {}
+            for index, filter in tx.matches:
+                if filter['bucket'] is not None:
+                    if id(filter) not in accepted:
+                        accepted[id(filter)] = filter['bucket'].take(now)
+                    if not accepted[id(filter)]:
+                        continue
+                matches.setdefault(filter['worker'], []).append((index, filter))
+            if not matches:
+                return result
+
+            # Deliver one event per worker. The main matched item is the one
+            # with the highest level (the first one in case of ties). Items
+            # are formatted once per payload policy.
+            payloads = {}
+            for worker, worker_matches in matches.iteritems():
+                index, filter = min(
+                    worker_matches,
+                    key=lambda match: FILTER_LEVELS.index(match[1]['level']))
+                payload = self._payloads.get(worker)
+                max_bytes = payload['max_bytes'] if payload is not None else None
+                if payload is None:
+                    if None not in payloads:
+                        payloads[None] = self._get_items(tx, None, None)
+                    items, omitted = payloads[None]
+                else:
+                    items, omitted = self._get_items(tx, payload, worker_matches)
+                event = {
+                    'message': self._format_item(
+                        tx.arena[index], tx.arena[index + 1], max_bytes),
+                    'data': {
+                        'timestamp': tx.timestamp,
+                        'logger': 'varnishsentry',
+                        'level': filter['level'],
+                        'tags': {
+                            'filter': filter['name'],
+                            'type': TRANSACTIONS[tx.type]['name'],
+                            'worker': worker,
+                        },
+                        # 'sentry.interfaces.Message': {
+                        #     'message': 'My raw message with interpreted strings like %s',
+                        #     'params': ['this'],
+                        # },
+                        # 'sentry.interfaces.Http': {
+                        #     'url': 'http://absolute.uri/foo',
+                        #     'method': 'POST',
+                        #     'data': {
+                        #         'foo': 'bar',
+                        #     },
+                        #     'query_string': 'hello=world',
+                        #     'cookies': 'foo=bar',
+                        #     'headers': {
+                        #         'Content-Type': 'text/html',
+                        #     },
+                        #     'env': {
+                        #         'REMOTE_ADDR': '192.168.0.1',
+                        #     },
+                        # },
+                        # 'sentry.interfaces.User': {
+                        #     'id': 'unique_id',
+                        #     'username': 'my_user',
+                        #     'email': 'foo@example.com',
+                        #     'ip_address': '127.0.0.1',
+                        # },
+                    },
+                    'extra': {
+                        'timeout': timeout,
+                        'evicted': evicted,
+                        'truncated': tx.truncated,
+                        'effective_rate':
+                            filter['threshold'] *
+                            (filter['bucket'].ratio if filter['bucket'] is not None else 1.0),
+                        'items': items,
+                        'matched': [
+                            '[%(level)s/%(name)s] %(item)s' % {
+                                'name': filter['name'],
+                                'level': filter['level'],
+                                'item': self._format_item(
+                                    tx.arena[index], tx.arena[index + 1], max_bytes),
+                            }
+                            for index, filter in worker_matches],
                     },
-                    # 'sentry.interfaces.Message': {
-                    #     'message': 'My raw message with interpreted strings like %s',
-                    #     'params': ['this'],
-                    # },
-                    # 'sentry.interfaces.Http': {
-                    #     'url': 'http://absolute.uri/foo',
-                    #     'method': 'POST',
-                    #     'data': {
-                    #         'foo': 'bar',
-                    #     },
-                    #     'query_string': 'hello=world',
-                    #     'cookies': 'foo=bar',
-                    #     'headers': {
-                    #         'Content-Type': 'text/html',
-                    #     },
-                    #     'env': {
-                    #         'REMOTE_ADDR': '192.168.0.1',
-                    #     },
-                    # },
-                    # 'sentry.interfaces.User': {
-                    #     'id': 'unique_id',
-                    #     'username': 'my_user',
-                    #     'email': 'foo@example.com',
-                    #     'ip_address': '127.0.0.1',
-                    # },
-                },
-                extra={
-                    'timeout': timeout,
-                    'items': tx.items,
-                    'matched': tx.matched_items,
-                })
+                }
+                if payload is not None:
+                    event['extra']['omitted'] = omitted
+                result[worker] = event
+        return result
+
+    def _correlate(self, tx, events):
+        # Client txs fetching from some backend, and all backend txs, expect
+        # a counterpart sharing the same XID. The first one to be committed
+        # is indexed (holding back its events) until the second one arrives
+        # or the entry expires. Events of correlated txs include a summary of
+        # the counterpart. If both txs are matched, a single event per worker
+        # is delivered. Returns the events to be delivered right now.
+        xid, expecting = self._get_xid(tx)
+        if xid is None:
+            return events
+        now = self._clock()
+        self._expire_correlations(now)
+
+        # Counterpart already indexed?
+        entry = self._correlations.pop(xid, None)
+        if entry is not None and entry[1] == tx.type:
+            # Same tx type (e.g. a restart fetching again): give up.
+            self._release_correlation(entry)
+            entry = None
+        if entry is None:
+            if expecting:
+                self._correlations[xid] = (now, tx.type, self._summarize(tx), events)
+                while len(self._correlations) > self._correlation['max_entries']:
+                    self._release_correlation(self._correlations.popitem(last=False)[1])
+                return {}
+            return events
+
+        # Merge events of both txs.
+        timestamp, type, summary, pending = entry
+        self._correlated += 1
+        result = {}
+        for worker in set(events) | set(pending):
+            event, other = events.get(worker), pending.get(worker)
+            if event is None:
+                event, other = other, None
+                event['extra']['correlated'] = self._describe(tx.type, self._summarize(tx))
+            elif other is None:
+                event['extra']['correlated'] = self._describe(type, summary)
+            else:
+                # Both matched: the main event is the one with the highest
+                # level (the client one in case of ties), also including the
+                # matched items of the other one.
+                (event, _, _), (other, other_type, other_summary) = sorted(
+                    [(event, tx.type, None), (other, type, summary)],
+                    key=lambda item: (
+                        FILTER_LEVELS.index(item[0]['data']['level']), item[1]))
+                event['extra']['correlated'] = dict(
+                    self._describe(other_type, other_summary or self._summarize(tx)),
+                    matched=other['extra']['matched'])
+            result[worker] = event
+        return result
+
+    def _expire_correlations(self, now):
+        # Deliver (uncorrelated) events of expired entries, or of all of them.
+        while self._correlations:
+            xid, entry = next(self._correlations.iteritems())
+            if now is not None and now - entry[0] < self._correlation['timeout']:
+                break
+            del self._correlations[xid]
+            self._release_correlation(entry)
+
+    def _release_correlation(self, entry):
+        self._uncorrelated += 1
+        for worker, event in entry[3].iteritems():
+            self._deliver(worker, event)
+
+    def _get_xid(self, tx):
+        # XID of a tx (third field of ReqStart, or BackendXID), and whether
+        # a counterpart is expected.
+        xid = None
+        expecting = tx.type != 1
+        for index in xrange(0, len(tx.arena), 2):
+            tag = self._tags[tx.arena[index]]
+            if tag in self._xid_tags and xid is None:
+                parts = tx.arena[index + 1].split()
+                xid = parts[2] if tx.type == 1 and len(parts) > 2 else \
+                      parts[0] if tx.type != 1 and parts else None
+            elif tx.arena[index] == self._backend_tag:
+                expecting = True
+        return xid, expecting
+
+    def _summarize(self, tx):
+        # Compact summary of a tx: just (tag, message) pairs of a few tags.
+        # Messages are shared with the (released) tx, not copied.
+        return tuple(
+            (tx.arena[index], tx.arena[index + 1])
+            for index in xrange(0, len(tx.arena), 2)
+            if tx.arena[index] in self._correlation_tags)
+
+    def _describe(self, type, summary):
+        return {
+            'type': TRANSACTIONS[type]['name'],
+            'items': [
+                '[%s] %s' % (self._tags[tag], message)
+                for tag, message in summary],
+        }
+
+    def _get_items(self, tx, payload, matches):
+        # Formatted items of a tx according to some payload policy: matched
+        # items are always included, and other items only if allowed by the
+        # policy (unmatched items enabled, tag in the allowlist & below the
+        # maximum number of items). Returns the list of items & the number
+        # of omitted ones.
+        if payload is None:
+            return [
+                self._format_item(tx.arena[index], tx.arena[index + 1])
+                for index in xrange(0, len(tx.arena), 2)], 0
+        matched = set(index for index, filter in matches)
+        tags = payload['tags']
+        max_items = payload['max_items']
+        max_bytes = payload['max_bytes']
+        allowed = payload['unmatched']
+        if max_items is not None:
+            max_items = max(max_items, len(matched))
+        result = []
+        omitted = 0
+        for index in xrange(0, len(tx.arena), 2):
+            tag = tx.arena[index]
+            if index not in matched:
+                if not allowed or \
+                   (tags is not None and tag not in tags) or \
+                   (max_items is not None and
+                    len(result) + len(matched) >= max_items):
+                    omitted += 1
+                    continue
+            else:
+                matched.discard(index)
+            result.append(self._format_item(tag, tx.arena[index + 1], max_bytes))
+        return result, omitted
+
+    def _format_item(self, tag, message, max_bytes=None):
+        # Format an item, optionally truncating its message. Short formatted
+        # items are interned, so repeated items (e.g. common headers) are
+        # formatted once and shared by all events including them.
+        if max_bytes is not None and len(message) > max_bytes:
+            message = message[:max_bytes] + TRUNCATION_MARKER
+        if len(message) > MAX_INTERNED_LENGTH:
+            return '[%s] %s' % (self._tags[tag], message)
+        key = (tag, message)
+        result = self._interned.get(key)
+        if result is None:
+            if len(self._interned) >= MAX_INTERNED_ITEMS:
+                self._interned.clear()
+            result = self._interned[key] = '[%s] %s' % (self._tags[tag], message)
+        return result
 
 
 class Transaction(object):
-    def __init__(self, timestamp, type):
+    # Items are stored raw, as consecutive (integer tag, message) pairs in a
+    # single list. Matches are stored as (arena index, filter) pairs.
+    # Formatting is deferred until the tx is committed, and only matched txs
+    # are ever formatted. When using rules, the state of each predicate (None,
+    # False or the arena index of the matching item) & rule (None, True or
+    # False) is kept too, along with the number of undecided rules.
+    __slots__ = (
+        'timestamp', 'type', 'serial', 'draw', 'arena', 'matches', 'size',
+        'truncated', 'states', 'verdicts', 'alive',
+    )
+
+    def __init__(self):
+        self.arena = []
+        self.matches = []
+        self.reset(None, None, None)
+
+    def reset(self, timestamp, type, serial, draw=None, predicates=0, rules=0):
         self.timestamp = timestamp
         self.type = type
-        self.items = []
-        self.matched_item = None
-        self.matched_items = []
-        self.matched_name = None
-        self.matched_level = None
+        self.serial = serial
+        self.draw = draw
+        self.size = 0
+        self.truncated = 0
+        self.states = [None] * predicates if predicates else None
+        self.verdicts = [None] * rules if rules else None
+        self.alive = rules
+
+    def clear(self):
+        del self.arena[:]
+        del self.matches[:]
+        self.reset(None, None, None)
 
     def add(self, tag, message):
-        self.items.append(self._format_item(tag, message))
-
-    def match(self, tag, message, name, level):
-        # Format item.
-        matched_item = self._format_item(tag, message)
-
-        # Add to the list of matched items.
-        self.matched_items.append('[%(level)s/%(name)s] %(item)s' % {
-            'name': name,
-            'level': level,
-            'item': matched_item,
-        })
-
-        # Set as the main matched item?
-        if self.matched_item is None or \
-           FILTER_LEVELS.index(level) < FILTER_LEVELS.index(self.matched_level):
-            self.matched_item = matched_item
-            self.matched_name = name
-            self.matched_level = level
+        self.arena.append(tag)
+        self.arena.append(message)
+        self.size += len(message)
+
+    def match(self, filter):
+        # Add the last added item to the list of matched items.
+        self.matches.append((len(self.arena) - 2, filter))
 
     @property
     def is_matched(self):
-        return self.matched_item is not None
+        return len(self.matches) > 0
 
-    def _format_item(self, tag, message):
-        return '[%(tag)s] %(message)s' % {
-            'tag': tag,
-            'message': message,
-        }
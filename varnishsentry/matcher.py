@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+import time
+import sre_parse
+import sre_constants
+from varnishsentry import fields
+
+# Max number of cached field filter results per matcher (see
+# Matcher._check_fields()).
+MAX_CACHED_FIELDS = 1024
+
+# Tags supporting header filters (see Header).
+HEADER_TAGS = ('RxHeader', 'TxHeader', 'ObjHeader')
+
+
+class Header(object):
+    # Header filter predicate: holds for headers with some name (case
+    # insensitive) whose value (leading whitespace excluded) matches an
+    # optional regexp. Matchers index these predicates by header name.
+
+    def __init__(self, name, regexp=None):
+        assert \
+            name and ':' not in name, \
+            '"%s" is not a valid header name.' % name
+        self.name = name.strip().lower()
+        self.regexp = regexp
+        self.description = '%s: %s' % (
+            name.strip(), regexp.pattern if regexp is not None else '*')
+
+    def test(self, value):
+        return self.regexp is None or self.regexp.search(value) is not None
+
+    def search(self, message):
+        # Same interface used by regexps.
+        colon = message.find(':')
+        if colon < 0 or message[:colon].lower() != self.name:
+            return None
+        if self.test(message[colon + 1:].lstrip()):
+            return True
+        return None
+
+
+class Matcher(object):
+    def __init__(self, filters):
+        self._filters = filters
+
+        # Field filters (see varnishsentry.fields) are checked apart, against
+        # the typed fields of the message (split just once, and only if some
+        # of them exist).
+        # Header filters are indexed by (lower case) header name, so only
+        # filters of the header found in the message are checked.
+        self._fields = []
+        self._parse = None
+        self._cache = None
+        self._headers = {}
+        regexps = []
+        for index, filter in enumerate(filters):
+            if isinstance(filter['regexp'], fields.Predicate):
+                self._fields.append((index, filter['regexp']))
+            elif isinstance(filter['regexp'], Header):
+                self._headers.setdefault(filter['regexp'].name, []).append(
+                    (index, filter['regexp']))
+            else:
+                regexps.append((index, filter['regexp']))
+        if self._fields:
+            tag = self._fields[0][1].tag
+            self._parse = fields.get_parser(
+                tag, set(predicate.field for index, predicate in self._fields))
+            if len(fields.FIELDS[tag]) == 1:
+                self._cache = {}
+
+        # Extract a required literal (a prefix if possible) from each filter
+        # regexp. Records not containing any of them can be rejected without
+        # running a single regexp. Prefixes are indexed by their first
+        # character.
+        self._prefixes = {}
+        self._substrings = []
+        self._others = []
+        for index, regexp in regexps:
+            literal = _extract_literal(regexp)
+            if literal is None:
+                self._others.append(index)
+            elif literal[1]:
+                self._prefixes.setdefault(literal[0][0], []).append((index, literal[0]))
+            else:
+                self._substrings.append((index, literal[0]))
+
+        # Combine all filter regexps into a single one, so messages can be
+        # rejected scanning them just once.
+        self._regexps = len(regexps) > 0
+        self._regexp = _combine([regexp for index, regexp in regexps])
+
+    def match(self, message):
+        # Select candidate filters using the cheap literal checks.
+        candidates = self._candidates(message) if self._regexps else []
+
+        # Fast rejection?
+        if not candidates:
+            result = candidates
+        elif len(candidates) > 1 and \
+             self._regexp is not None and \
+             self._regexp.search(message) is None:
+            result = []
+
+        # Find out which filters are actually matching (keeping the
+        # configuration order).
+        else:
+            candidates.sort()
+            result = [
+                index for index in candidates
+                if self._filters[index]['regexp'].search(message) is not None]
+
+        # Add matching field & header filters.
+        if self._fields:
+            matches = self._check_fields(message)
+            if matches:
+                result.extend(matches)
+                result.sort()
+        if self._headers:
+            matches = self._check_headers(message)
+            if matches:
+                result.extend(matches)
+                result.sort()
+        return [self._filters[index] for index in result]
+
+    def profile(self, message, clock=time.time):
+        # Same as match(), but running every candidate regexp (and field &
+        # header filter) on its own and accounting evaluations & time spent in
+        # each filter. Much slower, so it should only be used for sampled
+        # messages.
+        result = []
+        candidates = self._candidates(message)
+        candidates.extend(index for index, predicate in self._fields)
+        if self._headers:
+            colon = message.find(':')
+            if colon >= 0:
+                candidates.extend(
+                    index for index, header in
+                    self._headers.get(message[:colon].lower(), ()))
+        candidates.sort()
+        for index in candidates:
+            filter = self._filters[index]
+            started = clock()
+            matched = filter['regexp'].search(message) is not None
+            filter['cost'] += clock() - started
+            filter['evaluations'] += 1
+            if matched:
+                result.append(filter)
+        return result
+
+    def _candidates(self, message):
+        result = list(self._others)
+        for index, prefix in self._prefixes.get(message[:1], ()):
+            if message.startswith(prefix):
+                result.append(index)
+        for index, substring in self._substrings:
+            if substring in message:
+                result.append(index)
+        return result
+
+    def _check_fields(self, message):
+        # Indexes of matching field filters. Results are cached for single
+        # field tags (e.g. statuses), whose messages hardly vary.
+        if self._cache is not None:
+            result = self._cache.get(message)
+            if result is not None:
+                return result
+        values = self._parse(message)
+        if values is None:
+            result = ()
+        else:
+            result = tuple(
+                index for index, predicate in self._fields
+                if predicate.test(values))
+        if self._cache is not None:
+            if len(self._cache) >= MAX_CACHED_FIELDS:
+                self._cache.clear()
+            self._cache[message] = result
+        return result
+
+    def _check_headers(self, message):
+        # Indexes of matching header filters. Messages of other headers are
+        # rejected with a single lookup.
+        colon = message.find(':')
+        if colon < 0:
+            return ()
+        items = self._headers.get(message[:colon].lower())
+        if items is None:
+            return ()
+        value = message[colon + 1:].lstrip()
+        return [index for index, header in items if header.test(value)]
+
+
+def _combine(regexps):
+    # Regexps can be safely combined only if all of them share the same flags
+    # and none of them depends on group numbering.
+    if len(regexps) < 2 or len(set(regexp.flags for regexp in regexps)) > 1:
+        return None
+    for regexp in regexps:
+        try:
+            if _has_group_references(sre_parse.parse(regexp.pattern, regexp.flags)):
+                return None
+        except sre_constants.error:
+            return None
+
+    # Build combined regexp.
+    try:
+        return re.compile(
+            '|'.join('(?:%s)' % regexp.pattern for regexp in regexps),
+            regexps[0].flags)
+    except (sre_constants.error, AssertionError, OverflowError):
+        return None
+
+
+def _has_group_references(value):
+    if isinstance(value, sre_parse.SubPattern):
+        for op, av in value:
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS) or \
+               _has_group_references(av):
+                return True
+    elif isinstance(value, (list, tuple)):
+        return any(_has_group_references(item) for item in value)
+    return False
+
+
+def _extract_literal(regexp):
+    # Literals cannot be extracted from case insensitive regexps.
+    if regexp.flags & re.IGNORECASE:
+        return None
+
+    # Parse regexp.
+    try:
+        parsed = list(sre_parse.parse(regexp.pattern, regexp.flags))
+    except sre_constants.error:
+        return None
+
+    # Is the regexp anchored at the beginning of the message?
+    anchored = \
+        not (regexp.flags & re.MULTILINE) and \
+        bool(parsed) and \
+        parsed[0] == (sre_constants.AT, sre_constants.AT_BEGINNING)
+
+    # Look for the longest run of consecutive top level literals. All of them
+    # must be present in any matching message.
+    best, best_is_prefix = '', False
+    current, current_is_prefix = [], anchored
+    for op, av in parsed[1 if anchored else 0:] + [(None, None)]:
+        if op == sre_constants.LITERAL and av < 256:
+            current.append(chr(av))
+        else:
+            if len(current) > len(best) or \
+               (current and current_is_prefix and len(current) == len(best)):
+                best, best_is_prefix = ''.join(current), current_is_prefix
+            current, current_is_prefix = [], False
+
+    # Done!
+    return (best, best_is_prefix) if best else None
+
+
+def backtracking_risks(regexp):
+    # Static detection of constructions prone to catastrophic backtracking:
+    # nested quantifiers able to split the same input in several ways (e.g.
+    # '(a+)+', '(\w+\s?)*') and quantified alternations whose branches overlap
+    # (e.g. '(\w|\d)+'). Returns a list of human readable descriptions.
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except sre_constants.error:
+        return []
+    result = []
+    _find_backtracking_risks(parsed, result)
+    return result
+
+
+def _find_backtracking_risks(value, result):
+    for op, av in value:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min, max, item = av
+            if max > 1:
+                # Nested variable quantifier overlapping whatever follows it
+                # (wrapping around to the beginning of the outer item)?
+                body = _unwrap(item)
+                for index, (inner_op, inner_av) in enumerate(body):
+                    if inner_op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and \
+                       inner_av[1] > 1 and inner_av[0] != inner_av[1]:
+                        follow, nullable = _first(body[index + 1:])
+                        if nullable:
+                            follow = follow | _first(body)[0]
+                        if _first(inner_av[2])[0] & follow:
+                            result.append('nested quantifiers')
+                            break
+
+                # Quantified alternation with overlapping branches?
+                if len(body) == 1 and body[0][0] == sre_constants.BRANCH:
+                    firsts = [_first(branch)[0] for branch in body[0][1][1]]
+                    for i in range(len(firsts)):
+                        if any(firsts[i] & firsts[j] for j in range(i)):
+                            result.append('quantified alternation with overlapping branches')
+                            break
+            _find_backtracking_risks(item, result)
+        elif op == sre_constants.SUBPATTERN:
+            _find_backtracking_risks(av[-1], result)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                _find_backtracking_risks(branch, result)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _find_backtracking_risks(av[1], result)
+
+
+def _unwrap(value):
+    # Contents of a subpattern, ignoring enclosing groups.
+    items = list(value)
+    while len(items) == 1 and items[0][0] == sre_constants.SUBPATTERN:
+        items = list(items[0][1][-1])
+    return items
+
+
+_ALL = frozenset(range(256))
+
+_CATEGORIES = dict(
+    (category, frozenset(
+        i for i in range(256) if re.match(pattern, chr(i)) is not None))
+    for category, pattern in (
+        (sre_constants.CATEGORY_DIGIT, r'\d'),
+        (sre_constants.CATEGORY_NOT_DIGIT, r'\D'),
+        (sre_constants.CATEGORY_SPACE, r'\s'),
+        (sre_constants.CATEGORY_NOT_SPACE, r'\S'),
+        (sre_constants.CATEGORY_WORD, r'\w'),
+        (sre_constants.CATEGORY_NOT_WORD, r'\W'),
+    ))
+
+
+def _first(value):
+    # Approximate set of characters (as integers) a sequence of items may
+    # start with, and whether it may match the empty string.
+    result = set()
+    for op, av in value:
+        if op == sre_constants.LITERAL:
+            result.add(av)
+        elif op == sre_constants.NOT_LITERAL:
+            result |= _ALL - set([av])
+        elif op == sre_constants.ANY:
+            result |= _ALL
+        elif op == sre_constants.IN:
+            result |= _first_in(av)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            first, nullable = _first(av[2])
+            result |= first
+            if av[0] == 0 or nullable:
+                continue
+        elif op == sre_constants.SUBPATTERN:
+            first, nullable = _first(av[-1])
+            result |= first
+            if nullable:
+                continue
+        elif op == sre_constants.BRANCH:
+            nullable = False
+            for branch in av[1]:
+                first, branch_nullable = _first(branch)
+                result |= first
+                nullable = nullable or branch_nullable
+            if nullable:
+                continue
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            continue
+        else:
+            result |= _ALL
+        return result, False
+    return result, True
+
+
+def _first_in(items):
+    result = set()
+    negate = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            result.add(av)
+        elif op == sre_constants.RANGE:
+            result.update(range(av[0], min(av[1], 255) + 1))
+        elif op == sre_constants.CATEGORY:
+            result |= _CATEGORIES.get(av, _ALL)
+    return (_ALL - result) if negate else result
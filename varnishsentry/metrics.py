@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import os
+import bisect
+import socket
+import threading
+import logging
+
+PREFIX = 'varnishsentry'
+
+# Buckets (in seconds) used for latency histograms.
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return (self.buckets, list(self.counts), self.sum, self.count)
+
+
+def counter(name, value, **labels):
+    return (name, 'counter', labels, value)
+
+
+def gauge(name, value, **labels):
+    return (name, 'gauge', labels, value)
+
+
+def histogram(name, histogram, **labels):
+    return (name, 'histogram', labels, histogram.snapshot())
+
+
+def sender(sender, **labels):
+    return [
+        counter('sent_events_total', sender.sent, **labels),
+        counter('failed_events_total', sender.failed, **labels),
+        counter('dropped_events_total', sender.dropped, **labels),
+        counter('aggregated_events_total', sender.aggregated, **labels),
+        gauge('queued_events', sender.size, **labels),
+    ] + [
+        counter('shed_events_total', count, level=level, **labels)
+        for level, count in sorted(sender.shed.iteritems())
+    ]
+
+
+def render(snapshots):
+    # Render samples published by all processes ({process: [sample, ...]})
+    # using the Prometheus text exposition format. Samples are labeled with
+    # the publishing process and, unless they already refer to some worker
+    # (e.g. samples of shared readers), with it as worker too.
+    metrics = {}
+    for process, samples in sorted(snapshots.iteritems()):
+        for name, kind, labels, value in samples:
+            labels = dict(labels, process=process)
+            labels.setdefault('worker', process)
+            metrics.setdefault((name, kind), []).append((labels, value))
+
+    lines = []
+    for (name, kind), samples in sorted(metrics.iteritems()):
+        name = '%s_%s' % (PREFIX, name)
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            if kind == 'histogram':
+                buckets, counts, sum, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _labels(labels, le=bound), cumulative))
+                lines.append('%s_sum%s %f' % (name, _labels(labels), sum))
+                lines.append('%s_count%s %d' % (name, _labels(labels), count))
+            else:
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.iteritems()))
+
+
+class Exporter(object):
+    # Keeps the latest samples published by each worker, exposing them in a
+    # file and / or a UNIX socket.
+
+    def __init__(self, path=None, socket_path=None):
+        self._path = path
+        self._socket_path = socket_path
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._socket = None
+        self._thread = None
+
+    def start(self):
+        if self._socket_path is not None:
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.bind(self._socket_path)
+            self._socket.listen(8)
+            self._thread = threading.Thread(target=self._serve)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+
+    def update(self, worker, samples):
+        with self._lock:
+            self._snapshots[worker] = samples
+
+    def export(self):
+        # Atomically replace the metrics file.
+        if self._path is not None:
+            tmp = '%s.tmp' % self._path
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp, self._path)
+
+    def render(self):
+        with self._lock:
+            return render(self._snapshots)
+
+    def _serve(self):
+        while self._socket is not None:
+            try:
+                connection, address = self._socket.accept()
+            except Exception:
+                break
+            try:
+                connection.sendall(self.render())
+            except Exception:
+                logging.getLogger('varnishsentry').error(
+                    'Got unexpected exception while serving metrics.',
+                    exc_info=True)
+            finally:
+                connection.close()
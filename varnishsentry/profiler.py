@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import os
+import gc
+import sys
+import time
+import threading
+import logging
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_DURATION = 30
+
+DEFAULT_INTERVAL = 0.01
+
+DEFAULT_PATH = '/tmp/varnishsentry.%(worker)s.%(pid)d.%(timestamp)d'
+
+TOP_ALLOCATIONS = 50
+
+
+class Profiler(threading.Thread):
+    # Sampling profiler: the stacks of some threads are periodically captured
+    # (using sys._current_frames()) during some time. Results are written
+    # using the collapsed stacks format (i.e. 'frame;frame;frame count'
+    # lines), as expected by flamegraph.pl & friends. Top allocations (or top
+    # object types if tracemalloc is not available) are written too.
+
+    def __init__(self, path, duration=DEFAULT_DURATION, interval=DEFAULT_INTERVAL,
+                 threads=None):
+        super(Profiler, self).__init__(name='profiler')
+        self.daemon = True
+        self._path = path
+        self._duration = duration
+        self._interval = interval
+        self._threads = threads
+        self._labels = {}
+
+    def run(self):
+        try:
+            # Start tracing allocations?
+            tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+
+            # Sample stacks.
+            stacks = {}
+            samples = 0
+            deadline = time.time() + self._duration
+            while time.time() < deadline:
+                frames = sys._current_frames()
+                if self._threads is None:
+                    idents = [
+                        ident for ident in frames
+                        if ident != threading.current_thread().ident]
+                else:
+                    idents = [thread.ident for thread in self._threads]
+                for ident in idents:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = self._collapse(frame)
+                        stacks[stack] = stacks.get(stack, 0) + 1
+                del frames
+                samples += 1
+                time.sleep(self._interval)
+
+            # Write stacks.
+            with open(self._path + '.folded', 'w') as f:
+                for stack, count in sorted(stacks.iteritems()):
+                    f.write('%s %d\n' % (stack, count))
+
+            # Write top allocations.
+            with open(self._path + '.allocations', 'w') as f:
+                if tracemalloc is not None:
+                    snapshot = tracemalloc.take_snapshot()
+                    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                        f.write('%s\n' % stat)
+                    if tracing:
+                        tracemalloc.stop()
+                else:
+                    counts = {}
+                    for item in gc.get_objects():
+                        name = type(item).__name__
+                        counts[name] = counts.get(name, 0) + 1
+                    f.write('# tracemalloc not available: top object types.\n')
+                    for name, count in sorted(
+                            counts.iteritems(), key=lambda item: item[1],
+                            reverse=True)[:TOP_ALLOCATIONS]:
+                        f.write('%s %d\n' % (name, count))
+
+            # Log.
+            logging.getLogger('varnishsentry').info(
+                'Profile done (%d samples). Results written to %s.*',
+                samples, self._path)
+        except Exception:
+            logging.getLogger('varnishsentry').error(
+                'Got unexpected exception while profiling.',
+                exc_info=True)
+
+    def _collapse(self, frame):
+        result = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = '%s (%s:%d)' % (
+                    code.co_name,
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno)
+            result.append(label)
+            frame = frame.f_back
+        result.reverse()
+        return ';'.join(result)
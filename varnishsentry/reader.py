@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import logging
+import threading
+from Queue import Empty, Full
+from varnishsentry import metrics
+from varnishsentry.consumer import Consumer
+from varnishsentry.sender import Sender, build_client
+from varnishsentry.worker import Worker
+
+# Max. time (in seconds) waiting for room in a delivery queue before checking
+# whether the forwarder is stopping.
+FORWARD_TIMEOUT = 1.0
+
+
+class Reader(Consumer):
+    # Shared reader: reads the shared memory log of some Varnish instance
+    # once, assembling txs and matching them against the filters of all
+    # workers using that instance. Matched txs are handed over to the
+    # corresponding Deliverer processes.
+
+    def _get_workers(self):
+        return self._config['workers']
+
+    def _init_delivery(self):
+        # Matched events are handed over to a forwarder per worker, so they
+        # are shed by level (just as the outbound queues of deliverers do)
+        # before reaching the inter-process delivery queues. Workers without
+        # DSN have no deliverer (and no queue).
+        self._senders = {}
+        self._dropped = {}
+        for worker, queue in self._config['queues'].iteritems():
+            self._senders[worker] = Forwarder(
+                queue, self._workers[worker].get('delivery', {}))
+            self._senders[worker].start()
+            self._dropped[worker] = 0
+
+    def _metrics_delivery(self):
+        result = []
+        for worker, sender in self._senders.iteritems():
+            result.append(metrics.counter(
+                'dropped_events_total', sender.dropped, worker=worker))
+            result.append(metrics.gauge(
+                'queued_events', sender.size, worker=worker))
+            result.extend(
+                metrics.counter('shed_events_total', count, level=level, worker=worker)
+                for level, count in sorted(sender.shed.iteritems()))
+        return result
+
+    def _get_backlog(self, worker):
+        # Events queued by the forwarder, and (if known) waiting in the
+        # delivery queue.
+        sender = self._senders.get(worker)
+        if sender is None:
+            return 0
+        try:
+            return sender.size + sender.queue.qsize()
+        except NotImplementedError:
+            return sender.size
+
+
+class Forwarder(Sender):
+    # Outbound queue of a shared reader for some worker: matched events are
+    # queued in per-level lanes (shedding the lowest levels first once the
+    # high watermark is reached), and a single thread moves them, highest
+    # levels first, to the delivery queue of the worker's deliverer,
+    # waiting while it's full. Events are moved one by one, so the thread
+    # never holds lower level events while higher level ones are waiting.
+
+    def __init__(self, queue, config):
+        super(Forwarder, self).__init__(None, dict(config, threads=1, batch=1))
+        self.queue = queue
+
+    def _deliver(self, batch, stop=False):
+        # Move events to the delivery queue. When stopping, events not
+        # fitting in the queue are dropped.
+        delivered = 0
+        for event in batch:
+            while True:
+                try:
+                    self.queue.put(event, self._running, FORWARD_TIMEOUT)
+                    delivered += 1
+                    break
+                except Full:
+                    if not self._running:
+                        self.dropped += 1
+                        break
+        self.sent += delivered
+        return delivered
+
+
+class Deliverer(Worker):
+    # Delivers to Sentry events matched by some shared reader on behalf of a
+    # worker. It runs as a separate process, so the worker's user & group are
+    # still honored.
+
+    def _init(self):
+        # Base initializations.
+        self._delivering = True
+        self._dropped = 0
+
+        # Initialize Sentry client & outbound queue.
+        self._sender = Sender(
+            build_client(self._config),
+            self._config.get('delivery', {}),
+            self._config.get('aggregation'),
+            self._config.get('spool'))
+        self._sender.start()
+
+        # Launch delivery thread.
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _poll(self):
+        # Is the delivery thread still alive?
+        if not self._thread.is_alive():
+            raise Exception('Delivery thread has been unexpectedly stopped.')
+
+        # Have new events been dropped by the outbound queue?
+        if self._sender.dropped > self._dropped:
+            logging.getLogger('varnishsentry').warning(
+                'Outbound queue is full. %d events dropped so far.',
+                self._sender.dropped)
+            self._dropped = self._sender.dropped
+
+    def _shutdown(self):
+        # If running, stop the delivery thread and flush pending events.
+        if getattr(self, '_delivering', False):
+            self._delivering = False
+            self._thread.join(2.0)
+            self._sender.stop()
+
+    def _metrics(self):
+        return metrics.sender(self._sender)
+
+    def _loop(self):
+        while self._delivering:
+            try:
+                self._sender.put(self._config['queue'].get(True, 1.0))
+            except Empty:
+                pass
+            except Exception:
+                logging.getLogger('varnishsentry').error(
+                    'Got unexpected exception while fetching matched event.',
+                    exc_info=True)
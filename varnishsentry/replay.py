@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import os
+import sys
+import time
+import json
+import mmap
+import struct
+import ctypes
+import logging
+import multiprocessing
+from varnishsentry import api
+from varnishsentry.consumer import Consumer
+from varnishsentry.sender import DEFAULT_LOW_WATERMARK
+
+# Varnish 3.0 tags, indexed by integer tag. Only used when libvarnishapi is
+# not available.
+DEFAULT_TAGS = (
+    None, 'Debug', 'Error', 'CLI', 'StatSess', 'ReqEnd', 'SessionOpen',
+    'SessionClose', 'BackendOpen', 'BackendXID', 'BackendReuse', 'BackendClose',
+    'HttpGarbage', 'Backend', 'Length', 'FetchError', 'RxRequest', 'RxResponse',
+    'RxStatus', 'RxURL', 'RxProtocol', 'RxHeader', 'TxRequest', 'TxResponse',
+    'TxStatus', 'TxURL', 'TxProtocol', 'TxHeader', 'ObjRequest', 'ObjResponse',
+    'ObjStatus', 'ObjURL', 'ObjProtocol', 'ObjHeader', 'LostHeader', 'TTL',
+    'Fetch_Body', 'VCL_acl', 'VCL_call', 'VCL_trace', 'VCL_return', 'VCL_error',
+    'ReqStart', 'Hit', 'HitPass', 'ExpBan', 'ExpKill', 'WorkThread',
+    'ESI_xmlerror', 'Hash', 'Backend_health', 'VCL_Log', 'Gzip',
+)
+
+# Record header in 'varnishlog -w' files: tag & length (highest 8 bits and
+# lowest 16 bits of the first word), and fd. Payloads are padded to 4 bytes.
+HEADER = struct.Struct('=II')
+
+CLIENT_SPEC_TAGS = ('SessionOpen', 'ReqStart')
+
+BACKEND_SPEC_TAGS = ('BackendOpen', 'BackendXID')
+
+# Delay (in seconds) while waiting for busy Sentry senders.
+WAIT_INTERVAL = 0.01
+
+# Replay context (workers, sink, etc.) shared with pool processes.
+_context = None
+
+
+class LogTags(object):
+    # Minimal replacement of api.VarnishTags based on a static tag table.
+
+    def __init__(self, tags=DEFAULT_TAGS):
+        self.VSL_tags = list(tags) + [None] * (256 - len(tags))
+        self._ids = dict(
+            (tag.lower(), id) for id, tag in enumerate(self.VSL_tags) if tag)
+
+    def VSL_Name2Tag(self, name):
+        return self._ids.get(name.lower(), -1)
+
+    def VSL_NameNormalize(self, name):
+        id = self.VSL_Name2Tag(name)
+        if id >= 0:
+            return self.VSL_tags[id]
+        return ''
+
+
+class LogFile(object):
+    # Reader of binary files written by 'varnishlog -w'. The file is mapped
+    # in memory, so payloads are handed over to VSL-like callbacks as raw
+    # pointers, without copying them. Client & backend records are told apart
+    # just as libvarnishapi does.
+
+    def __init__(self, path, tags):
+        self._path = path
+        self._client = set(tags.index(tag) for tag in CLIENT_SPEC_TAGS)
+        self._backend = set(tags.index(tag) for tag in BACKEND_SPEC_TAGS)
+
+    def dispatch(self, callback):
+        with open(self._path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                return 0
+            buffer = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+        try:
+            address = ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+            specs = {}
+            offset = 0
+            count = 0
+            while offset + HEADER.size <= size:
+                word, fd = HEADER.unpack_from(buffer, offset)
+                tag = word >> 24
+                length = word & 0xffff
+                if offset + HEADER.size + length > size:
+                    logging.getLogger('varnishsentry').warning(
+                        'Ignoring truncated record at the end of %s.', self._path)
+                    break
+
+                # Update client & backend fds.
+                if tag in self._client:
+                    specs[fd] = 1
+                elif tag in self._backend:
+                    specs[fd] = 2
+
+                # Process record.
+                count += 1
+                if callback(
+                        None, tag, fd, length, specs.get(fd, 0),
+                        address + offset + HEADER.size, 0):
+                    break
+                offset += HEADER.size + ((length + 3) & ~3)
+            return count
+        finally:
+            buffer.close()
+
+    def find(self, tag):
+        # Payload of the first record of some tag (None if not found).
+        result = []
+
+        def callback(priv, id, fd, length, spec, ptr, bm):
+            if id == tag:
+                result.append(ctypes.string_at(ptr, length))
+                return 1
+
+        self.dispatch(callback)
+        return result[0] if result else None
+
+
+class Replayer(Consumer):
+    # Runs the tx assembly & matching pipeline of all selected workers over
+    # 'varnishlog -w' files. Matched txs are delivered to Sentry or written to
+    # a JSONL sink. The wall clock is replaced by the log's own clock (the
+    # end timestamp of the last ReqEnd record), so txs are timestamped and
+    # expired as they were originally.
+
+    def _get_workers(self):
+        return self._config['workers']
+
+    def _get_clock(self):
+        self._log_time = 0.0
+        return lambda: self._log_time
+
+    def _connect(self):
+        try:
+            return api.VarnishTags(
+                sopath=self._get_config('libvarnishapi', 'libvarnishapi.so.1'))
+        except OSError:
+            return LogTags()
+
+    def _init_delivery(self):
+        self._events = 0
+        self._errors = 0
+        self._failures = 0
+        self._sink = self._config.get('sink')
+        if self._sink is None:
+            super(Replayer, self)._init_delivery()
+        else:
+            self._senders = {}
+
+    def _shutdown_delivery(self):
+        # Replay is not time-sensitive: wait for senders to deliver every
+        # queued event. Events not accepted by Sentry (or dropped) are
+        # counted as errors.
+        for sender in self._senders.itervalues():
+            sender.stop(timeout=None)
+            self._errors += sender.failed + sender.dropped
+
+    def _deliver(self, worker, event):
+        # Failures are handled per event, so a single bad event doesn't stop
+        # the replay.
+        self._events += 1
+        try:
+            if self._sink is not None:
+                self._sink.write(event)
+            else:
+                # Replay is not time-sensitive: wait for the sender instead of
+                # dropping events.
+                sender = self._senders.get(worker)
+                if sender is not None:
+                    limit = self._workers[worker].get('delivery', {}).get(
+                        'low_watermark', DEFAULT_LOW_WATERMARK)
+                    while sender.size >= limit:
+                        time.sleep(WAIT_INTERVAL)
+                    sender.put(event)
+        except Exception:
+            self._errors += 1
+            logging.getLogger('varnishsentry').error(
+                'Got unexpected exception while delivering replayed event.',
+                exc_info=True)
+
+    def _loop(self):
+        self._consuming = True
+        reqend = self._tags.index(self._vap.VSL_NameNormalize('ReqEnd'))
+
+        def callback(priv, tag, fd, length, spec, ptr, bm):
+            # Advance the log clock (it never goes back), and timestamp the
+            # ending tx using its own start timestamp.
+            if tag == reqend:
+                start = self._advance_clock(ctypes.string_at(ptr, length))
+                tx = self._buffers.get(spec, {}).get(fd)
+                if tx is not None and start is not None:
+                    tx.timestamp = int(start)
+            return self._vap_callBack(priv, tag, fd, length, spec, ptr, bm)
+
+        try:
+            for path in self._config['files']:
+                try:
+                    # Start the clock before the first tx.
+                    log = LogFile(path, self._tags)
+                    message = log.find(reqend)
+                    if message is not None:
+                        self._advance_clock(message)
+                    log.dispatch(callback)
+                except Exception:
+                    self._failures += 1
+                    logging.getLogger('varnishsentry').error(
+                        'Got unexpected exception while replaying VSL file %s.',
+                        path, exc_info=True)
+        finally:
+            # Any tx still buffered is incomplete.
+            self._purge_buffers(sys.maxint)
+            self._consuming = False
+
+    def _advance_clock(self, message):
+        # Advance the clock to the end timestamp of a ReqEnd record (third
+        # field). Returns its start timestamp (None if malformed).
+        fields = message.split(None, 3)
+        try:
+            start, end = float(fields[1]), float(fields[2])
+        except (IndexError, ValueError):
+            return None
+        self._log_time = max(self._log_time, end)
+        return start
+
+    def replay(self):
+        # Replay synchronously, in the calling process.
+        self._init()
+        self._thread.join()
+        self._shutdown_delivery()
+        if self._profile_filters:
+            self._dump_filter_stats()
+        return {
+            'records': self._records,
+            'transactions': sum(self._opened.itervalues()),
+            'timeouts': sum(self._timed_out.itervalues()),
+            'evictions': self._evictions,
+            'events': self._events,
+            'errors': self._errors,
+            'failures': self._failures,
+        }
+
+
+class Sink(object):
+    # JSONL output, shared by several processes. Each event is written using
+    # a single append.
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = multiprocessing.Lock()
+        self._fd = None
+
+    def write(self, event):
+        if self._fd is None:
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            line = json.dumps(event, sort_keys=True)
+        except UnicodeDecodeError:
+            # VSL payloads are not necessarily UTF-8.
+            line = json.dumps(_decode(event), sort_keys=True)
+        with self._lock:
+            os.write(self._fd, line + '\n')
+
+
+def _decode(value):
+    # Copy of some JSON-like value where byte strings are decoded as UTF-8,
+    # replacing invalid sequences.
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    elif isinstance(value, dict):
+        return dict((_decode(key), _decode(item)) for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return [_decode(item) for item in value]
+    return value
+
+
+def replay(files, workers, output=None, processes=None):
+    # Replay files using a pool of processes (one file per process at a
+    # time). Returns the aggregated stats.
+    global _context
+    _context = {
+        'workers': workers,
+        'sink': Sink(output) if output is not None else None,
+    }
+    processes = min(processes or multiprocessing.cpu_count(), len(files))
+    pool = multiprocessing.Pool(processes)
+    try:
+        result = {}
+        for stats in pool.imap_unordered(_replay, files):
+            for key, value in stats.iteritems():
+                result[key] = result.get(key, 0) + value
+        return result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _replay(path):
+    return Replayer(
+        None, None, None, 'replay:%s' % os.path.basename(path),
+        dict(_context, files=[path]), False).replay()
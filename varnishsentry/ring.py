@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import ctypes
+import struct
+import multiprocessing
+
+DEFAULT_SIZE = 8 * 1024 * 1024
+
+# Record header: spec, tag, fd & payload length. Records are 8 bytes aligned.
+HEADER = struct.Struct('=IIII')
+
+# Tag value used to mark the end of the used space before wrapping around.
+WRAP_TAG = 0xffffffff
+
+
+class Ring(object):
+    # Single producer / single consumer ring buffer of VSL records living in
+    # shared memory. It must be created before forking producer & consumer
+    # processes. Head & tail are ever increasing byte counters, and each one
+    # is written by a single process only. The producer publishes a record
+    # updating the head once the record has been fully written.
+
+    def __init__(self, size=DEFAULT_SIZE):
+        assert \
+            size % 8 == 0 and size > 0xffff + HEADER.size, \
+            'Ring size must be a multiple of 8 able to hold any VSL record.'
+        self._size = size
+        self._buffer = multiprocessing.RawArray(ctypes.c_char, size)
+        self._head = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._tail = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._address = ctypes.addressof(self._buffer)
+
+    def put(self, spec, tag, fd, ptr, length):
+        head = self._head.value
+        offset = head % self._size
+        size = (HEADER.size + length + 7) & ~7
+
+        # Not enough room at the end of the buffer? => wrap around.
+        padding = self._size - offset if offset + size > self._size else 0
+
+        # Is the ring full?
+        if head + padding + size - self._tail.value > self._size:
+            return False
+
+        # Mark the wrap around.
+        if padding:
+            if padding >= HEADER.size:
+                HEADER.pack_into(self._buffer, offset, 0, WRAP_TAG, 0, 0)
+            head += padding
+            offset = 0
+
+        # Write the record & publish it.
+        HEADER.pack_into(self._buffer, offset, spec, tag, fd, length)
+        ctypes.memmove(self._address + offset + HEADER.size, ptr, length)
+        self._head.value = head + size
+        return True
+
+    def consume(self, callback, limit=1024):
+        # Feed available records to a VSL-like callback. The payload pointer
+        # is only valid during the callback execution.
+        head = self._head.value
+        tail = self._tail.value
+        count = 0
+        while tail < head and count < limit:
+            offset = tail % self._size
+
+            # Wrapped around?
+            if self._size - offset < HEADER.size:
+                tail += self._size - offset
+                continue
+            spec, tag, fd, length = HEADER.unpack_from(self._buffer, offset)
+            if tag == WRAP_TAG:
+                tail += self._size - offset
+                continue
+
+            # Process record.
+            callback(None, tag, fd, length, spec, self._address + offset + HEADER.size, 0)
+            tail += (HEADER.size + length + 7) & ~7
+            count += 1
+
+        # Release consumed space.
+        self._tail.value = tail
+        return count
+
+    @property
+    def used(self):
+        return self._head.value - self._tail.value
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import re
+from varnishsentry import fields
+
+# Rule expressions combine predicates using 'and', 'or', 'not' & parentheses.
+# A predicate ('Tag ~ "regexp"') holds once some record of that tag in the tx
+# matches the regexp. Backslashes in regexps are kept as they are, except
+# when escaping double quotes. Tags with typed fields (see
+# varnishsentry.fields) also support numeric predicates ('Tag.field > 2',
+# using >, >=, <, <=, == or !=, and 'Tag.field in (500, 503)'). E.g.:
+#
+#   TxStatus ~ "^5" and RxURL ~ "^/api" and not VCL_Log ~ "\[EXPECTED\]"
+#   ReqEnd.total > 2.5 and not TxStatus.status in (301, 302)
+#
+TOKENS = re.compile(r'''
+    \s*(?:
+        (?P<open>\() |
+        (?P<close>\)) |
+        (?P<tilde>~) |
+        (?P<dot>\.) |
+        (?P<comma>,) |
+        (?P<comparison>>=|<=|==|!=|>|<) |
+        "(?P<string>(?:[^"\\]|\\.)*)" |
+        (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?) |
+        (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    )''', re.VERBOSE)
+
+COMPARISONS = {
+    '>': 'gt',
+    '>=': 'ge',
+    '<': 'lt',
+    '<=': 'le',
+    '==': 'eq',
+    '!=': 'ne',
+}
+
+PREDICATE = 0
+
+NOT = 1
+
+AND = 2
+
+OR = 3
+
+# Tags logged at most once per tx. Predicates on these tags are decided (true
+# or false) as soon as their record is found, instead of at the end of the tx.
+SINGLE_TAGS = (
+    'ReqStart', 'ReqEnd', 'BackendXID', 'Length',
+    'RxRequest', 'RxURL', 'RxProtocol', 'RxStatus', 'RxResponse',
+    'TxRequest', 'TxURL', 'TxProtocol', 'TxStatus', 'TxResponse',
+)
+
+
+def parse(expression):
+    # Parse an expression. Returns the expression tree & the list of
+    # predicates, as (tag, regexp) pairs (field predicates are used instead
+    # of regexps for numeric predicates). Tree nodes are (PREDICATE, index),
+    # (NOT, node), (AND, nodes) & (OR, nodes) tuples.
+    tokens = _tokenize(expression)
+    predicates = []
+    tree, position = _parse_or(tokens, 0, predicates)
+    assert \
+        position == len(tokens), \
+        'Unexpected "%s" in rule expression "%s".' % (tokens[position][1], expression)
+    return tree, predicates
+
+
+def evaluate(node, states, offset=0, final=False):
+    # Three-valued evaluation of an expression tree, given the states of its
+    # predicates (stored from some offset): None (unknown yet), False or
+    # the arena index of the matching item. Unknown predicates are false once
+    # the tx is over (i.e. final evaluation). Returns True, False or None.
+    kind = node[0]
+    if kind == PREDICATE:
+        state = states[offset + node[1]]
+        if state is None:
+            return False if final else None
+        return state is not False
+    elif kind == NOT:
+        value = evaluate(node[1], states, offset, final)
+        return None if value is None else not value
+    else:
+        result = kind == AND
+        for child in node[1]:
+            value = evaluate(child, states, offset, final)
+            if value is None:
+                result = None
+            elif value != (kind == AND):
+                return value
+        return result
+
+
+def _tokenize(expression):
+    result = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        assert \
+            match is not None, \
+            'Invalid rule expression "%s" at position %d.' % (expression, position)
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = value.replace('\\"', '"')
+        elif kind == 'number':
+            value = float(value)
+        elif kind == 'word' and value.lower() in ('and', 'or', 'not', 'in'):
+            kind = value.lower()
+        result.append((kind, value))
+        position = match.end()
+    return result
+
+
+def _parse_or(tokens, position, predicates):
+    return _parse_operator(tokens, position, predicates, 'or', OR, _parse_and)
+
+
+def _parse_and(tokens, position, predicates):
+    return _parse_operator(tokens, position, predicates, 'and', AND, _parse_not)
+
+
+def _parse_operator(tokens, position, predicates, keyword, kind, parse):
+    nodes = []
+    while True:
+        node, position = parse(tokens, position, predicates)
+        nodes.append(node)
+        if position < len(tokens) and tokens[position][0] == keyword:
+            position += 1
+        else:
+            break
+    return (nodes[0] if len(nodes) == 1 else (kind, tuple(nodes))), position
+
+
+def _parse_not(tokens, position, predicates):
+    if position < len(tokens) and tokens[position][0] == 'not':
+        node, position = _parse_not(tokens, position + 1, predicates)
+        return (NOT, node), position
+    return _parse_atom(tokens, position, predicates)
+
+
+def _parse_atom(tokens, position, predicates):
+    assert \
+        position < len(tokens), \
+        'Unexpected end of rule expression.'
+    kind, value = tokens[position]
+    if kind == 'open':
+        node, position = _parse_or(tokens, position + 1, predicates)
+        assert \
+            position < len(tokens) and tokens[position][0] == 'close', \
+            'Missing ")" in rule expression.'
+        return node, position + 1
+    assert \
+        kind == 'word' and position + 2 < len(tokens), \
+        'Expected a predicate in rule expression, found "%s".' % value
+    if tokens[position + 1][0] == 'dot':
+        return _parse_field(tokens, position, predicates)
+    assert \
+        tokens[position + 1][0] == 'tilde' and \
+        tokens[position + 2][0] == 'string', \
+        'Expected \'Tag ~ "regexp"\' in rule expression, found "%s".' % value
+    predicates.append((value, re.compile(tokens[position + 2][1])))
+    return (PREDICATE, len(predicates) - 1), position + 3
+
+
+def _parse_field(tokens, position, predicates):
+    # 'Tag.field <comparison> number' or 'Tag.field in (number, ...)'.
+    tag = tokens[position][1]
+    assert \
+        position + 4 < len(tokens) and \
+        tokens[position + 2][0] == 'word', \
+        'Expected \'Tag.field\' in rule expression, found "%s".' % tag
+    field = tokens[position + 2][1]
+    kind, value = tokens[position + 3]
+    if kind == 'comparison':
+        assert \
+            tokens[position + 4][0] == 'number', \
+            'Expected a number after "%s.%s %s" in rule expression.' % (tag, field, value)
+        condition = (COMPARISONS[value], tokens[position + 4][1])
+        position += 5
+    else:
+        assert \
+            kind == 'in' and tokens[position + 4][0] == 'open', \
+            'Expected a comparison after "%s.%s" in rule expression.' % (tag, field)
+        values = []
+        position += 5
+        while True:
+            assert \
+                position + 1 < len(tokens) and \
+                tokens[position][0] == 'number' and \
+                tokens[position + 1][0] in ('comma', 'close'), \
+                'Expected \'(number, ...)\' after "%s.%s in" in rule expression.' % (tag, field)
+            values.append(tokens[position][1])
+            position += 2
+            if tokens[position - 1][0] == 'close':
+                break
+        condition = ('in', values)
+    predicates.append((tag, fields.Predicate(tag, field, [condition])))
+    return (PREDICATE, len(predicates) - 1), position
@@ -7,8 +7,12 @@
 from __future__ import absolute_import
 import os
 import sys
+import time
+import json
+import logging
 from optparse import OptionParser
 from varnishsentry.conf import settings
+from varnishsentry import replay
 from varnishsentry.runner import daemon
 
 
@@ -42,6 +46,160 @@ def _status(args, parser):
     daemon.Daemon().status()
 
 
+def _replay(args, parser):
+    # Initialize.
+    parser.add_option(
+        '', '--workers', dest='workers', default=None,
+        help='comma separated list of workers to replay (defaults to all)',
+        metavar='WORKERS')
+    parser.add_option(
+        '', '--output', dest='output', default=None,
+        help='append matched txs to a JSONL file instead of submitting them '
+             'to Sentry',
+        metavar='FILE')
+    parser.add_option(
+        '', '--processes', dest='processes', type='int', default=None,
+        help='number of replaying processes (defaults to number of CPUs)',
+        metavar='N')
+    parser.add_option(
+        '', '--debug', action='store_true', dest='debug', default=False,
+        help='replay in debug mode')
+    options, files = _init(args, parser, positional=True)
+    if not files:
+        parser.error('at least one varnishlog -w file is required')
+
+    # Select workers.
+    workers = _get_workers(options, parser)
+
+    # Log to the console.
+    logger = logging.getLogger('varnishsentry')
+    logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)s: %(levelname)s %(message)s',
+        '%b %e %H:%M:%S'))
+    logger.addHandler(handler)
+
+    # Replay.
+    start = time.time()
+    stats = replay.replay(
+        files, workers, output=options.output, processes=options.processes)
+    elapsed = time.time() - start
+    sys.stdout.write(
+        'Replayed %(records)d records (%(rate)d records/sec): %(transactions)d '
+        'txs, %(timeouts)d incomplete txs, %(evictions)d evicted txs & '
+        '%(events)d matched events (%(errors)d failed events, %(failures)d '
+        'failed files).\n' % dict(
+            stats, rate=stats['records'] / elapsed if elapsed > 0 else 0))
+    if stats['errors'] or stats['failures']:
+        sys.exit(1)
+
+
+def _bench(args, parser):
+    # Initialize.
+    from varnishsentry.bench import run, run_shards, generator
+    from varnishsentry.ring import DEFAULT_SIZE as DEFAULT_RING_SIZE
+    for name, type, default, help in (
+            ('seed', 'int', generator.DEFAULT_SEED, 'random seed'),
+            ('transactions', 'int', generator.DEFAULT_TRANSACTIONS, 'number of txs'),
+            ('backend-ratio', 'float', generator.DEFAULT_BACKEND_RATIO, 'ratio of backend txs'),
+            ('headers', 'int', generator.DEFAULT_HEADERS, 'headers per request / response'),
+            ('concurrency', 'int', generator.DEFAULT_CONCURRENCY, 'interleaved txs'),
+            ('match-rate', 'float', generator.DEFAULT_MATCH_RATE, 'ratio of matching client txs')):
+        parser.add_option(
+            '', '--' + name, dest=name.replace('-', '_'), type=type, default=default,
+            help='%s (defaults to %s)' % (help, default))
+    parser.add_option(
+        '', '--full-context', action='store_true', dest='full_context', default=False,
+        help='read all tags')
+    parser.add_option(
+        '', '--use-workers', action='store_true', dest='use_workers', default=False,
+        help='use filters of configured workers instead of the sample ones')
+    parser.add_option(
+        '', '--baseline', action='store_true', dest='baseline', default=False,
+        help='dispatch records as done before the dispatch table, for comparison')
+    parser.add_option(
+        '', '--shards', dest='shards', default=None,
+        help='comma separated list of shard counts to benchmark sharded tx assembly with',
+        metavar='N,...')
+    parser.add_option(
+        '', '--ring-size', dest='ring_size', type='int', default=DEFAULT_RING_SIZE,
+        help='ring buffer size of each shard, in bytes (defaults to %d)' % DEFAULT_RING_SIZE,
+        metavar='BYTES')
+    options = _init(args, parser)
+
+    # Sharded mode?
+    if options.shards is not None:
+        try:
+            shards = [int(count) for count in options.shards.split(',')]
+        except ValueError:
+            shards = []
+        if not shards or min(shards) < 1:
+            parser.error('shard counts must be positive integers')
+        result = run_shards(
+            shards,
+            workers=settings.WORKERS if options.use_workers else None,
+            full_context=options.full_context,
+            ring_size=options.ring_size,
+            seed=options.seed,
+            transactions=options.transactions,
+            backend_ratio=options.backend_ratio,
+            headers=options.headers,
+            concurrency=options.concurrency,
+            match_rate=options.match_rate)
+        sys.stdout.write(json.dumps(result, indent=4, sort_keys=True) + '\n')
+        return
+
+    # Run benchmark & dump results.
+    result = run(
+        workers=settings.WORKERS if options.use_workers else None,
+        full_context=options.full_context,
+        baseline=options.baseline,
+        seed=options.seed,
+        transactions=options.transactions,
+        backend_ratio=options.backend_ratio,
+        headers=options.headers,
+        concurrency=options.concurrency,
+        match_rate=options.match_rate)
+    sys.stdout.write(json.dumps(result, indent=4, sort_keys=True) + '\n')
+
+
+def _check_filters(args, parser):
+    # Initialize.
+    from varnishsentry import checker
+    parser.add_option(
+        '', '--workers', dest='workers', default=None,
+        help='comma separated list of workers to check (defaults to all)',
+        metavar='WORKERS')
+    parser.add_option(
+        '', '--limit', dest='limit', type='int', default=checker.DEFAULT_LIMIT,
+        help='maximum number of corpus messages per tag (defaults to %d)' %
+             checker.DEFAULT_LIMIT,
+        metavar='N')
+    options, files = _init(args, parser, positional=True)
+    workers = _get_workers(options, parser)
+
+    # Check filters & dump results.
+    failed = False
+    for report in checker.check(workers, files, limit=options.limit):
+        failed = failed or bool(report['risks']) or report['slow']
+        sys.stdout.write(
+            '%(status)s %(worker)s / %(tag)s / %(name)s: %(regexp)r\n'
+            '    %(evaluations)d evaluations, %(matches)d matches, '
+            '%(mean).2f us/evaluation, %(slowest).2f us slowest evaluation\n' % dict(
+                report,
+                status='[!!]' if report['risks'] or report['slow'] else '[ok]',
+                mean=report['seconds'] * 1e6 / max(report['evaluations'], 1),
+                slowest=report['slowest'] * 1e6))
+        for risk in report['risks']:
+            sys.stdout.write('    Possible catastrophic backtracking: %s.\n' % risk)
+        if report['slow']:
+            sys.stdout.write(
+                '    Evaluations consistently slower than %.2f ms found in '
+                'corpus.\n' % (checker.SLOW_EVALUATION * 1e3))
+    sys.exit(1 if failed else 0)
+
+
 def _settings(args, parser):
     # Initialize.
     _init(args, parser)
@@ -52,7 +210,7 @@ def _settings(args, parser):
     sys.stdout.write(inspect.getsource(default))
 
 
-def _init(args, parser):
+def _init(args, parser, positional=False):
     # Parse command line arguments.
     (options, args) = parser.parse_args(args)
 
@@ -61,9 +219,23 @@ def _init(args, parser):
         settings.load(options.config)
 
     # Done!
+    if positional:
+        return options, args
     return options
 
 
+def _get_workers(options, parser):
+    # Workers selected using the --workers option (defaults to all).
+    workers = settings.WORKERS
+    if options.workers:
+        names = options.workers.split(',')
+        for name in names:
+            if name not in workers:
+                parser.error('unknown worker %s' % name)
+        workers = dict((name, workers[name]) for name in names)
+    return workers
+
+
 def main():
     # Compose help message.
     help = '''Usage: %(cmd)s <command> [--config=CONFIG] [<options>]
@@ -78,6 +250,16 @@ def main():
   status:
       Shows service status.
 
+  %(header)s[offline]%(endc)s
+  replay [--workers=WORKERS] [--output=FILE] [--processes=N] [--debug] FILE...:
+      Runs workers over files written by 'varnishlog -w'.
+
+  bench [--transactions=N] [--headers=N] [--concurrency=N] [--match-rate=R] [--shards=N,...] ...:
+      Benchmarks tx assembly & matching using synthetic VSL records.
+
+  check-filters [--workers=WORKERS] [--limit=N] [FILE...]:
+      Checks filters & rules, timing them against files written by 'varnishlog -w'.
+
   %(header)s[misc]%(endc)s
   settings:
       Dumps sample configuration file.
@@ -91,7 +273,7 @@ def main():
     # Check base arguments.
     if len(sys.argv) > 1:
         command = '_' + sys.argv[1].replace('-', '_').replace('.', '_')
-        if command in ('_start', '_stop', '_status', '_settings',):
+        if command in ('_start', '_stop', '_status', '_replay', '_bench', '_check_filters', '_settings',):
             parser = OptionParser('usage: %prog ' + sys.argv[1] + ' [options]')
             parser.add_option(
                 '', '--config', dest='config', default=None,
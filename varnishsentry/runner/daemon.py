@@ -14,8 +14,14 @@ import time
 import multiprocessing
 import logging
 from lockfile import pidlockfile
+from Queue import Empty
 from varnishsentry.conf import settings
+from varnishsentry.metrics import Exporter
 from varnishsentry.consumer import Consumer
+from varnishsentry.reader import Reader, Deliverer
+from varnishsentry.shard import Splitter, Shard
+from varnishsentry.ring import Ring, DEFAULT_SIZE as DEFAULT_RING_SIZE
+from varnishsentry.sender import DEFAULT_HIGH_WATERMARK
 
 
 class Daemon(daemon.DaemonContext):
@@ -23,6 +29,8 @@ class Daemon(daemon.DaemonContext):
         self._workers = []
         self._shutdown_event = None
         self._logging_queue = None
+        self._metrics_queue = None
+        self._exporter = None
         self._sigterm = False
         self._sigchld = 0
 
@@ -32,6 +40,7 @@ class Daemon(daemon.DaemonContext):
                 signal.SIGTERM: 'sigterm_handler',
                 signal.SIGINT: 'sigint_handler',
                 signal.SIGCHLD: 'sigchld_handler',
+                signal.SIGUSR1: 'sigusr1_handler',
             })
 
     def start(self, detach=True, debug=False):
@@ -60,21 +69,31 @@ class Daemon(daemon.DaemonContext):
             self._shutdown_event = multiprocessing.Event()
             self._logging_queue = multiprocessing.Queue(-1)
             self._init_logger(debug=debug, console=not detach)
+            if settings.METRICS.get('enabled', False):
+                self._metrics_queue = multiprocessing.Queue(-1)
+                self._exporter = Exporter(
+                    path=settings.METRICS.get('path'),
+                    socket_path=settings.METRICS.get('socket'))
+                self._exporter.start()
 
             # Log.
             logging.getLogger('varnishsentry').info(
                 'Starting varnishsentry service (PID %d)', pid)
 
             # Launch consumers.
-            for id, config in settings.WORKERS.iteritems():
-                worker = Consumer(
-                    pid,
-                    self._shutdown_event,
-                    self._logging_queue,
-                    id,
-                    config,
-                    debug)
-                self._workers.append(worker)
+            if settings.SHARED_READER.get('enabled', False):
+                self._workers = self._build_shared_workers(pid, debug)
+            else:
+                for id, config in settings.WORKERS.iteritems():
+                    self._workers.append(Consumer(
+                        pid,
+                        self._shutdown_event,
+                        self._logging_queue,
+                        id,
+                        config,
+                        debug,
+                        metrics_queue=self._metrics_queue))
+            for worker in self._workers:
                 worker.start()
 
             # Periodically check for termination and for terminated workers.
@@ -89,6 +108,10 @@ class Daemon(daemon.DaemonContext):
                 except:
                     pass
 
+                # Export metrics published by workers.
+                if self._metrics_queue is not None:
+                    self._export_metrics()
+
                 # Some worker has terminated? => rebuild the list of workers.
                 if self._sigchld > 0:
                     workers = []
@@ -124,6 +147,10 @@ class Daemon(daemon.DaemonContext):
             for worker in self._workers:
                 worker.join()
 
+            # Stop metrics exporter.
+            if self._exporter is not None:
+                self._exporter.stop()
+
         # Clean up and exit.
         pidlockfile.remove_existing_pidfile(settings.PIDFILE)
         logging.getLogger('varnishsentry').info(
@@ -183,6 +210,105 @@ class Daemon(daemon.DaemonContext):
         # good enough :)
         self._sigchld += 1
 
+    def sigusr1_handler(self, *args):
+        # Forward profiling requests to all workers.
+        for worker in self._workers:
+            if worker.is_alive():
+                try:
+                    os.kill(worker.pid, signal.SIGUSR1)
+                except OSError:
+                    pass
+
+    def _export_metrics(self):
+        # Fetch all pending snapshots & export them (if any).
+        updated = False
+        while True:
+            try:
+                worker, samples = self._metrics_queue.get_nowait()
+            except Empty:
+                break
+            self._exporter.update(worker, samples)
+            updated = True
+        if updated:
+            try:
+                self._exporter.export()
+            except Exception:
+                logging.getLogger('varnishsentry').error(
+                    'Got unexpected exception while exporting metrics.',
+                    exc_info=True)
+
+    def _build_shared_workers(self, pid, debug):
+        # Group workers by Varnish instance.
+        instances = {}
+        for id, config in settings.WORKERS.iteritems():
+            key = (
+                config.get('options', {}).get('-n'),
+                config.get('libvarnishapi'),
+            )
+            instances.setdefault(key, {})[id] = config
+
+        # Build one reader per instance, and one deliverer per worker.
+        result = []
+        for (name, libvarnishapi), configs in sorted(instances.iteritems()):
+            queues = {}
+            for id, config in sorted(configs.iteritems()):
+                if 'dsn' in config:
+                    queues[id] = multiprocessing.Queue(
+                        config.get('delivery', {}).get('high_watermark', DEFAULT_HIGH_WATERMARK))
+                    result.append(Deliverer(
+                        pid,
+                        self._shutdown_event,
+                        self._logging_queue,
+                        id,
+                        dict(config, queue=queues[id]),
+                        debug,
+                        metrics_queue=self._metrics_queue))
+
+            reader = {
+                'workers': configs,
+                'queues': queues,
+            }
+            for key in ('user', 'group'):
+                if key in settings.SHARED_READER:
+                    reader[key] = settings.SHARED_READER[key]
+
+            # Sharded mode? => a thin reader (i.e. splitter) forwarding records
+            # to several matcher processes (i.e. shards).
+            shards = settings.SHARED_READER.get('shards', 0)
+            if shards > 0:
+                rings = [
+                    Ring(settings.SHARED_READER.get('ring_size', DEFAULT_RING_SIZE))
+                    for i in range(shards)]
+                for i, ring in enumerate(rings):
+                    result.append(Shard(
+                        pid,
+                        self._shutdown_event,
+                        self._logging_queue,
+                        'shard:%s:%d' % (name or 'default', i),
+                        dict(reader, ring=ring),
+                        debug,
+                        metrics_queue=self._metrics_queue))
+                result.append(Splitter(
+                    pid,
+                    self._shutdown_event,
+                    self._logging_queue,
+                    'reader:%s' % (name or 'default'),
+                    dict(reader, rings=rings),
+                    debug,
+                    metrics_queue=self._metrics_queue))
+            else:
+                result.append(Reader(
+                    pid,
+                    self._shutdown_event,
+                    self._logging_queue,
+                    'reader:%s' % (name or 'default'),
+                    reader,
+                    debug,
+                    metrics_queue=self._metrics_queue))
+
+        # Done!
+        return result
+
     def _init_logger(self, debug=False, console=False):
         # Init.
         logger = logging.getLogger('varnishsentry')
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+
+DEFAULT_MAX_BACKLOG = 5000
+
+DEFAULT_MAX_LATENCY = 0.0001
+
+DEFAULT_MIN_FACTOR = 0.01
+
+# Adaptive factor adjustments: multiplicative decrease under pressure, and
+# slower multiplicative increase otherwise.
+DECREASE = 0.5
+
+INCREASE = 1.25
+
+
+class TokenBucket(object):
+    # Classic token bucket: 'rate' tokens per second, up to 'burst' tokens.
+    # Offered & accepted tokens are counted, so the acceptance ratio can be
+    # periodically estimated.
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self._burst
+        self._timestamp = None
+        self._offered = 0
+        self._accepted = 0
+        self.ratio = 1.0
+
+        # Check rate.
+        assert \
+            self._rate > 0 and self._burst >= 1, \
+            'Filter rates must be positive and bursts at least 1.'
+
+    def take(self, now):
+        if self._timestamp is not None:
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._timestamp) * self._rate)
+        self._timestamp = now
+        self._offered += 1
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self._accepted += 1
+            return True
+        return False
+
+    def update_ratio(self):
+        # Acceptance ratio since the last update (unchanged if nothing has
+        # been offered).
+        if self._offered > 0:
+            self.ratio = float(self._accepted) / self._offered
+            self._offered = 0
+            self._accepted = 0
+
+
+class Governor(object):
+    # Adaptive sampling factor of a worker: lowered while its outbound
+    # backlog or the VSL callback latency are above some thresholds, and
+    # slowly restored otherwise.
+
+    def __init__(self, config):
+        self._max_backlog = config.get('max_backlog', DEFAULT_MAX_BACKLOG)
+        self._max_latency = config.get('max_latency', DEFAULT_MAX_LATENCY)
+        self._min_factor = config.get('min_factor', DEFAULT_MIN_FACTOR)
+        self.factor = 1.0
+
+    def update(self, backlog, latency):
+        if backlog > self._max_backlog or \
+           (latency is not None and latency > self._max_latency):
+            self.factor = max(self._min_factor, self.factor * DECREASE)
+        else:
+            self.factor = min(1.0, self.factor * INCREASE)
+        return self.factor
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import time
+import datetime
+import logging
+import threading
+import functools
+from collections import deque
+import raven
+from raven import Client
+from raven.utils import get_auth_header
+from varnishsentry.aggregator import Aggregator
+from varnishsentry.sampling import TokenBucket
+from varnishsentry.spool import Spool, DEFAULT_SEGMENT_SIZE, DEFAULT_MAX_SIZE
+from varnishsentry.transport import KeepAliveHTTPTransport
+
+DEFAULT_THREADS = 2
+
+DEFAULT_BATCH = 32
+
+DEFAULT_HIGH_WATERMARK = 10000
+
+DEFAULT_LOW_WATERMARK = 8000
+
+# Event levels, from highest to lowest priority. Each one gets its own lane in
+# the in-memory outbound queue.
+LEVELS = ('fatal', 'error', 'warning', 'info', 'debug')
+
+# Max. number of events of each level taken from its lane per scheduling round.
+DEFAULT_WEIGHTS = {
+    'fatal': 16,
+    'error': 8,
+    'warning': 4,
+    'info': 2,
+    'debug': 1,
+}
+
+DEFAULT_FSYNC_INTERVAL = 1.0
+
+DEFAULT_FSYNC_BATCH = 1024
+
+MIN_RETRY_BACKOFF = 1.0
+
+MAX_RETRY_BACKOFF = 60.0
+
+
+def build_client(config):
+    # Sentry client of a worker. Whatever the DSN scheme, a synchronous
+    # keep-alive transport is used (with a connection per sender thread):
+    # asynchronous raven transports buffer events in their own unbounded
+    # queues, bypassing the bounded outbound queue. Delivery errors are
+    # always raised, so senders count the outcome of each event (and, when
+    # spooling, events not accepted by Sentry are kept in the spool). Raven
+    # hooks & breadcrumbs are disabled: they are useless for VSL events, and
+    # formatting breadcrumbs dominates the cost of building them.
+    delivery = config.get('delivery', {})
+    return Client(
+        dsn=config['dsn'],
+        transport=functools.partial(
+            KeepAliveHTTPTransport,
+            connections=delivery.get('threads', DEFAULT_THREADS),
+            **delivery.get('transport', {})),
+        raise_send_errors=True,
+        install_sys_hook=False,
+        install_logging_hook=False,
+        enable_breadcrumbs=False)
+
+
+class Sender(object):
+    def __init__(self, client, config, aggregation=None, spool=None):
+        self._client = client
+        self._threads_count = config.get('threads', DEFAULT_THREADS)
+        self._batch = config.get('batch', DEFAULT_BATCH)
+        self._high_watermark = config.get('high_watermark', DEFAULT_HIGH_WATERMARK)
+        self._low_watermark = config.get('low_watermark', DEFAULT_LOW_WATERMARK)
+        self._weights = dict(DEFAULT_WEIGHTS, **config.get('weights', {}))
+        self._lanes = [deque() for level in LEVELS]
+        self._lane = dict((level, i) for i, level in enumerate(LEVELS))
+        self._size = 0
+        self._condition = threading.Condition()
+        self._shedding = False
+        self._running = False
+        self._threads = []
+        self._aggregator = None
+        self._spool = None
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.shed = dict((level, 0) for level in LEVELS)
+
+        # Check watermarks.
+        assert \
+            0 < self._low_watermark <= self._high_watermark, \
+            'Delivery watermarks must satisfy 0 < low <= high.'
+
+        # Check weights.
+        for level, weight in self._weights.iteritems():
+            assert \
+                level in LEVELS and weight >= 1, \
+                'Delivery weights must be at least 1 for valid levels.'
+
+        # Aggregate events before enqueuing them?
+        if aggregation is not None and aggregation.get('enabled', False):
+            self._aggregator = Aggregator(aggregation)
+
+        # Write events to an on-disk spool, drained by a single sender
+        # thread, instead of to the in-memory queue?
+        if spool is not None and spool.get('enabled', False):
+            assert \
+                'path' in spool, \
+                'Spool path is required.'
+            self._spool = Spool(
+                spool['path'],
+                segment_size=spool.get('segment_size', DEFAULT_SEGMENT_SIZE),
+                max_size=spool.get('max_size', DEFAULT_MAX_SIZE))
+            self._fsync_interval = spool.get('fsync_interval', DEFAULT_FSYNC_INTERVAL)
+            self._fsync_batch = spool.get('fsync_batch', DEFAULT_FSYNC_BATCH)
+            self._rate = spool.get('rate')
+            self._bucket = TokenBucket(self._rate) if self._rate else None
+            self._threads_count = 1
+
+    def start(self):
+        self._running = True
+        for i in range(self._threads_count):
+            thread = threading.Thread(
+                target=self._loop if self._spool is None else self._drain,
+                name='sender-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        # Wake up all sender threads and let them flush pending events
+        # (including aggregated ones). When spooling, pending events are
+        # simply kept on disk until the next start.
+        with self._condition:
+            self._flush(force=True)
+            self._running = False
+            self._condition.notify_all()
+
+        # Wait (up to some timeout, if any) for the sender threads.
+        deadline = time.time() + timeout if timeout is not None else None
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0) if deadline is not None else None)
+        self._threads = []
+
+    def put(self, event):
+        with self._condition:
+            if self._aggregator is None:
+                return self._enqueue(event)
+            else:
+                for event in self._aggregator.add(event, time.time()):
+                    self._enqueue(event)
+                return True
+
+    def _enqueue(self, event):
+        # Enqueuing never blocks: once the queue reaches the high watermark
+        # events are shed (and counted per level) until it drains below the
+        # low watermark. Lowest levels are shed first: an incoming event
+        # replaces the oldest queued event of the lowest level below its own,
+        # if any, or it's dropped otherwise. The condition must be held by the
+        # caller.
+        if self._spool is not None:
+            return self._append(event)
+        size = self._size
+        lane = self._lane.get(event['data']['level'], len(LEVELS) - 1)
+
+        # Leave shedding mode once the queue has drained below the low
+        # watermark.
+        if self._shedding and size < self._low_watermark:
+            self._shedding = False
+
+        # Enter shedding mode once the queue reaches the high watermark.
+        if not self._shedding and size >= self._high_watermark:
+            self._shedding = True
+
+        # Shed some event (this one or a queued one of a lower level).
+        if self._shedding:
+            for i in range(len(LEVELS) - 1, lane, -1):
+                if self._lanes[i]:
+                    self._lanes[i].popleft()
+                    self._size -= 1
+                    break
+            else:
+                i = lane
+            self.shed[LEVELS[i]] += 1
+            self.dropped += 1
+            if i == lane:
+                return False
+
+        # Enqueue the event.
+        self._lanes[lane].append(event)
+        self._size += 1
+        self.queued += 1
+        self._condition.notify()
+        return True
+
+    def _append(self, event):
+        # Append an event to the spool. Appending never blocks on disk
+        # synchronization, and the spool itself drops the oldest events once
+        # full. The condition must be held by the caller.
+        dropped = self._spool.dropped
+        try:
+            self._spool.append(event)
+        except Exception:
+            self.dropped += 1
+            return False
+        self.dropped += self._spool.dropped - dropped
+        self.queued += 1
+        if self._spool.unsynced >= self._fsync_batch:
+            self._condition.notify()
+        return True
+
+    @property
+    def size(self):
+        if self._spool is not None:
+            return self._spool.backlog
+        return self._size
+
+    @property
+    def aggregated(self):
+        return self._aggregator.aggregated if self._aggregator is not None else 0
+
+    def _flush(self, force=False):
+        # Enqueue events of closed aggregation windows. The condition must be
+        # held by the caller.
+        if self._aggregator is not None:
+            for event in self._aggregator.flush(time.time(), force=force):
+                self._enqueue(event)
+
+    def _loop(self):
+        while True:
+            # Wait for a batch of pending events.
+            with self._condition:
+                self._flush()
+                while self._running and not self._size:
+                    self._condition.wait(1.0)
+                    self._flush()
+                if not self._size:
+                    return
+                batch = self._schedule()
+
+            # Deliver the batch.
+            self._deliver(batch)
+
+    def _schedule(self):
+        # Weighted round robin across lanes, from highest to lowest level,
+        # until the batch is complete. The condition must be held by the
+        # caller.
+        batch = []
+        while self._size and len(batch) < self._batch:
+            for level, lane in zip(LEVELS, self._lanes):
+                count = min(self._weights[level], len(lane), self._batch - len(batch))
+                for i in xrange(count):
+                    batch.append(lane.popleft())
+                self._size -= count
+        return batch
+
+    def _drain(self):
+        # Spooled events are read, committed & synchronized without holding
+        # the condition, so the VSL callback never waits on the disk.
+        synced = time.time()
+        backoff = MIN_RETRY_BACKOFF
+        while True:
+            # Wait for a batch of spooled events, meanwhile synchronizing
+            # pending writes.
+            synced = self._sync(synced)
+            with self._condition:
+                self._flush()
+                running = self._running
+            if not running:
+                self._spool.close()
+                return
+            batch = self._spool.read(self._batch)
+            if not batch:
+                with self._condition:
+                    if self._running:
+                        self._condition.wait(self._fsync_interval)
+                continue
+
+            # Deliver the batch (honoring the rate limit, if any), stopping at
+            # the first failure.
+            events = []
+            for event, position in batch:
+                if not self._wait_for_token():
+                    break
+                events.append(event)
+            delivered = self._deliver(events, stop=True)
+
+            # Advance (and persist) the cursor past delivered events.
+            if delivered > 0:
+                self._spool.commit(batch[delivered - 1][1])
+                self._spool.sync()
+                synced = time.time()
+                backoff = MIN_RETRY_BACKOFF
+
+            # Back off after a failure. Undelivered events will be retried.
+            if delivered < len(batch):
+                deadline = time.time() + backoff
+                while self._running and time.time() < deadline:
+                    synced = self._sync(synced)
+                    with self._condition:
+                        self._condition.wait(max(0, min(
+                            deadline - time.time(), self._fsync_interval)))
+                backoff = min(backoff * 2, MAX_RETRY_BACKOFF)
+
+    def _sync(self, synced):
+        # Synchronize the spool (if enough pending writes, or after some
+        # interval). Returns the time of the last synchronization.
+        now = time.time()
+        if self._spool.unsynced >= self._fsync_batch or \
+           (self._spool.pending and now - synced >= self._fsync_interval):
+            self._spool.sync()
+            return now
+        return synced
+
+    def _wait_for_token(self):
+        if self._bucket is not None:
+            while not self._bucket.take(time.time()):
+                if not self._running:
+                    return False
+                time.sleep(1.0 / self._rate)
+        return self._running
+
+    def _deliver(self, batch, stop=False):
+        # Deliver a batch of events. All of them are built & encoded first,
+        # signed with a single auth header, and then posted back to back over
+        # a single keep-alive connection (the Sentry store API accepts one
+        # event per request). If required, delivery stops at the first
+        # failure. Outcomes are counted. Returns the number of leading events
+        # accepted by Sentry.
+        client = self._client
+        payloads = []
+        for event in batch:
+            try:
+                payloads.append(client.encode(self._build(event)))
+            except Exception as e:
+                payloads.append(e)
+                logging.getLogger('varnishsentry').error(
+                    'Got unexpected exception while building Sentry event.',
+                    exc_info=True)
+                if stop:
+                    break
+        encoded = [payload for payload in payloads if isinstance(payload, str)]
+        result = []
+        if encoded:
+            agent = 'raven-python/%s' % raven.VERSION
+            headers = {
+                'User-Agent': agent,
+                'X-Sentry-Auth': get_auth_header(
+                    protocol=client.protocol_version,
+                    timestamp=time.time(),
+                    client=agent,
+                    api_key=client.remote.public_key,
+                    api_secret=client.remote.secret_key),
+                'Content-Encoding': client.get_content_encoding(),
+                'Content-Type': 'application/octet-stream',
+            }
+            try:
+                result = client.remote.get_transport().send_batch(
+                    client.remote.store_endpoint, encoded, headers, stop=stop)
+            except Exception as e:
+                result = [e] * len(encoded)
+
+        # Count outcomes.
+        result = iter(result)
+        delivered = None
+        for i, payload in enumerate(payloads):
+            if isinstance(payload, str):
+                error = next(result)
+                if error is None:
+                    self.sent += 1
+                    continue
+                logging.getLogger('varnishsentry').error(
+                    'Got unexpected exception while delivering event to Sentry: %s',
+                    error)
+            self.failed += 1
+            if delivered is None:
+                delivered = i
+                if stop:
+                    break
+        return len(payloads) if delivered is None else delivered
+
+    def _build(self, event):
+        data = dict(event['data'])
+        data['timestamp'] = datetime.datetime.fromtimestamp(data['timestamp'])
+        return self._client.build_msg(
+            'raven.events.Message',
+            data=data,
+            extra=event['extra'],
+            message=event['message'])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import time
+import logging
+from varnishsentry import api
+from varnishsentry import metrics
+from varnishsentry.consumer import MIN_IDLE_BACKOFF, MAX_IDLE_BACKOFF
+from varnishsentry.reader import Reader
+
+
+class Splitter(Reader):
+    # Thin shared reader: relevant VSL records are not processed, but copied
+    # to the ring buffer of some shard. The shard is selected by fd, so all
+    # records of a tx are always handled by the same shard.
+
+    def _init_delivery(self):
+        # Events are delivered by shards.
+        self._senders = {}
+        self._dropped = {}
+        self._rings = self._config['rings']
+        self._overflows = 0
+        self._logged_overflows = 0
+
+    def _poll_delivery(self):
+        # Have records been dropped because of full ring buffers?
+        if self._overflows > self._logged_overflows:
+            logging.getLogger('varnishsentry').warning(
+                'Shard ring buffers are full. %d records dropped so far.',
+                self._overflows)
+            self._logged_overflows = self._overflows
+
+    def _metrics_delivery(self):
+        result = [metrics.counter('ring_overflows_total', self._overflows)]
+        for index, ring in enumerate(self._rings):
+            result.append(metrics.gauge('ring_used_bytes', ring.used, ring=index))
+        return result
+
+    def _vap_callBack(self, priv, tag, fd, length, spec, ptr, bm):
+        # Stop dispatching ASAP when shutting down.
+        if not self._consuming:
+            return 1
+        self._records += 1
+
+        # Forward relevant items to the right shard.
+        if self._dispatch[spec][tag] is not None:
+            self._tag_records[tag] += 1
+            if not self._rings[fd % len(self._rings)].put(spec, tag, fd, ptr, length):
+                self._overflows += 1
+
+
+class Shard(Reader):
+    # Matcher process: assembles & matches txs from records forwarded by a
+    # splitter. Matched txs are delivered to the same deliverers used by
+    # shared readers.
+
+    def _get_correlation(self):
+        # Client & backend txs of the same request are usually handled by
+        # different shards (they're selected by fd), so they can't be
+        # correlated.
+        if super(Shard, self)._get_correlation() is not None:
+            logging.getLogger('varnishsentry').warning(
+                'Correlation of client & backend txs is not available when '
+                'sharding.')
+        return None
+
+    def _connect(self):
+        return api.VarnishTags(
+            sopath=self._get_config('libvarnishapi', 'libvarnishapi.so.1'))
+
+    def _loop(self):
+        self._consuming = True
+        ring = self._config['ring']
+        backoff = MIN_IDLE_BACKOFF
+        while self._consuming:
+            try:
+                # Process available records. Nothing to do? Purge buffered txs
+                # and wait a bit, increasing the delay while idle.
+                if ring.consume(self._vap_callBack) == 0:
+                    self._purge_buffers(int(self._clock()))
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_IDLE_BACKOFF)
+                else:
+                    backoff = MIN_IDLE_BACKOFF
+            except Exception:
+                logging.getLogger('varnishsentry').error(
+                    'Got unexpected exception while processing VSL item.',
+                    exc_info=True)
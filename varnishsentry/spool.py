@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import os
+import zlib
+import struct
+import marshal
+import logging
+import threading
+
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Record header: payload length & CRC32.
+HEADER = struct.Struct('=Ii')
+
+SEGMENT_SUFFIX = '.spool'
+
+CURSOR = 'cursor'
+
+
+class Spool(object):
+    # Append-only on-disk queue of events, split into numbered segment files.
+    # Records are marshaled events framed with their length and CRC32, so
+    # torn writes are detected. A cursor file holds the position of the next
+    # event to be read (segment number & offset), and it's atomically
+    # replaced when events are committed. Segments before the cursor are
+    # removed. After a restart writing always starts in a new segment.
+    # Once the total size goes beyond some limit the oldest segments are
+    # dropped, even if they hold unread events (which are counted).
+    #
+    # Appending is meant to be called from latency sensitive code: it never
+    # touches the disk beyond buffered writes (and opening new segments).
+    # Everything else (fsync'ing, reading, persisting the cursor & removing
+    # segments) is done by a single consumer thread calling read(), commit()
+    # & sync(), holding the internal lock only to update the in-memory state.
+    # Event counts of all segments are kept in memory, so both the backlog
+    # and dropped events are known without reading segments.
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE, max_size=DEFAULT_MAX_SIZE):
+        self._path = path
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._writer = None
+        self._unsynced = 0
+        self._retired = []
+        self._garbage = []
+        self._dirty = False
+        self._reading = None
+        self.dropped = 0
+        self.backlog = 0
+
+        # Load existing segments (sizes & event counts) & cursor. The cursor
+        # is a (segment, offset, events before offset) tuple.
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(path)
+            if name.endswith(SEGMENT_SUFFIX))
+        self._sizes = {}
+        self._counts = {}
+        cursor = self._load_cursor()
+        index = 0
+        for segment in self._segments:
+            self._sizes[segment], self._counts[segment], before = \
+                self._scan(segment, cursor[1] if segment == cursor[0] else None)
+            if segment == cursor[0]:
+                index = before
+        self._size = sum(self._sizes.itervalues())
+        self._cursor = (cursor[0], cursor[1], index)
+        self._update_backlog()
+
+        # Open a new segment for writing.
+        self._roll()
+
+    def append(self, event):
+        payload = marshal.dumps(event)
+        with self._lock:
+            if self._sizes[self._segments[-1]] >= self._segment_size:
+                self._roll()
+            segment = self._segments[-1]
+            self._writer.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._writer.write(payload)
+            self._sizes[segment] += HEADER.size + len(payload)
+            self._counts[segment] += 1
+            self._size += HEADER.size + len(payload)
+            self._unsynced += 1
+            self.backlog += 1
+
+            # Enforce size limit dropping the oldest segments.
+            while self._size > self._max_size and len(self._segments) > 1:
+                self._drop_oldest()
+
+    @property
+    def unsynced(self):
+        return self._unsynced
+
+    @property
+    def pending(self):
+        # Is there anything to be done by sync()?
+        return self._unsynced > 0 or self._dirty or \
+            len(self._retired) > 0 or len(self._garbage) > 0
+
+    def sync(self):
+        # Flush & fsync pending writes (including those of retired segments),
+        # persist the cursor and remove unneeded segments. The internal lock
+        # is only held while flushing & collecting pending work.
+        with self._lock:
+            fds = [os.dup(self._writer.fileno())] if self._unsynced > 0 else []
+            if self._unsynced > 0:
+                self._writer.flush()
+                self._unsynced = 0
+            retired, self._retired = self._retired, []
+            garbage, self._garbage = self._garbage, []
+            cursor = self._cursor[:2] if self._dirty else None
+            self._dirty = False
+        for writer in retired:
+            fds.append(os.dup(writer.fileno()))
+            writer.close()
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if cursor is not None:
+            self._save_cursor(cursor)
+        for segment in garbage:
+            try:
+                os.unlink(self._get_segment_path(segment))
+            except OSError:
+                pass
+
+    def read(self, limit):
+        # Read up to some number of events starting at the cursor. Returns
+        # a list of (event, position) pairs. Positions can be committed once
+        # events have been processed. Files are read without holding the
+        # internal lock, and only up to their flushed size.
+        with self._lock:
+            if self._unsynced > 0:
+                self._writer.flush()
+            segment, offset, index = self._cursor
+            segments = list(self._segments)
+            sizes = dict(self._sizes)
+        result = []
+        while len(result) < limit and segment in sizes:
+            active = segment == segments[-1]
+            with open(self._get_segment_path(segment), 'rb') as f:
+                f.seek(offset)
+                while len(result) < limit and offset < sizes[segment]:
+                    header = f.read(HEADER.size)
+                    if len(header) == HEADER.size:
+                        length, crc = HEADER.unpack(header)
+                        payload = f.read(length)
+                        if len(payload) == length and zlib.crc32(payload) == crc:
+                            offset += HEADER.size + length
+                            index += 1
+                            result.append((marshal.loads(payload), (segment, offset, index)))
+                            continue
+                    break
+
+            # Done with the active segment? Otherwise, move on to the next
+            # one (skipping torn records left by some crash, if any).
+            if active or len(result) >= limit:
+                break
+            if offset < sizes[segment]:
+                logging.getLogger('varnishsentry').warning(
+                    'Skipping corrupted data in spool segment %d.', segment)
+            segment, offset, index = self._next_segment(segment, segments), 0, 0
+            if len(result) == 0:
+                with self._lock:
+                    if self._cursor[0] < segment:
+                        self._cursor = (segment, 0, 0)
+                        self._dirty = True
+                        self._update_backlog()
+
+        # Remember the position of the last read event (events already read
+        # are not counted as dropped).
+        with self._lock:
+            self._reading = result[-1][1] if result else None
+        return result
+
+    def commit(self, position):
+        # Advance the cursor (unless some drop already moved it further) and
+        # schedule removal of fully processed segments. The cursor is
+        # persisted by the next sync().
+        with self._lock:
+            self._reading = None
+            if position > self._cursor:
+                self._cursor = position
+                self._dirty = True
+                while self._segments[0] < position[0]:
+                    self._remove(self._segments[0])
+                self._update_backlog()
+
+    def close(self):
+        if self._writer is not None:
+            with self._lock:
+                self._retired.append(self._writer)
+                self._writer = None
+                self._unsynced = 0
+            self.sync()
+
+    def _roll(self):
+        # Start a new segment. The previous one is fsync'ed & closed by the
+        # next sync(). The internal lock must be held by the caller.
+        if self._writer is not None:
+            self._writer.flush()
+            self._retired.append(self._writer)
+            self._unsynced = 0
+        segment = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(segment)
+        self._sizes[segment] = 0
+        self._counts[segment] = 0
+        self._writer = open(self._get_segment_path(segment), 'ab')
+        if self._cursor[0] not in self._sizes:
+            self._cursor = (segment, 0, 0)
+
+    def _drop_oldest(self):
+        # Drop the oldest segment, counting its unread events (neither
+        # committed nor already read). The internal lock must be held by the
+        # caller.
+        segment = self._segments[0]
+        if segment == self._cursor[0]:
+            if self._reading is None or self._reading[0] < segment:
+                self.dropped += self._counts[segment] - self._cursor[2]
+            elif self._reading[0] == segment:
+                self.dropped += self._counts[segment] - self._reading[2]
+            self._cursor = (self._next_segment(segment, self._segments), 0, 0)
+            self._dirty = True
+        self._remove(segment)
+        self._update_backlog()
+
+    def _remove(self, segment):
+        # The internal lock must be held by the caller.
+        self._size -= self._sizes.pop(segment)
+        del self._counts[segment]
+        self._segments.remove(segment)
+        self._garbage.append(segment)
+
+    def _update_backlog(self):
+        # Unread events: those after the cursor. The internal lock must be
+        # held by the caller.
+        segment, offset, index = self._cursor
+        self.backlog = sum(
+            count for item, count in self._counts.iteritems()
+            if item >= segment) - (index if segment in self._counts else 0)
+
+    def _scan(self, segment, offset=None):
+        # Size & number of (complete) records of a segment, and number of
+        # records before some offset. Payloads are not read.
+        size = os.path.getsize(self._get_segment_path(segment))
+        count = 0
+        before = 0
+        with open(self._get_segment_path(segment), 'rb') as f:
+            position = 0
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                position += HEADER.size + HEADER.unpack(header)[0]
+                if position > size:
+                    break
+                f.seek(position)
+                count += 1
+                if offset is not None and position <= offset:
+                    before += 1
+        return size, count, before
+
+    def _next_segment(self, segment, segments):
+        for item in segments:
+            if item > segment:
+                return item
+        return segment + 1
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self._path, CURSOR)) as f:
+                segment, offset = map(int, f.read().split())
+        except (IOError, ValueError):
+            segment, offset = 0, 0
+        if segment not in self._segments:
+            segment = self._next_segment(segment - 1, self._segments) if self._segments else 0
+            offset = 0
+        return (segment, offset)
+
+    def _save_cursor(self, cursor):
+        path = os.path.join(self._path, CURSOR)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d\n' % cursor)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _get_segment_path(self, segment):
+        return os.path.join(self._path, '%016d%s' % (segment, SEGMENT_SUFFIX))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+'''
+:copyright: (c) 2014 by Carlos Abalde, see AUTHORS.txt for more details.
+'''
+
+from __future__ import absolute_import
+import ssl
+import time
+import random
+import socket
+import httplib
+import threading
+from urlparse import urlparse
+from raven.conf import defaults
+from raven.exceptions import APIError, RateLimited
+from raven.transport.base import Transport
+
+DEFAULT_CONNECTIONS = 2
+
+DEFAULT_RETRIES = 2
+
+DEFAULT_BACKOFF = 0.1
+
+DEFAULT_MAX_BACKOFF = 5.0
+
+
+class KeepAliveHTTPTransport(Transport):
+    # Synchronous HTTP transport keeping a small pool of persistent
+    # connections to the Sentry server, so concurrent sender threads reuse
+    # them instead of paying the connection setup for every event. Batches
+    # of payloads are posted back to back over a single connection. Failed
+    # requests (network errors & 5xx responses) are retried with exponential
+    # backoff & full jitter. Payloads are already compressed by the client.
+
+    scheme = ['http', 'https']
+
+    def __init__(self, timeout=defaults.TIMEOUT, verify_ssl=True,
+                 ca_certs=defaults.CA_BUNDLE, connections=DEFAULT_CONNECTIONS,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self._timeout = float(timeout)
+        self._verify_ssl = verify_ssl not in (False, '0', 'false')
+        self._ca_certs = ca_certs
+        self._connections = int(connections)
+        self._retries = int(retries)
+        self._backoff = float(backoff)
+        self._max_backoff = float(max_backoff)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def send(self, url, data, headers):
+        error = self.send_batch(url, [data], headers)[0]
+        if error is not None:
+            raise error
+
+    def send_batch(self, url, payloads, headers, stop=False):
+        # Post several payloads back to back over a single connection (as
+        # long as the server keeps it alive). Returns the outcome of each
+        # payload: None if accepted, or the raised exception otherwise. Once
+        # rate limited (or after any failure, if required) remaining payloads
+        # are not posted, and they get the same outcome.
+        url = urlparse(url)
+        path = url.path + ('?' + url.query if url.query else '')
+        connection = None
+        result = []
+        try:
+            for data in payloads:
+                if result and result[-1] is not None and \
+                   (stop or isinstance(result[-1], RateLimited)):
+                    result.append(result[-1])
+                    continue
+                try:
+                    connection = self._post(url, path, data, headers, connection)
+                except (APIError, httplib.HTTPException, socket.error) as e:
+                    connection = None
+                    result.append(e)
+                else:
+                    result.append(None)
+        finally:
+            if connection is not None:
+                self._release(connection)
+        return result
+
+    def _post(self, url, path, data, headers, connection=None):
+        # Post a payload (retrying failed requests) using some connection, or
+        # a pooled / new one. Returns the connection if it can be reused (None
+        # otherwise). On failure the connection is already released / closed.
+        attempt = 0
+        while True:
+            if connection is None:
+                connection = self._acquire(url)
+            try:
+                connection.request('POST', path, data, headers)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                # Network errors (including keep-alive connections closed by
+                # the server).
+                connection.close()
+                connection = None
+                if attempt >= self._retries:
+                    raise
+            else:
+                # Keep the connection for later requests?
+                if response.will_close:
+                    connection.close()
+                    connection = None
+
+                # Check response.
+                if 200 <= response.status < 300:
+                    return connection
+                message = response.getheader('x-sentry-error') or response.reason
+                error = None
+                if response.status == 429:
+                    try:
+                        retry_after = int(response.getheader('retry-after'))
+                    except (ValueError, TypeError):
+                        retry_after = 0
+                    error = RateLimited(message, retry_after)
+                elif response.status < 500 or attempt >= self._retries:
+                    error = APIError(message, response.status)
+                if error is not None:
+                    if connection is not None:
+                        self._release(connection)
+                    raise error
+
+            # Wait before retrying.
+            attempt += 1
+            time.sleep(self._random.uniform(
+                0, min(self._max_backoff, self._backoff * 2 ** attempt)))
+
+    def _acquire(self, url):
+        # Reuse an idle connection to the same server, or open a new one.
+        key = (url.scheme, url.netloc)
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == key:
+                    return self._idle.pop(i)[1]
+        if url.scheme == 'https':
+            if not self._verify_ssl:
+                context = ssl._create_unverified_context()
+            else:
+                context = ssl.create_default_context(cafile=self._ca_certs)
+            connection = httplib.HTTPSConnection(
+                url.netloc, timeout=self._timeout, context=context)
+        else:
+            connection = httplib.HTTPConnection(url.netloc, timeout=self._timeout)
+        connection.key = key
+        return connection
+
+    def _release(self, connection):
+        # Return a connection to the pool, closing the oldest idle one if the
+        # pool is full.
+        with self._lock:
+            self._idle.append((connection.key, connection))
+            if len(self._idle) > self._connections:
+                self._idle.pop(0)[1].close()
@@ -12,21 +12,26 @@ import grp
 import multiprocessing
 import logging
 import signal
+from varnishsentry import profiler
 from varnishsentry.conf import settings
 from varnishsentry.helpers import log
 
 
 class Worker(multiprocessing.Process):
-    def __init__(self, ppid, shutdown_event, logging_queue, id, config, debug, retries=0):
+    def __init__(self, ppid, shutdown_event, logging_queue, id, config, debug, retries=0,
+                 metrics_queue=None):
         super(Worker, self).__init__(name=id)
         self._ppid = ppid
         self._shutdown_event = shutdown_event
         self._logging_queue = logging_queue
+        self._metrics_queue = metrics_queue
         self._config = config
         self._debug = debug
         self._retries = retries
         self._stopping = False
         self._timestamp = int(time.time())
+        self._profile_requested = False
+        self._profiler = None
 
     def restart(self):
         # Build new worker based on the current one.
@@ -37,7 +42,8 @@ class Worker(multiprocessing.Process):
             self.name,
             self._config,
             self._debug,
-            retries=0 if (int(time.time()) - self._timestamp > 60) else self._retries + 1)
+            retries=0 if (int(time.time()) - self._timestamp > 60) else self._retries + 1,
+            metrics_queue=self._metrics_queue)
 
         # Launch.
         worker.start()
@@ -69,6 +75,7 @@ class Worker(multiprocessing.Process):
             signal.signal(signal.SIGTERM, signal.SIG_DFL)
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, self._sigusr1_handler)
 
             # Add some delay if required.
             delay = min(self._retries * 0.5, 10.0)
@@ -79,7 +86,8 @@ class Worker(multiprocessing.Process):
             # Specific worker initialization.
             self._init()
 
-            # Periodically check for termination.
+            # Periodically check for termination (and publish metrics).
+            next_publication = time.time()
             while not self._stopping:
                 # Check if the parent process is still alive.
                 if self._ppid is not None and os.getppid() != self._ppid:
@@ -90,6 +98,12 @@ class Worker(multiprocessing.Process):
                 # Poll worker & wait for the next check.
                 else:
                     self._poll()
+                    if self._metrics_queue is not None and time.time() >= next_publication:
+                        self._publish_metrics()
+                        next_publication = time.time() + settings.METRICS.get('interval', 10)
+                    if self._profile_requested:
+                        self._profile_requested = False
+                        self._profile()
                     time.sleep(1.0)
         except Exception as e:
             logging.getLogger('varnishsentry').error(
@@ -111,6 +125,45 @@ class Worker(multiprocessing.Process):
     def _shutdown(self):
         raise NotImplementedError('Please implement this method.')
 
+    def _metrics(self):
+        return []
+
+    def _publish_metrics(self):
+        try:
+            self._metrics_queue.put_nowait((self.name, self._metrics()))
+        except Exception:
+            logging.getLogger('varnishsentry').error(
+                'Got unexpected exception while publishing metrics.',
+                exc_info=True)
+
+    def _get_profiled_threads(self):
+        # None means all threads.
+        return None
+
+    def _profile(self):
+        # Launch a sampling profiler, unless some profile is already running.
+        if self._profiler is not None and self._profiler.is_alive():
+            logging.getLogger('varnishsentry').warning(
+                'Ignoring profiling request. Profiling already in progress.')
+            return
+        path = settings.PROFILING.get('path', profiler.DEFAULT_PATH) % {
+            'worker': self.name.replace('/', '_'),
+            'pid': os.getpid(),
+            'timestamp': int(time.time()),
+        }
+        self._profiler = profiler.Profiler(
+            path,
+            duration=settings.PROFILING.get('duration', profiler.DEFAULT_DURATION),
+            interval=settings.PROFILING.get('interval', profiler.DEFAULT_INTERVAL),
+            threads=self._get_profiled_threads())
+        self._profiler.start()
+        logging.getLogger('varnishsentry').info(
+            'Profiling worker. Results will be written to %s.*', path)
+
+    def _sigusr1_handler(self, *args):
+        # Profiling is launched from the main loop, not from the handler.
+        self._profile_requested = True
+
     def _init_logger(self):
         # Set custom root logger.
         handler = log.QueueHandler(